@@ -10,7 +10,16 @@ def parse_args():
     parser.add_argument("--simulator", choices=['0','1'], default=0, help="Simulation versions: 0 = Hardware Only, 1 = Fully Simulated")
     #parser.add_argument("--ssd", choices=['0','1'], default=0, help="Choose to spoof polled sensor data (temperature, pressure, o2 concentration) or not. 0 = No, 1 = Yes")
     parser.add_argument("--loop_delay", type=int, default = 100, help="Time delay between system loops, in milliseconds.")
-    #parser.add_argument("--log_lev", choices=['0','1','2','3','4','5'],default = 0, help="The level at which colony debug printing will occur. 0 = Verbose, 1 = Info, 2 = Debug, 3 = Warning, 4 = Error, 5 = WTF")
+    parser.add_argument("--execution", choices=['thread','pool'], default='thread', help="Subsystem execution mode: thread = one thread per subsystem, pool = shared worker pool")
+    parser.add_argument("--workers", type=int, default=2, help="Number of worker threads when using --execution pool.")
+    parser.add_argument("--bus_latency", type=float, default=0, help="With --simulator 1: time taken by every simulated I2C transaction, in milliseconds.")
+    parser.add_argument("--nack_rate", type=float, default=0, help="With --simulator 1: probability that a simulated I2C transaction is not acknowledged.")
+    parser.add_argument("--time_scale", type=float, default=1, help="With --simulator 1: how many times faster than real time the simulated hardware (door, valves, chamber pressure) runs.")
+    parser.add_argument("--telemetry_dir", default=None, help="Directory to write the binary telemetry log to. Telemetry is not recorded if omitted.")
+    parser.add_argument("--metrics_port", type=int, default=0, help="Port to serve runtime metrics on, at http://localhost:<port>/metrics. Metrics are not collected if 0.")
+    parser.add_argument("--log_lev", choices=['0','1','2','3','4','5'],default = 0, help="The level at which colony debug printing will occur. 0 = Verbose, 1 = Info, 2 = Debug, 3 = Warning, 4 = Error, 5 = WTF")
+    parser.add_argument("--log_file", default=None, help="File the log is appended to as well as the console, e.g. on the SD card.")
+    parser.add_argument("--log_json", choices=['0','1'], default=0, help="Log format: 0 = text lines, 1 = one JSON object per record")
 
     # CL ARG PARSING
     config_data = parser.parse_args()
@@ -37,6 +46,12 @@ if __name__ == "__main__":
 
     runtime_params = parse_args()
 
+    log = importlib.import_module('pi-systems_log')
+    log.configure(
+        level=int(runtime_params.log_lev),
+        path=runtime_params.log_file,
+        as_json=str(runtime_params.log_json) == '1')
+
     os.system("Title UBC Mars Colony - Airlock Startup Dialog")
     os.system("cls")
 
@@ -51,7 +66,22 @@ if __name__ == "__main__":
     # Wait for new user input to proceediIsl
     print("Preliminary setup completed.\nSYSTEM READY")
     # os.system("PAUSE")
-    pi_main_sys = importlib.import_module('pi-main_primary')
+    if runtime_params.metrics_port:
+        metrics = importlib.import_module('pi-systems_metrics')
+        metrics.serve(runtime_params.metrics_port)
+
+    if str(runtime_params.simulator) == '1':
+        # Select the simulated hardware before any subsystem is imported.
+        hardware = importlib.import_module('pi-systems_hardware')
+        clocks = importlib.import_module('pi-systems_clock')
+        hardware.select(
+            hardware.Backend.Simulator,
+            clock=clocks.ScaledClock(runtime_params.time_scale),
+            latency_s=runtime_params.bus_latency / 1000,
+            nack_rate=runtime_params.nack_rate)
+        pi_main_sys = importlib.import_module('pi-main_simulated')
+    else:
+        pi_main_sys = importlib.import_module('pi-main_primary')
 
     # Move to the main system file. System begins lifecycle here.
     pi_main_sys.begin(runtime_params)
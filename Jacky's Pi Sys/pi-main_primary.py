@@ -17,6 +17,8 @@ pressure_ss = importlib.import_module('pi-systems_pressure-manager')
 door_ss = importlib.import_module('pi-systems_door-subsystem')
 hexdisplay_ss = importlib.import_module('pi-systems_hexdisplay-subsystem')
 interface_ss = importlib.import_module('pi-systems_interface-subsystem')
+async_ss = importlib.import_module('pi-systems_async-subsystem')
+telemetry = importlib.import_module('pi-systems_telemetry-log')
 
 """
 Purpose: Performs initial system setup and begins airlock loop cycle.
@@ -30,6 +32,13 @@ def begin(runtime_params):
     start_time = time()
     print("\n\n---INITIALIZING AIRLOCK SYSTEMS---")
 
+    ss_pool.set_execution_mode(
+        runtime_params.execution,
+        runtime_params.workers)
+
+    if runtime_params.telemetry_dir:
+        telemetry.open_log(runtime_params.telemetry_dir)
+
     # Start initializing the vital airlock systems
     subsystems = []
 
@@ -184,7 +193,9 @@ def begin(runtime_params):
 
     print("\n---ALL SUBSYSTEMS STARTED---\n")
     print("\n---STARTING FSMs---")
-    fsms = importlib.import_module('pi-systems-subsys_FSMs')
+    # The supervisor-based FSMs: stepped on input and sensor changes
+    # rather than spinning until each target is reached.
+    fsms = importlib.import_module('pi-systems_FSMs')
     print("\n---FSM HAS STARTED---")
 
     keyboard.on_press(handle_cmd)
@@ -196,23 +207,23 @@ def begin(runtime_params):
 
     print("\n---STARTING LOOPER SEQUENCE---\n")
 
+    # The runner blocks on the event loop (no busy loop) and drives any
+    # AsyncSubsystem, plus any subsystem that was not started above.
+    runner = async_ss.AsyncRunner()
     while True:
         try:
-            loop(runtime_params)
+            runner.run()
         except KeyboardInterrupt:
             cmd_input = input("Shut down colony? (y/n)\n")
             if cmd_input == "y" or cmd_input == "Y":
                 ss_pool.stop_all()
+                telemetry.close_log()
                 exit(0)
                 break
             else:
                 print("Airlock shutdown cancelled")
 
 
-def loop(runtime_params):
-    pass
-
-
 def handle_cmd(cmd):
     cmd = cmd.name
     subsystems = ss_pool.get_all()
@@ -288,4 +299,5 @@ def handle_cmd(cmd):
     elif cmd is '!':
         print('---STOPPING COLONY---')
         ss_pool.stop_all()
+        telemetry.close_log()
         exit(0)
@@ -1,49 +1,106 @@
-def begin(config_data_dict):
-    log.print_config(config_data_dict["log_level"])
-
-    light_thread = light_ss.LightingThread("LightThread", 3)
-    light_thread.start()
-    
-    try:
-        loop(config_data_dict)
-    except KeyboardInterrupt:
-        print("Shutting down colony...")
-        ss_pool.stopAll()
-        exit(0)
-
-    
-def loop(config_data):
-    
-    while True:
-        if config_data["ssd"] == 0:
-            data_reader.update_sensor_data()
-        else:
-            #Access the local variable to write directly to it
-            data_reader.__sensor_data = {"GasComposition":{"CO2":450, "O2":21.3},"Temperature":25, "Pressure":100000000000, "Motion Detector":0}
-            
-        log.d(TAG, str(data_reader.get_sensor_data()))
-        
-        time.sleep(config_data["loop_delay"])
-            
-#initialization
-TAG = "pi-main_simulated"
-
-import sys
 import importlib
 import time
 
-print("STARTING SYSTEM")
-
-# Data Reader
-# sys.path.insert(0, '../pi-comms')
-# log = importlib.import_module("pi-comms_log")
+"""
+Purpose: Runs the airlock subsystems against the simulated hardware
+    (pi-systems_simulator.py) instead of a Pi and its Arduinos.
+    Started by init.py with --simulator 1.
+"""
 
-# sys.path.insert(0, '../pi-comms/pi-comms_data-reader')
-# data_reader = importlib.import_module('pi-comms_data-reader-v2')
+hardware = importlib.import_module('pi-systems_hardware')
+# The simulator must be selected before the subsystems are imported, as
+# the I2C bus is opened when pi-systems_communications is imported.
+if hardware.backend is not hardware.Backend.Simulator:
+    hardware.select(hardware.Backend.Simulator)
 
-# Lighting
-# sys.path.insert(0, '../pi-systems/')
-light_ss = importlib.import_module('pi-systems_lighting_lights-manager')
 ss_pool = importlib.import_module('pi-systems_subsystem-pool')
+sensor_ss = importlib.import_module('pi-systems_sensor-reader')
+lights_ss = importlib.import_module('pi-systems_lights-manager')
+pressure_ss = importlib.import_module('pi-systems_pressure-manager')
+door_ss = importlib.import_module('pi-systems_door-subsystem')
+hexdisplay_ss = importlib.import_module('pi-systems_hexdisplay-subsystem')
+comms = importlib.import_module('pi-systems_communications')
+telemetry = importlib.import_module('pi-systems_telemetry-log')
+watchdog = importlib.import_module('pi-systems_watchdog')
+
+
+"""
+Purpose: Creates the subsystems on the simulated bus and prints what the
+    simulated Arduinos see until interrupted.
+Parameter: runtime_params - The Namespace returned by the argument parser
+    in init.py
+"""
+def begin(runtime_params):
+    sim = hardware.simulator
+    print("\n\n---INITIALIZING SIMULATED AIRLOCK---")
+    print(sim)
+
+    ss_pool.set_execution_mode(
+        runtime_params.execution,
+        runtime_params.workers)
 
-print("SYSTEM READY\n-------------\n-------------\n\n")
\ No newline at end of file
+    if runtime_params.telemetry_dir:
+        telemetry.open_log(runtime_params.telemetry_dir)
+
+    sensors = sensor_ss.SensorSubsystem(
+        name="airlock1_sensors",
+        thread_id=0xDE7EC7,
+        addresses=sim.sensors.address)
+
+    subsystems = [
+        sensors,
+        lights_ss.LightingSubsystem(
+            name="airlock1_lights-internal",
+            thread_id=0x5EE,
+            pins=18),
+        pressure_ss.PressureSubsystem(
+            name="airlock1_pressurization",
+            thread_id=0xAE120,
+            sensors=sensors),
+        door_ss.DoorSubsystem(
+            name="airlock1_door_col",
+            thread_id=0xD00121,
+            address=sim.door.address),
+        hexdisplay_ss.HexDisplaySubsystem(
+            name="hexdisplay_internal",
+            thread_id="hexdisp",
+            address=sim.hexdisplay.address,
+            display_data_fns=[
+                lambda: sensors.sensor_data['O2'],
+                lambda: sensors.sensor_data['CO2'],
+                lambda: sensors.sensor_data['temperature'],
+                lambda: sensors.sensor_data['pressure']
+            ])
+    ]
+
+    for subsystem in subsystems:
+        subsystem.start()
+    dog = watchdog.Watchdog(subsystems)
+    dog.start()
+    print("---ALL SUBSYSTEMS STARTED---\n")
+
+    try:
+        loop(runtime_params, sim, sensors, dog)
+    except KeyboardInterrupt:
+        print("Shutting down colony...")
+        dog.stop()
+        ss_pool.stop_all()
+        telemetry.close_log()
+
+
+def loop(runtime_params, sim, sensors, dog):
+    while True:
+        time.sleep(runtime_params.loop_delay)
+        print("sensors: %s" % sensors.sensor_data)
+        print("door: state=%i position=%i  valves: target=%i open=%s/%s  "
+              "display: %s" % (
+                  sim.door.door_state, sim.door.position,
+                  sim.pressure.target_state,
+                  sim.pressure.pressurizer_open,
+                  sim.pressure.depressurizer_open,
+                  sim.hexdisplay.values))
+        print("commands: pressure=%s door=%s" % (
+            ss_pool.get("airlock1_pressurization").command_latency.report(),
+            ss_pool.get("airlock1_door_col").command_latency.report()))
+        print("bus: %s" % comms.bus_stats())
+        print("watchdog: %s\n" % dog.stats)
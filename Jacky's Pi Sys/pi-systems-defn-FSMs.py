@@ -8,15 +8,34 @@
 # iii. LightFSM
 # _________________________________________________________________________
 
-from statemachine import StateMachine, State
+from contextlib import ExitStack
+import importlib
 import time
+telemetry = importlib.import_module('pi-systems_telemetry-log')
+fsm_engine = importlib.import_module('pi-systems_fsm-engine')
+log = importlib.import_module('pi-systems_log')
+StateMachine, State = fsm_engine.StateMachine, fsm_engine.State
 
 ON = 1
 OFF = 0
 
 
-# i. Create a pressure FSM that controls TargetState and Priority of
+# Batch the LED writes made inside the with block, so each GPIO port the
+# LEDs live on gets one masked write instead of one write per LED.
+# LEDs without a port (not owned by an InterfaceSubsystem) write directly.
+def leds_batch(leds):
+    stack = ExitStack()
+    ports = {id(port): port
+             for port in (getattr(led, 'port', None) for led in leds)
+             if port is not None}
+    for port in ports.values():
+        stack.enter_context(port.batch())
+    return stack
+
+
+# i. Create a pressure FSM that controls the desired state and Priority of
 #    the Pressure subsystem
+@telemetry.trace_transitions
 class PressureFSM(StateMachine):
     #   State Definitions
     idle = State("idle", initial=True)
@@ -41,149 +60,152 @@ class PressureFSM(StateMachine):
     detected_emerg_1 = pressurize.to(Emergency)
     detected_emerg_2 = depressurize.to(Emergency)
     detected_emerg_3 = idle.to(Emergency)
+    detected_emerg_4 = pause.to(Emergency)
     emerg_unresolved = Emergency.to(Emergency)
 
     # Methods for the states actions
     # executed when the state transition (defined above) is triggered
     def on_keep_idling(self, airlock_press_ss):
         self.airlock_press_ss = airlock_press_ss
-        self.airlock_press_ss.TargetState = 'Idle'
-        #self.airlock_press_ss.request_new_state(3)          # UNCOMMENT FOR VALVES TO WORK
         self.airlock_press_ss.priority = 'low'
+        self.airlock_press_ss.desired_state = 'Idle'
 
     def on_pause_press(self, airlock_press_ss, leds):
         self.airlock_press_ss = airlock_press_ss
-        self.airlock_press_ss.TargetState = 'close'
-        #self.airlock_press_ss.request_new_state(0)         # UNCOMMENT FOR VALVES TO WORK
         self.airlock_press_ss.priority = 'low'
+        self.airlock_press_ss.desired_state = 'close'
         self.leds = leds
         self.leds[6].write(ON)
 
     def on_pause_depress(self, airlock_press_ss, leds):
         self.airlock_press_ss = airlock_press_ss
-        self.airlock_press_ss.TargetState = 'close'
-        #self.airlock_press_ss.request_new_state(0)         # UNCOMMENT FOR VALVES TO WORK
         self.airlock_press_ss.priority = 'low'
+        self.airlock_press_ss.desired_state = 'close'
         self.leds = leds
         self.leds[6].write(ON)
 
     def on_resume_press(self, airlock_press_ss, leds):
         self.airlock_press_ss = airlock_press_ss
-        self.airlock_press_ss.TargetState = 'Pressurize'
-        #self.airlock_press_ss.request_new_state(1)         # UNCOMMENT FOR VALVES TO WORK
         self.airlock_press_ss.priority = 'low'
+        self.airlock_press_ss.desired_state = 'Pressurize'
         self.leds = leds
         self.leds[6].write(OFF)
 
     def on_resume_depress(self, airlock_press_ss, leds):
         self.airlock_press_ss = airlock_press_ss
-        self.airlock_press_ss.TargetState = 'Depressurize'
-        #self.airlock_press_ss.request_new_state(2)         # UNCOMMENT FOR VALVES TO WORK
         self.airlock_press_ss.priority = 'low'
+        self.airlock_press_ss.desired_state = 'Depressurize'
         self.leds = leds
         self.leds[6].write(OFF)
 
     def on_keep_pausing(self, airlock_press_ss):
         self.airlock_press_ss = airlock_press_ss
-        self.airlock_press_ss.TargetState = 'close'
-        #self.airlock_press_ss.request_new_state(0)         # UNCOMMENT FOR VALVES TO WORK
         self.airlock_press_ss.priority = 'low'
+        self.airlock_press_ss.desired_state = 'close'
 
     def on_start_pressurize(self, airlock_press_ss, leds):
         self.airlock_press_ss = airlock_press_ss
-        self.airlock_press_ss.TargetState = 'Pressurize'
-        #self.airlock_press_ss.request_new_state(1)         # UNCOMMENT FOR VALVES TO WORK
         self.airlock_press_ss.priority = 'low'
+        self.airlock_press_ss.desired_state = 'Pressurize'
         self.leds = leds
-        self.leds[0].write(OFF)  # All LEDs off except In_progress LED
-        self.leds[1].write(ON)
-        self.leds[2].write(OFF)
+        with leds_batch(leds):
+            self.leds[0].write(OFF)  # All LEDs off except In_progress LED
+            self.leds[1].write(ON)
+            self.leds[2].write(OFF)
 
     def on_keep_pressurize(self, airlock_press_ss, leds):
         self.airlock_press_ss = airlock_press_ss
-        self.airlock_press_ss.TargetState = 'Pressurize'
         self.airlock_press_ss.priority = 'low'
+        self.airlock_press_ss.desired_state = 'Pressurize'
         self.leds = leds
-        self.leds[0].write(OFF)  # All LEDs off except In_progress LED
-        self.leds[1].write(ON)
-        self.leds[2].write(OFF)
-        self.leds[6].write(OFF)  # hold LED off when we keep depressurizing
+        with leds_batch(leds):
+            self.leds[0].write(OFF)  # All LEDs off except In_progress LED
+            self.leds[1].write(ON)
+            self.leds[2].write(OFF)
+            self.leds[6].write(OFF)  # hold LED off when we keep depressurizing
 
     def on_done_pressurize(self, airlock_press_ss, leds):
         self.airlock_press_ss = airlock_press_ss
-        self.airlock_press_ss.TargetState = 'Idle'
-        #self.airlock_press_ss.request_new_state(3)         # UNCOMMENT FOR VALVES TO WORK
         self.airlock_press_ss.priority = 'low'
+        self.airlock_press_ss.desired_state = 'Idle'
         self.leds = leds
-        self.leds[0].write(ON)  # All LEDs off except Pressurized LED
-        self.leds[1].write(OFF)
-        self.leds[2].write(OFF)
+        with leds_batch(leds):
+            self.leds[0].write(ON)  # All LEDs off except Pressurized LED
+            self.leds[1].write(OFF)
+            self.leds[2].write(OFF)
 
     def on_start_depressurize(self, airlock_press_ss, leds):
         self.airlock_press_ss = airlock_press_ss
-        self.airlock_press_ss.TargetState = "Depressurize"
-        #self.airlock_press_ss.request_new_state(2)         # UNCOMMENT FOR VALVES TO WORK
         self.airlock_press_ss.priority = 'low'
+        self.airlock_press_ss.desired_state = "Depressurize"
         self.leds = leds
-        self.leds[0].write(OFF)  # All LEDs off except In_progress LED
-        self.leds[1].write(ON)
-        self.leds[2].write(OFF)
+        with leds_batch(leds):
+            self.leds[0].write(OFF)  # All LEDs off except In_progress LED
+            self.leds[1].write(ON)
+            self.leds[2].write(OFF)
 
     def on_keep_depressurize(self, airlock_press_ss, leds):
         self.airlock_press_ss = airlock_press_ss
-        self.airlock_press_ss.TargetState = 'Depressurize'
         self.airlock_press_ss.priority = 'low'
+        self.airlock_press_ss.desired_state = 'Depressurize'
         self.leds = leds
-        self.leds[0].write(OFF)  # All LEDs off except In_progress LED
-        self.leds[1].write(ON)
-        self.leds[2].write(OFF)
-        self.leds[6].write(OFF)  # hold off when we keep depressurizing
+        with leds_batch(leds):
+            self.leds[0].write(OFF)  # All LEDs off except In_progress LED
+            self.leds[1].write(ON)
+            self.leds[2].write(OFF)
+            self.leds[6].write(OFF)  # hold off when we keep depressurizing
 
     def on_done_depressurize(self, airlock_press_ss, leds):
         self.airlock_press_ss = airlock_press_ss
-        self.airlock_press_ss.TargetState = "Idle"
-        #self.airlock_press_ss.request_new_state(3)         # UNCOMMENT FOR VALVES TO WORK
         self.airlock_press_ss.priority = 'low'
+        self.airlock_press_ss.desired_state = "Idle"
         self.leds = leds
-        self.leds[0].write(OFF)  # All LEDs off except Depressurized LED
-        self.leds[1].write(OFF)
-        self.leds[2].write(ON)
+        with leds_batch(leds):
+            self.leds[0].write(OFF)  # All LEDs off except Depressurized LED
+            self.leds[1].write(OFF)
+            self.leds[2].write(ON)
 
     def on_detected_emerg_1(self, airlock_press_ss, leds):
         self.airlock_press_ss = airlock_press_ss
-        self.airlock_press_ss.TargetState = 'Emergency'
-        #self.airlock_press_ss.request_new_state(0)        # UNCOMMENT FOR VALVES TO WORK
         self.airlock_press_ss.priority = 'high'
+        self.airlock_press_ss.desired_state = 'Emergency'
         self.leds = leds
         self.leds[5].write(ON)  # Turn on emergency LED
 
     def on_detected_emerg_2(self, airlock_press_ss, leds):
         self.airlock_press_ss = airlock_press_ss
-        self.airlock_press_ss.TargetState = 'Emergency'
         self.airlock_press_ss.priority = 'high'
-        #self.airlock_press_ss.request_new_state(0)        # UNCOMMENT FOR VALVES TO WORK
+        self.airlock_press_ss.desired_state = 'Emergency'
         self.leds = leds
         self.leds[5].write(ON)  # Turn on emergency LED
 
     def on_detected_emerg_3(self, airlock_press_ss, leds):
         self.airlock_press_ss = airlock_press_ss
-        self.airlock_press_ss.TargetState = 'Emergency'
         self.airlock_press_ss.priority = 'high'
-        #self.airlock_press_ss.request_new_state(0)        # UNCOMMENT FOR VALVES TO WORK
+        self.airlock_press_ss.desired_state = 'Emergency'
         self.leds = leds
         self.leds[5].write(ON)  # Turn on emergency LED
 
+    def on_detected_emerg_4(self, airlock_press_ss, leds):
+        self.airlock_press_ss = airlock_press_ss
+        self.airlock_press_ss.priority = 'high'
+        self.airlock_press_ss.desired_state = 'Emergency'
+        self.leds = leds
+        with leds_batch(leds):
+            self.leds[5].write(ON)  # Turn on emergency LED
+            self.leds[6].write(OFF)  # No longer on hold
+
     def on_emerg_unresolved(self, airlock_press_ss, leds):
         self.airlock_press_ss = airlock_press_ss
-        self.airlock_press_ss.TargetState = 'Emergency'
         self.airlock_press_ss.priority = 'high'
-        #self.airlock_press_ss.request_new_state(0)        # UNCOMMENT FOR VALVES TO WORK
+        self.airlock_press_ss.desired_state = 'Emergency'
         self.leds = leds
         self.leds[5].write(ON)
 
 
 # ii. Create a Door FSM that controls Procedure and Priority of
 #     the door subsystem
+@telemetry.trace_transitions
 class DoorFSM(StateMachine):
     #   State Definitions
     idle = State("Idle", initial=True)
@@ -210,58 +232,58 @@ class DoorFSM(StateMachine):
     # executed when the state transition (defined above) is triggered
     def on_keep_idling(self, airlock_door_ss):
         self.airlock_door_ss = airlock_door_ss
-        self.airlock_door_ss.Procedure = 'Idle'  # int 0
+        self.airlock_door_ss.desired_state = 'Idle'  # int 0
         self.airlock_door_ss.priority = 'low'  # same int value as pressure FSM
 
     # Note to self: Include the priority later
     def on_start_open(self, airlock_door_ss):
         self.airlock_door_ss = airlock_door_ss
-        self.airlock_door_ss.Procedure = 'OpenDoor'  # int 1
+        self.airlock_door_ss.desired_state = 'OpenDoor'  # int 1
         self.priority = 'low'
 
     def on_start_close(self, airlock_door_ss):
         self.airlock_door_ss = airlock_door_ss
-        self.airlock_door_ss.Procedure = 'CloseDoor'  # int 2
+        self.airlock_door_ss.desired_state = 'CloseDoor'  # int 2
         self.priority = 'low'
 
     def on_done_open(self, airlock_door_ss):
         self.airlock_door_ss = self.airlock_door_ss
-        self.airlock_door_ss.Procedure = 'Idle'  # int 0
+        self.airlock_door_ss.desired_state = 'Idle'  # int 0
         self.priority = 'low'
 
     def on_done_close(self, airlock_door_ss):
         self.airlock_door_ss = self.airlock_door_ss
-        self.airlock_door_ss.Procedure = 'Idle'  # int 0
+        self.airlock_door_ss.desired_state = 'Idle'  # int 0
         self.priority = 'low'
 
     def on_keep_opening(self, airlock_door_ss):
         self.airlock_door_ss = airlock_door_ss
-        self.airlock_door_ss.Procedure = 'OpenDoor'  # int 1
+        self.airlock_door_ss.desired_state = 'OpenDoor'  # int 1
         self.priority = 'low'
 
     def on_keep_closing(self, airlock_door_ss):
         self.airlock_door_ss = airlock_door_ss
-        self.airlock_door_ss.Procedure = "CloseDoor"  # int 2
+        self.airlock_door_ss.desired_state = "CloseDoor"  # int 2
         self.priority = 'low'
 
     def on_detected_emerg_1(self, airlock_door_ss):
         self.airlock_door_ss = airlock_door_ss
-        self.airlock_door_ss.Procedure = 'Emergency'  # int 0
+        self.airlock_door_ss.desired_state = 'Emergency'  # int 0
         self.priority = 'high'
 
     def on_detected_emerg_2(self, airlock_door_ss):
         self.airlock_door_ss = airlock_door_ss
-        self.airlock_door_ss.Procedure = 'Emergency'  # int 0
+        self.airlock_door_ss.desired_state = 'Emergency'  # int 0
         self.priority = 'high'
 
     def on_detected_emerg_3(self, airlock_door_ss):
         self.airlock_door_ss = airlock_door_ss
-        self.airlock_door_ss.Procedure = 'Emergency'  # int 0
+        self.airlock_door_ss.desired_state = 'Emergency'  # int 0
         self.priority = 'high'
 
     def on_emerg_unresolved(self, airlock_door_ss):
         self.airlock_door_ss = airlock_door_ss
-        self.airlock_door_ss.Procedure = 'Emergency'  # int 0
+        self.airlock_door_ss.desired_state = 'Emergency'  # int 0
         self.priority = 'high'
 
 
@@ -279,9 +301,9 @@ class LightFSM(StateMachine):
     def on_turn_off(self, airlock_light_ss):
         self.airlock_light_ss = airlock_light_ss
         self.airlock_light_ss.toggle()  # Debug this part/ ask thomas about lights-manager code
-        print("Turn the lights off")
+        log.i("LightFSM", "Turn the lights off")
 
     def on_turn_on(self, airlock_light_ss):
         self.airlock_light_ss = airlock_light_ss
         self.airlock_light_ss.toggle()
-        print("Turn the lights on")
+        log.i("LightFSM", "Turn the lights on")
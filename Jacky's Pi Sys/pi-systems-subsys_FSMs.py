@@ -28,6 +28,10 @@ comms = importlib.import_module('pi-systems_communications')
 subsys_base = importlib.import_module('pi-systems_subsystem-base')
 sensor_ss = importlib.import_module('pi-systems_sensor-reader')
 FSM = importlib.import_module('pi-systems-defn-FSMs')
+log = importlib.import_module('pi-systems_log')
+
+# Tag of the log records of the FSM loop.
+TAG = "loop_FSMs"
 
 inputs = []
 
@@ -208,7 +212,7 @@ def loop_FSMs(subsystems,
                     time.sleep(0.001)           # Take this out when sensors implemented
                     pressure = pressure + 1  # Take this out when sensors implemented
                     #sensor_ss.__update_sensor_data()  # Not sure if the sensors are read continuously but update the sensor value
-                    print("PRESSURIZING...")
+                    log.v(TAG, "PRESSURIZING...", pressure=pressure)
                 else:
                     if(fsm_pressure.current_state == fsm_pressure.Emergency):
                         fsm_pressure.emerg_unresolved(airlock_press_ss)
@@ -233,7 +237,7 @@ def loop_FSMs(subsystems,
                     fsm_pressure.keep_depressurize(airlock_press_ss)
                     time.sleep(0.001)            # Take this out when sensors implemented
                     pressure = pressure - 1  # Take this out when sensors implemented
-                    print("DEPRESSURIZING")
+                    log.v(TAG, "DEPRESSURIZING", pressure=pressure)
                 else:
                     if(fsm_pressure.current_state == fsm_pressure.Emergency):
                         fsm_pressure.emerg_unresolved(airlock_press_ss)
@@ -247,7 +251,7 @@ def loop_FSMs(subsystems,
             else:
                 fsm_pressure.keep_idling(airlock_press_ss)
 
-        print("I am in idle again? ",
+        log.v(TAG, "I am in idle again? %s",
               fsm_pressure.current_state == fsm_pressure.idle)
 
         # Check if user pressed L
@@ -257,19 +261,19 @@ def loop_FSMs(subsystems,
                 try:
                     fsm_lights.turn_off(airlock_light_ss)
                 except NameError:
-                    print("Subsys doesnt exist")
+                    log.e(TAG, "Subsys doesnt exist")
             # else the light switch is ON
             else:
-                print("Lights already off")
+                log.v(TAG, "Lights already off")
         else:
             if(fsm_lights.current_state.name == "OFF"):
                 try:
                     fsm_lights.turn_on(airlock_light_ss)
                 except NameError:
-                    print("Subsys doesnt exist")
+                    log.e(TAG, "Subsys doesnt exist")
             else:
-                print("Lights already on")
-        print("we idling? ", fsm_door.current_state == fsm_door.idle)
+                log.v(TAG, "Lights already on")
+        log.v(TAG, "we idling? %s", fsm_door.current_state == fsm_door.idle)
 
         #Check if user pressed O button
         # CHANGE THIS TO READ SENSOR DATA NOT MOCK DATA
@@ -320,9 +324,9 @@ def loop_FSMs(subsystems,
                 fsm_door.emerg_unresolved(airlock_door_ss)
             else:
                 fsm_door.keep_idling(airlock_door_ss)
-        print("Current Pressure State: ", fsm_pressure.current_state.name)
-        print("Current Door State: ", fsm_door.current_state.name)
-        print("Current Light State: ", fsm_lights.current_state.name, "\n")
+        log.d(TAG, "Current states", pressure=fsm_pressure.current_state.name,
+              door=fsm_door.current_state.name,
+              lights=fsm_lights.current_state.name)
 
 loop_FSMs(subsystems,
           inputs)
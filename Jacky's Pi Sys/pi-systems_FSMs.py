@@ -33,6 +33,8 @@ comms = importlib.import_module('pi-systems_communications')
 subsys_base = importlib.import_module('pi-systems_subsystem-base')
 sensor_ss = importlib.import_module('pi-systems_sensor-reader')
 FSM = importlib.import_module('pi-systems-defn-FSMs')
+fsm_supervisor = importlib.import_module('pi-systems_fsm-supervisor')
+watchdog = importlib.import_module('pi-systems_watchdog')
 
 inputs = []
 
@@ -188,213 +190,63 @@ outputs = [led1, led2, led3, led4, led5, led6, led7]
 
 # ________________END OF SECTION 2_____________________________________________
 
-#  Create an instance of the FSMs
-fsm_pressure = FSM.PressureFSM()
-fsm_lights = FSM.LightFSM()
-fsm_door = FSM.DoorFSM()
-
 # Integer Target pressures for pressurizing and depressurizing
-target_p = 1013  # Earth atmosphere roughly 101.3kPa
-target_d = 6     # Martian Atmosphere 600 Pascals
+target_p = fsm_supervisor.TARGET_PRESSURE  # Earth atmosphere roughly 101.3kPa
+target_d = fsm_supervisor.TARGET_DEPRESSURE  # Martian Atmosphere 600 Pascals
 
 # ________________________SECTION 3_______________________________________
-# loop that checks the inputs and takes the appropriate actions.
-# IMPORTANT NOTE: Replace "inputs[0].state", etc., etc.
-#  with "emergency_butt", etc. etc. for more readable code.
+# Supervisor that checks the inputs and takes the appropriate actions.
+# The FSMs live in the supervisor (supervisor.fsm_pressure, ...) and are
+# stepped on its own thread whenever an input or the sensors change, so
+# this loop only reports what they are doing.
 
 
 def loop_FSMs(subsystems,
               inputs,
-              outputs):
-    #pressure = sensor_ss.sensor_data[3]  # Replace the line below once sensors
-    pressure = 0
-
-    while(True):
-        # i and j are used for very general mock door state ...
-        # i = 0 represents door not in desired state
-        # i = 1 represents door in desired state
-        i = 0   # door_state, door_angle = door_ss.get_current_door_state(airlock_door_ss)  #  Might give Attribute Error?
-        j = 0   # Represents same thing as i but for closing door so just delete when sensors implemented
-
-        # Comment this out for now bc interface inputs cannot be used
-        '''
-        print("E button: ", inputs[0].state)
-        print("P button: ", inputs[1].state)
-        print("D button: ", inputs[2].state)
-        print("L switch: ", inputs[3].state)
-        print("O button: ", inputs[4].state)
-        print("Cl button: ", inputs[5].state)
-        print("SPST Enable", inputs[6].state)
-        '''
-
-        # Check if user pressed Emergency button
-        # NOTE EMERG LOGIC IS ACTIVE LOW
-        if inputs[0].state == 0:
-            emergency = True  # theres really no point in this besides an easier way to display Emergencies to user
-            if(fsm_pressure.current_state.name == 'idle'):
-                fsm_pressure.detected_emerg_3(airlock_press_ss, outputs)
-            elif(fsm_pressure.current_state.name == 'Emergency'):
-                fsm_pressure.emerg_unresolved(airlock_press_ss, outputs)
-            if(fsm_door.current_state.name == 'Idle'):
-                fsm_door.detected_emerg_3(airlock_door_ss)
-            elif(fsm_door.current_state.name == 'Emergency'):
-                fsm_door.emerg_unresolved(airlock_door_ss)
-
-        # Check if the STSD switch enables the P/D/H buttons
-        if inputs[6].state == 1:
-            led4.write(ON)
-
-            # Check if user pressed P
-            # CHANGE THIS TO READ SENSOR DATA NOT MOCK DATA: pressure
-            if (inputs[1].state == 1 and inputs[0].state == 1):
-                fsm_pressure.start_pressurize(airlock_press_ss, outputs)
-
-                # While not done pressurizing to targer...
-                #while (sensor_ss.sensor_data[3] < target_p):  # REPLACE LINE BELOW WITH THIS FOR SENSORS
-                while (pressure < target_p):
-                    if inputs[0].state is 1:  # check for emerg. while pressurizing
-                        if inputs[7].state == 1:  # check if user wants to pause
-                            if fsm_pressure.current_state.name == "pressurize":
-                                fsm_pressure.pause_press(airlock_press_ss, outputs)
-                                while inputs[7].state is 1:
-                                    fsm_pressure.keep_pausing(airlock_press_ss)
-                                fsm_pressure.resume_press(airlock_press_ss, outputs)
-                        else:
-                            # This is for no pausing & no emergencies.
-                            fsm_pressure.keep_pressurize(airlock_press_ss, outputs)
-                            time.sleep(0.001)           # Take this out when sensors implemented
-                            pressure = pressure + 1     # Take this out when sensors implemented
-                            #sensor_ss.__update_sensor_data()  # Not sure if the sensors are read continuously but update the sensor value
-                            print("PRESSURIZING...")
-                    else:
-                        if(fsm_pressure.current_state == fsm_pressure.Emergency):
-                            fsm_pressure.emerg_unresolved(airlock_press_ss, outputs) # Emerg to Emerg
-                        else:
-                            fsm_pressure.detected_emerg_1(airlock_press_ss, outputs) # Press to Emerg
-                fsm_pressure.done_pressurize(airlock_press_ss, outputs)
-            else:
-                if(fsm_pressure.current_state == fsm_pressure.Emergency):
-                    fsm_pressure.emerg_unresolved(airlock_press_ss, outputs)
-                else:
-                    fsm_pressure.keep_idling(airlock_press_ss)
-
-            # Check if user pressed D
-            # CHANGE THIS TO READ SENSOR DATA NOT MOCK DATA
-            if inputs[2].state == 1 and inputs[0].state == 1:
-                pressure = 1013  # For debugging. Delete when sensors implemented
-                fsm_pressure.start_depressurize(airlock_press_ss, outputs)
-                #while (sensor_ss.sensor_data[3] < target_d):  # REPLACE LINE BELOW WITH THIS FOR SENSORS
-                while(pressure > target_d):
-                    if inputs[0].state == 1:
-                        if inputs[7].state == 1:
-                            if fsm_pressure.current_state.name == 'depressurize':
-                                fsm_pressure.pause_depress(airlock_press_ss, outputs)
-                                while inputs[7].state is 1:
-                                    fsm_pressure.keep_pause(airlock_press_ss)
-                                fsm_pressure.resume_depress(airlock_press_ss, outputs)
-                        else:
-                            fsm_pressure.keep_depressurize(airlock_press_ss, outputs)
-                            time.sleep(0.001)            # Take this out when sensors implemented
-                            pressure = pressure - 1  # Take this out when sensors implemented
-                            print("DEPRESSURIZING")
-                    else:
-                        if(fsm_pressure.current_state == fsm_pressure.Emergency):
-                            fsm_pressure.emerg_unresolved(airlock_press_ss, outputs)
-                        else:
-                            fsm_pressure.detected_emerg_2(airlock_press_ss, outputs)    
-                    # sensor_ss.__update_sensor_data()  # Might need to manually update. check how sensors are read
-                fsm_pressure.done_depressurize(airlock_press_ss, outputs)
-            else:
-                if(fsm_pressure.current_state == fsm_pressure.Emergency):
-                    fsm_pressure.emerg_unresolved(airlock_press_ss, outputs)
-                else:
-                    fsm_pressure.keep_idling(airlock_press_ss)
-
-            print("I am in idle again? ",
-                  fsm_pressure.current_state == fsm_pressure.idle)
-        else:
-            led4.write(OFF)
-
-        # Check if user pressed L
-        if inputs[3].state == 0:
-            # we want the lights off and theyre on
-            if(fsm_lights.current_state.name == "ON"):
-                try:
-                    fsm_lights.turn_off(airlock_light_ss)
-                except NameError:
-                    print("Subsys doesnt exist")
-            # else the light switch is ON
-            else:
-                print("Lights already off")
-        else:
-            if(fsm_lights.current_state.name == "OFF"):
-                try:
-                    fsm_lights.turn_on(airlock_light_ss)
-                except NameError:
-                    print("Subsys doesnt exist")
-            else:
-                print("Lights already on")
-        print("we idling? ", fsm_door.current_state == fsm_door.idle)
-
-        #Check if user pressed O button
-        # CHANGE THIS TO READ SENSOR DATA NOT MOCK DATA
-        if inputs[4].state == 1 and inputs[0].state == 1:
-            fsm_door.start_open(airlock_door_ss)
-            #door_state, door_angle = door_ss.get_current_door_state()
-
-            # While the door is not open
-            #while door_state is not 111:  # replace the line below when sensors implemeneted
-            while i is not 1:
-                if inputs[0].state == 1:
-                    fsm_door.keep_opening(airlock_door_ss)
-                    #inputs = [0, 0, 0, 0, 1, 0, 1]
-                    i = 1  # Delete once sensor data is implemented & replace with line below to get updated door_state every loop
-                    #door_state, door_angle = door_ss.get_current_door_state(airlock_door_ss)
-                else:
-                    if fsm_door.current_state.name == "Open":
-                        fsm_door.detected_emerg_1(airlock_door_ss)
-                    elif fsm_door.current_state.name == "Emergency":
-                        fsm_door.emerg_unresolved(airlock_door_ss)
-            fsm_door.done_open(airlock_door_ss)
-        else:
-            if(fsm_door.current_state == fsm_door.Emergency):
-                fsm_door.emerg_unresolved(airlock_door_ss)
-            else:
-                # no code red so keep idling
-                fsm_door.keep_idling(airlock_door_ss)
-
-        # Check if user pressed Cl for close door
-        if inputs[5].state == 1 and inputs[0].state == 1:  # change to interface logic
-            fsm_door.start_close(airlock_door_ss)
-
-            while(j is 0):
-                if inputs[0].state == 1:
-                    fsm_door.keep_closing(airlock_door_ss)
-                    # j var represents when the door is in the processs of closing
-                    j = 1
-                else:
-                    if(fsm_door.current_state == fsm_door.Emergency):
-                        fsm_door.emerg_unresolved(airlock_door_ss)
-                    else:
-                        fsm_door.detected_emerg_2(airlock_door_ss)
-            fsm_door.done_close(airlock_door_ss)
-        else:
-            if(fsm_door.current_state == fsm_door.Emergency):
-                fsm_door.emerg_unresolved(airlock_door_ss)
-            else:
-                fsm_door.keep_idling(airlock_door_ss)
-
-        # Check if the user has confirmed the Door Action
-        # This should be moved up into the inputs[4] and inputs[5] loops.
-        # CHANGE LATER ^^^ for now it just turns on/off LED
-        if inputs[8].state == 1:
-            led5.write(ON)
-        else:
-            led5.write(OFF)
-
-        print("Current Pressure State: ", fsm_pressure.current_state.name)
-        print("Current Door State: ", fsm_door.current_state.name)
-        print("Current Light State: ", fsm_lights.current_state.name, "\n")
+              outputs,
+              report_delay=1.0):
+    # The lights and sensors are skipped above when they fail to start.
+    sensors = globals().get('airlock_sensor_ss')
+    supervisor = fsm_supervisor.FSMSupervisor(
+        airlock_press_ss,
+        airlock_door_ss,
+        globals().get('airlock_light_ss'),
+        outputs,
+        read_pressure=lambda:
+            sensors.sensor_data['pressure'] if sensors else None)
+    supervisor.attach_inputs(inputs)
+    # The door position is the one last read by the door loop
+    # (airlock_door_ss.in_position); re-check it whenever that changes.
+    airlock_door_ss.on_loop = supervisor.wake
+    if sensors:
+        # Close the valves on the pressure history rather than on the FSM's
+        # target check (see PressureController), and re-check the targets
+        # as soon as new readings arrive.
+        airlock_press_ss.controller.history = sensors.history
+        sensors.on_loop = supervisor.wake
+    supervisor.start()
+
+    # Restart hung or failing subsystems, and treat one that keeps failing
+    # (e.g. a pressure reading that stopped updating) as an emergency.
+    dog = watchdog.Watchdog(
+        subsystems,
+        on_escalate=lambda name, reason: supervisor.set_input('E', 0))
+    dog.start()
+
+    try:
+        while(True):
+            time.sleep(report_delay)
+            print("Current Pressure State: ",
+                  supervisor.fsm_pressure.current_state.name)
+            print("Current Door State: ",
+                  supervisor.fsm_door.current_state.name)
+            print("Current Light State: ",
+                  supervisor.fsm_lights.current_state.name)
+            print("Supervisor: ", supervisor.stats)
+            print("Watchdog: ", dog.stats, "\n")
+    finally:
+        dog.stop()
+        supervisor.stop()
 
 loop_FSMs(subsystems,
           inputs,
@@ -0,0 +1,246 @@
+import asyncio
+import functools
+import importlib
+from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+subsys = importlib.import_module('pi-systems_subsystem-base')
+subsys_pool = importlib.import_module('pi-systems_subsystem-pool')
+log = importlib.import_module('pi-systems_log')
+
+"""
+Purpose: Run subsystems as coroutines on a single asyncio event loop
+    instead of one thread each. Blocking calls (I2C reads and writes)
+    are offloaded to a small executor so they do not stall the loop.
+    Subsystems can also await each other's state without polling,
+    e.g. "wait until the door reports open".
+"""
+
+
+class AsyncSubsystem(subsys.Subsystem):
+    """
+    Purpose: Subsystem variant whose loop is a coroutine. It is driven by
+        the AsyncRunner rather than by its own thread. Takes the same
+        arguments as Subsystem.
+
+    Example:
+        class DoorWatcher(AsyncSubsystem):
+            async def loop(self):
+                raw = await self.offload(comms.intra_read, 0x0B, 4)
+                ...
+
+        await door.wait_until(lambda d: d.door_state == d.DoorState.open)
+    """
+    def __init__(self, name, *, thread_id, **kwargs):
+        super().__init__(name=name, thread_id=thread_id, **kwargs)
+        self.runner = None
+        self._changed = None
+
+    def start(self):
+        if self.thread.running:
+            return
+
+        self.thread.running = True
+        if self.runner is not None:
+            self.runner.attach(self)
+
+        if (self.on_start):  # Run callback method if it exists
+            self.on_start()
+
+    def stop(self):
+        self.thread.running = False
+        if self.runner is not None:
+            self.runner.wake(self)
+
+        if (self.on_stop):  # Run callback method if it exists
+            self.on_stop()
+
+    """
+    Definition contains the coroutine which will be awaited
+    during the subsystem's active life.
+    """
+    @abstractmethod
+    async def loop(self):
+        pass
+
+    async def _loop(self):
+        await self.loop()
+        if self.on_loop:
+            self.on_loop()
+
+    """
+    Run a blocking function on the runner's executor and await its result.
+    """
+    async def offload(self, fn, *args, **kwargs):
+        return await self.runner.offload(fn, *args, **kwargs)
+
+    """
+    Wait, without polling, until predicate(self) is true. The predicate is
+    re-evaluated every time this subsystem completes a loop or calls
+    notify_changed(). Only once an AsyncRunner is running the subsystem.
+    """
+    async def wait_until(self, predicate, timeout=None):
+        if self._changed is None:
+            raise RuntimeError("%s is not run by an AsyncRunner yet!"
+                               % self.name)
+        async with self._changed:
+            await asyncio.wait_for(
+                self._changed.wait_for(lambda: predicate(self)),
+                timeout)
+
+    async def notify_changed(self):
+        if self._changed is None:
+            return  # No runner yet, so nothing can be waiting.
+        async with self._changed:
+            self._changed.notify_all()
+
+
+class AsyncRunner:
+    """
+    Purpose: Drive every subsystem in the subsystem pool on one asyncio
+        event loop. AsyncSubsystems are awaited directly. Plain Subsystems
+        that have not already been started on their own thread are adopted
+        and their loop is run on the executor, so everything shares one
+        event loop thread plus the executor workers. An adopted loop still
+        leaves its heartbeat for the Watchdog, and its notify() and
+        restart() wake or replace the loop's driver here.
+    subsystems: The subsystems to drive. Defaults to the subsystem pool.
+    executor_workers: Number of threads used for blocking calls.
+    """
+    def __init__(self, subsystems=None, executor_workers=1):
+        self.subsystems = subsystems
+        self.executor_workers = executor_workers
+        self.event_loop = None
+        self.executor = None
+        self._drivers = {}
+        self._wake_events = {}
+        self._stopped = None
+        # Subsystems this runner drives, and so stops when it ends.
+        # Threaded subsystems started on their own are left running.
+        self._adopted = []
+
+    """
+    Run the event loop until stop() is called. Blocks the calling thread.
+    """
+    def run(self):
+        asyncio.run(self._main())
+
+    def stop(self):
+        if self.event_loop is not None:
+            self.event_loop.call_soon_threadsafe(self._stopped.set)
+
+    """
+    Start driving a subsystem. Safe to call from any thread.
+    """
+    def attach(self, subsystem):
+        if self.event_loop is None:
+            return
+        self.event_loop.call_soon_threadsafe(self._attach, subsystem)
+
+    """
+    Interrupt a subsystem's wait so it re-checks its running state.
+    """
+    def wake(self, subsystem):
+        event = self._wake_events.get(subsystem.name)
+        if event is not None and self.event_loop is not None:
+            self.event_loop.call_soon_threadsafe(event.set)
+
+    async def offload(self, fn, *args, **kwargs):
+        return await self.event_loop.run_in_executor(
+            self.executor,
+            functools.partial(fn, *args, **kwargs))
+
+    async def _main(self):
+        self.event_loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.executor_workers,
+            thread_name_prefix="async-runner")
+        self._stopped = asyncio.Event()
+
+        subsystems = self.subsystems \
+            if self.subsystems is not None \
+            else list(subsys_pool.get_all().values())
+
+        for subsystem in subsystems:
+            if isinstance(subsystem, AsyncSubsystem):
+                subsystem.runner = self
+                subsystem._changed = asyncio.Condition()
+                self._adopted.append(subsystem)
+                if subsystem.thread.running:
+                    self._attach(subsystem)
+            elif not subsystem.thread.running:
+                # Adopt a threaded subsystem that was never started.
+                subsystem.thread.running = True
+                self._adopted.append(subsystem)
+                self._attach(subsystem)
+
+        try:
+            await self._stopped.wait()
+        finally:
+            adopted, self._adopted = self._adopted, []
+            for subsystem in adopted:
+                if subsystem.thread.running:
+                    subsystem.stop()
+                subsystem.thread.on_notify = None
+                subsystem.thread.on_restart = None
+            for driver in list(self._drivers.values()):
+                driver.cancel()
+            self.executor.shutdown(wait=False)
+            self.event_loop = None
+
+    def _attach(self, subsystem):
+        driver = self._drivers.get(subsystem.name)
+        if driver is not None and not driver.done():
+            return
+        self._wake_events[subsystem.name] = asyncio.Event()
+        self._drivers[subsystem.name] = \
+            self.event_loop.create_task(self._drive(subsystem))
+        subsystem.thread.on_notify = lambda: self.wake(subsystem)
+        subsystem.thread.on_restart = lambda: self.event_loop \
+            .call_soon_threadsafe(self._restart, subsystem)
+
+    """
+    Abandon a subsystem's driver, which may be stuck on a hung loop, and
+    run the loop again now on a new one (see SubsystemThread.restart).
+    """
+    def _restart(self, subsystem):
+        driver = self._drivers.pop(subsystem.name, None)
+        if driver is not None:
+            driver.cancel()
+        if subsystem.thread.running:
+            self._attach(subsystem)
+            self._wake_events[subsystem.name].set()
+
+    async def _drive(self, subsystem):
+        period = subsystem.thread.loop_delay_ms / 1000
+        wake_event = self._wake_events[subsystem.name]
+        next_run = self.event_loop.time() + period
+
+        while subsystem.thread.running:
+            try:
+                await asyncio.wait_for(
+                    wake_event.wait(),
+                    max(0, next_run - self.event_loop.time()))
+                wake_event.clear()
+            except asyncio.TimeoutError:
+                pass
+
+            if not subsystem.thread.running:
+                break
+
+            try:
+                if isinstance(subsystem, AsyncSubsystem):
+                    await subsystem._loop()
+                    await subsystem.notify_changed()
+                else:
+                    # As on its own thread: heartbeat, error counts and
+                    # loop metrics, with any exception logged there.
+                    thread = subsystem.thread
+                    await self.offload(thread._run_once, thread._generation)
+            except Exception as e:
+                log.e(subsystem.name, "Subsystem exception: %s", e)
+
+            # Fixed rate, skipping any periods missed by a slow loop.
+            now = self.event_loop.time()
+            next_run += period
+            if next_run <= now:
+                next_run += ((now - next_run) // period + 1) * period
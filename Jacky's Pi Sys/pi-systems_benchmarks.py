@@ -0,0 +1,1129 @@
+import argparse
+import contextlib
+import heapq
+import importlib
+import itertools
+import json
+import random
+import resource
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+"""
+Purpose: Benchmarks for the pi systems. Each benchmark prints its results
+    as JSON lines so they can be collected and compared between runs.
+Usage: python pi-systems_benchmarks.py <benchmark> [options]
+    Run with --help for the list of benchmarks.
+"""
+
+
+def _rss_kb():
+    # Current resident set size. Falls back to the peak RSS where
+    # /proc is unavailable.
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _context_switches():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_nvcsw + usage.ru_nivcsw
+
+
+def _emit(result):
+    print(json.dumps(result))
+    sys.stdout.flush()
+
+
+# ---------------------------------------------------------------------------
+# Execution mode: thread-per-subsystem vs. shared worker pool
+# ---------------------------------------------------------------------------
+def _execution_child(args):
+    subsys = importlib.import_module("pi-systems_subsystem-base")
+    subsys_pool = importlib.import_module("pi-systems_subsystem-pool")
+    subsys_pool.set_execution_mode(args.mode, args.workers)
+
+    class IdleSubsystem(subsys.Subsystem):
+        def loop(self):
+            with self:
+                pass
+
+    # Mirror the loop delays of the airlock subsystems.
+    delays = [100, 100, 750, 750, 2000, 5000]
+    subsystems = [
+        IdleSubsystem(
+            "bench_%i" % i,
+            thread_id="bench_%i" % i,
+            loop_delay_ms=delays[i % len(delays)])
+        for i in range(args.subsystems)
+    ]
+
+    rss_before = _rss_kb()
+    switches_before = _context_switches()
+    cpu_before = time.process_time()
+
+    for s in subsystems:
+        s.start()
+    time.sleep(args.duration)
+
+    switches = _context_switches() - switches_before
+    cpu = time.process_time() - cpu_before
+    threads = threading.active_count()
+    rss = _rss_kb()
+    loops = sum(s.thread.stats.get("runs", 0) for s in subsystems)
+    subsys_pool.stop_all()
+
+    _emit({
+        "benchmark": "execution",
+        "mode": args.mode,
+        "workers": args.workers,
+        "subsystems": args.subsystems,
+        "duration_s": args.duration,
+        "loops": loops,
+        "threads": threads,
+        "wakeups_per_s": switches / args.duration,
+        "cpu_s": cpu,
+        "rss_kb": rss,
+        "rss_delta_kb": rss - rss_before
+    })
+
+
+def bench_execution(args):
+    if args.mode:
+        return _execution_child(args)
+
+    # Each mode runs in its own interpreter so the pool and RSS
+    # measurements do not leak into each other.
+    for mode in ("thread", "pool"):
+        subprocess.run([
+            sys.executable, __file__, "execution",
+            "--mode", mode,
+            "--workers", str(args.workers),
+            "--subsystems", str(args.subsystems),
+            "--duration", str(args.duration)
+        ], check=True)
+
+
+# ---------------------------------------------------------------------------
+# IntraModCommMessage encode/decode throughput
+# ---------------------------------------------------------------------------
+class _LegacyMessage:
+    # The list-backed message as it was before it moved to a byte buffer,
+    # kept here as the "before" side of the comparison.
+    def __init__(self, raw_array):
+        self.raw_array = raw_array
+
+    @property
+    def action(self):
+        return self.raw_array[0] & ~(1 << 7)
+
+    @property
+    def procedure(self):
+        return self.raw_array[1] & ~(1 << 7)
+
+    def validate(self, actions):
+        return self.action in set(a.value for a in actions)
+
+    @staticmethod
+    def generate(actions, *, action, procedure, priority=0, data=None):
+        if action not in set(a.value for a in actions):
+            raise ValueError("specified action %i is not defined!" % action)
+        if data is not None:
+            procedure += 1 << 7
+        message = [action, procedure, priority]
+        if data is not None:
+            message.extend(data)
+        return _LegacyMessage(message)
+
+
+def bench_messages(args):
+    comms = importlib.import_module("pi-systems_communications")
+    actions = comms.IntraModCommAction
+    fmt = 'cccBBBhHH'
+    codec = comms.IntraModCommMessage.codec(fmt)
+    frame = [1, 129, 0, 0b11111000, 21, 40, 22, 0, 0xF5, 0x03, 0xC2, 0x01]
+
+    def legacy():
+        msg = _LegacyMessage.generate(
+            actions, action=1, procedure=3, data=[0, 1])
+        msg.validate(actions)
+        msg.action, msg.procedure
+        received = _LegacyMessage(list(frame))
+        struct.unpack(fmt, bytes(received.raw_array[0:struct.calcsize(fmt)]))
+
+    def current():
+        msg = comms.IntraModCommMessage.generate(
+            action=1, procedure=3, data=[0, 1])
+        msg.validate()
+        msg.action, msg.procedure
+        received = comms.IntraModCommMessage(frame)
+        received.unpack(codec)
+
+    for name, fn in (("legacy", legacy), ("current", current)):
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            fn()
+        elapsed = time.perf_counter() - started
+        _emit({
+            "benchmark": "messages",
+            "implementation": name,
+            "iterations": args.iterations,
+            "messages_per_s": args.iterations / elapsed
+        })
+
+
+# ---------------------------------------------------------------------------
+# Simulated pressurization cycle
+# ---------------------------------------------------------------------------
+def bench_pressurization(args):
+    clocks = importlib.import_module("pi-systems_clock")
+    simulator = importlib.import_module("pi-systems_simulator")
+    comms = importlib.import_module("pi-systems_communications")
+    schemas = importlib.import_module("pi-systems_payload-schemas")
+    controller = simulator.PressureController
+
+    clock = clocks.VirtualClock()
+    sim = simulator.Simulator(clock=clock, chamber={
+        "volume_m3": args.volume,
+        "pressurizer_conductance": args.conductance,
+        "depressurizer_conductance": args.conductance,
+        "leak_conductance": args.leak,
+        "initial_pa": args.target_d * 100
+    })
+
+    def set_pressure(target):
+        sim.bus.write_i2c_block_data(
+            controller.SLAVE_ADDRESS, 1,
+            [controller.SET_PRESSURE, 0, target])
+
+    def pressure():
+        frame = sim.bus.read_i2c_block_data(sim.sensors.address, 1)
+        return schemas.SENSOR_DATA.decode(
+            comms.IntraModCommMessage(frame)).pressure
+
+    def run(target, done):
+        set_pressure(target)
+        started = clock.now()
+        while not done(pressure()):
+            if clock.now() - started > args.timeout:
+                return None
+            clock.advance(args.sensor_period)
+        set_pressure(controller.CLOSE)
+        return clock.now() - started
+
+    started = time.perf_counter()
+    pressurize = run(controller.PRESSURIZE, lambda p: p >= args.target_p)
+    depressurize = run(controller.DEPRESSURIZE, lambda p: p <= args.target_d)
+    _emit({
+        "benchmark": "pressurization",
+        "volume_m3": args.volume,
+        "conductance": args.conductance,
+        "leak_conductance": args.leak,
+        "sensor_period_s": args.sensor_period,
+        "pressurize_s": pressurize,
+        "depressurize_s": depressurize,
+        "wall_ms": (time.perf_counter() - started) * 1000
+    })
+
+
+# ---------------------------------------------------------------------------
+# FSMs: python-statemachine vs. the compiled transition tables
+# ---------------------------------------------------------------------------
+class _BenchSubsystem:
+    desired_state = None
+    priority = None
+
+    def toggle(self):
+        pass
+
+
+class _BenchLED:
+    def write(self, value):
+        return value
+
+
+class _NullWriter:
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+# One airlock cycle per FSM as (event, repeats). The repeated self-loops
+# stand in for the control loop passes spent waiting in a state.
+def _fsm_cycles(hold):
+    return {
+        "PressureFSM": [
+            ("keep_idling", hold), ("start_pressurize", 1),
+            ("keep_pressurize", hold), ("done_pressurize", 1),
+            ("keep_idling", hold), ("start_depressurize", 1),
+            ("keep_depressurize", hold), ("pause_depress", 1),
+            ("keep_pausing", hold), ("resume_depress", 1),
+            ("keep_depressurize", hold), ("done_depressurize", 1)
+        ],
+        "DoorFSM": [
+            ("keep_idling", hold), ("start_open", 1),
+            ("keep_opening", hold), ("done_open", 1),
+            ("keep_idling", hold), ("start_close", 1),
+            ("keep_closing", hold), ("done_close", 1)
+        ],
+        "LightFSM": [("turn_on", 1), ("turn_off", 1)]
+    }
+
+
+def _library_fsm(cls):
+    # The same machine declared with python-statemachine, sharing the
+    # callbacks of the compiled one.
+    import statemachine
+    states = {s.value: statemachine.State(s.name, initial=s.initial)
+              for s in cls.states}
+    attributes = dict(states)
+    for event, row in zip(cls.events, cls._table):
+        transitions = None
+        for source, target in enumerate(row):
+            if target < 0:
+                continue
+            transition = states[cls.states[source].value].to(
+                states[cls.states[target].value])
+            transitions = transition if transitions is None \
+                else transitions | transition
+        attributes[event] = transitions
+    for name in dir(cls):
+        if name.startswith("on_"):
+            attributes[name] = getattr(cls, name)
+    return type(cls.__name__, (statemachine.StateMachine,), attributes)
+
+
+def bench_fsm(args):
+    import contextlib
+    import warnings
+    fsms = importlib.import_module("pi-systems-defn-FSMs")
+
+    # "compiled" runs every callback, as python-statemachine does, so
+    # the two compare like for like. "compiled_elided" also skips the
+    # callbacks of repeated self-loops, as the supervisor runs it.
+    implementations = [("compiled", lambda cls: cls),
+                       ("compiled_elided", lambda cls: cls)]
+    try:
+        import statemachine  # noqa: F401
+        implementations.insert(0, ("statemachine", _library_fsm))
+    except ModuleNotFoundError:
+        print("python-statemachine is not installed, benchmarking the "
+              "compiled FSMs only.", file=sys.stderr)
+
+    ss = _BenchSubsystem()
+    leds = [_BenchLED() for _ in range(7)]
+    # Arguments of each event, as passed by the control loop.
+    arguments = {
+        "PressureFSM": lambda event: (ss,) if event in (
+            "keep_idling", "keep_pausing") else (ss, leds),
+        "DoorFSM": lambda event: (ss,),
+        "LightFSM": lambda event: (ss,)
+    }
+
+    for fsm_name, cycle in _fsm_cycles(args.hold).items():
+        cls = getattr(fsms, fsm_name)
+        calls = [(event, arguments[fsm_name](event))
+                 for event, repeats in cycle for _ in range(repeats)]
+        for implementation, build in implementations:
+            fsm = build(cls)()
+            if implementation == "compiled":
+                fsm.elide_self_loops = False
+            fire = [(getattr(fsm, event), event_args)
+                    for event, event_args in calls]
+            with warnings.catch_warnings(), \
+                    contextlib.redirect_stdout(_NullWriter()):
+                warnings.simplefilter("ignore")
+                started = time.perf_counter()
+                for _ in range(args.cycles):
+                    for event, event_args in fire:
+                        event(*event_args)
+                elapsed = time.perf_counter() - started
+            transitions = args.cycles * len(calls)
+            result = {
+                "benchmark": "fsm",
+                "fsm": fsm_name,
+                "implementation": implementation,
+                "transitions": transitions,
+                "transitions_per_s": transitions / elapsed
+            }
+            if implementation == "compiled_elided":
+                result["callbacks_elided"] = fsm.stats["elided"]
+            _emit(result)
+
+
+# ---------------------------------------------------------------------------
+# Cycle time: the pressure subsystems and PressureFSM on the simulator
+# ---------------------------------------------------------------------------
+class _VirtualLoops:
+    # The subsystem loops, run one at a time in deadline order on a
+    # VirtualClock. A task is [deadline, period_s, loop].
+    def __init__(self, clock):
+        self.clock = clock
+        self._queue = []
+        self._counter = itertools.count()
+
+    def add(self, period_s, loop):
+        task = [self.clock.now(), period_s, loop]
+        self._push(task)
+        return task
+
+    # Like Scheduler.wake(): run the task now, then at its period again.
+    def wake(self, task):
+        task[0] = self.clock.now()
+        self._push(task)
+
+    # Run loops until done() is true. Returns False on timeout.
+    def run_until(self, done, timeout_s, after=None):
+        timeout = self.clock.now() + timeout_s
+        while not done():
+            deadline, _, task = self._queue[0]
+            if deadline > timeout:
+                return False
+            heapq.heappop(self._queue)
+            if deadline != task[0]:
+                continue  # Woken since this run was planned.
+            self.clock.advance_to(deadline)
+            task[0] = deadline + task[1]
+            self._push(task)
+            task[2]()
+            if after:
+                after()
+        return True
+
+    def _push(self, task):
+        heapq.heappush(self._queue, (task[0], next(self._counter), task))
+
+
+def _cycle_configs(args):
+    for loop_delay, sensor_period, sensors, latency, controller in \
+            itertools.product(args.loop_delay, args.sensor_period,
+                              args.sensors, args.latency, args.controller):
+        yield {
+            "loop_delay_ms": loop_delay,
+            "sensor_period_ms": sensor_period,
+            "sensors": sensors,
+            "bus_latency_s": latency,
+            "controller": controller
+        }
+
+
+def _cycle_run(args, config):
+    # Imported here: pi-systems_communications opens the bus of the
+    # backend selected when it is first imported.
+    hardware = importlib.import_module("pi-systems_hardware")
+    clocks = importlib.import_module("pi-systems_clock")
+    simulator = importlib.import_module("pi-systems_simulator")
+    comms = importlib.import_module("pi-systems_communications")
+    sensor_ss = importlib.import_module("pi-systems_sensor-reader")
+    pressure_ss = importlib.import_module("pi-systems_pressure-manager")
+    supervisor = importlib.import_module("pi-systems_fsm-supervisor")
+    subsys_pool = importlib.import_module("pi-systems_subsystem-pool")
+
+    clock = clocks.VirtualClock()
+    sim = hardware.select(
+        hardware.Backend.Simulator,
+        clock=clock,
+        latency_s=config["bus_latency_s"],
+        chamber={
+            "supply_pa": args.supply * 100,
+            "initial_pa": supervisor.TARGET_DEPRESSURE * 100
+        })
+    comms.bus_manager.bus = sim.bus
+    addresses = [sim.sensors.address]
+    for i in range(1, config["sensors"]):
+        addresses.append(sim.bus.attach(simulator.SensorBoard(
+            address=sim.sensors.address + i,
+            clock=clock,
+            source=sim.chamber.readings)).address)
+
+    sensors = sensor_ss.SensorSubsystem(
+        name="bench_sensors",
+        thread_id="bench_sensors",
+        addresses=addresses,
+        clock=clock.now)
+    pressure = pressure_ss.PressureSubsystem(
+        name="bench_pressure",
+        thread_id="bench_pressure",
+        sensors=sensors if config["controller"] == "on" else None,
+        control_delay_ms=args.control_delay,
+        controller_options={"clock": clock.now})
+
+    def read_pressure():
+        latest = sensors.history['pressure'].latest()
+        return latest[1] if latest else None
+
+    fsms = supervisor.FSMSupervisor(
+        pressure, _BenchSubsystem(), leds=[_BenchLED() for _ in range(7)],
+        read_pressure=read_pressure)
+
+    loops = _VirtualLoops(clock)
+    ticks = loops.add(fsms.tick_s, fsms.settle)
+
+    def read_sensors():
+        sensors.loop()
+        loops.wake(ticks)  # sensors.on_loop
+
+    loops.add(config["sensor_period_ms"] / 1000, read_sensors)
+    loop = loops.add(config["loop_delay_ms"] / 1000, pressure.loop)
+    pressure.reconciler.on_desire = lambda: loops.wake(loop)
+    if config["controller"] == "on":
+        loops.add(args.control_delay / 1000, pressure.controller.step)
+
+    extremes = {}
+    results = []
+
+    def track():
+        p = sim.chamber.pressure_hpa
+        extremes["max"] = max(extremes.get("max", p), p)
+        extremes["min"] = min(extremes.get("min", p), p)
+
+    for name, button, target in (
+            ("pressurize", "P", supervisor.TARGET_PRESSURE),
+            ("depressurize", "D", supervisor.TARGET_DEPRESSURE)):
+        fsms.set_input('Enable P/D/H', 1)
+        fsms.set_input(button, 1)
+        fsms.settle()
+        fsms.set_input(button, 0)
+
+        extremes.clear()
+        transactions = sim.bus.transactions
+        started = clock.now()
+        cpu = time.process_time()
+        wall = time.perf_counter()
+        finished = loops.run_until(
+            lambda: fsms.fsm_pressure.current_state.name == "idle",
+            args.timeout, after=track)
+        cycle_s = clock.now() - started
+        cpu_s = time.process_time() - cpu
+        wall_s = time.perf_counter() - wall
+        i2c = sim.bus.transactions - transactions
+        # Let the valves close before judging the overshoot.
+        loops.run_until(lambda: False, args.settle, after=track)
+        if name == "pressurize":
+            overshoot = extremes["max"] - target
+        else:
+            overshoot = target - extremes["min"]
+
+        results.append(dict(
+            config,
+            cycle=name,
+            cycle_s=cycle_s if finished else None,
+            overshoot_hpa=max(0.0, overshoot),
+            final_hpa=sim.chamber.pressure_hpa,
+            i2c_transactions=i2c,
+            cpu_ms=cpu_s * 1000,
+            wall_ms=wall_s * 1000))
+
+    subsys_pool.remove(sensors)
+    subsys_pool.remove(pressure)
+    return results
+
+
+def _load_baseline(path):
+    baseline = {}
+    with open(path) as results:
+        for line in results:
+            result = json.loads(line)
+            if result.get("benchmark") == "cycle":
+                baseline[_cycle_key(result)] = result
+    return baseline
+
+
+def _cycle_key(result):
+    return tuple(result[key] for key in (
+        "cycle", "loop_delay_ms", "sensor_period_ms", "sensors",
+        "bus_latency_s", "controller"))
+
+
+def _cycle_regressions(result, baseline, tolerance):
+    previous = baseline.get(_cycle_key(result))
+    if previous is None:
+        return []
+    regressions = []
+    for metric, slack in (("cycle_s", 0), ("overshoot_hpa", 0.1),
+                          ("i2c_transactions", 0)):
+        old, new = previous.get(metric), result[metric]
+        if old is None:
+            continue
+        if new is None or new > old * (1 + tolerance) + slack:
+            regressions.append("%s: %s -> %s" % (metric, old, new))
+    return regressions
+
+
+def bench_cycle(args):
+    baseline = _load_baseline(args.baseline) if args.baseline else {}
+    regressed = 0
+    for config in _cycle_configs(args):
+        with contextlib.redirect_stdout(_NullWriter()):
+            results = _cycle_run(args, config)
+        for result in results:
+            result = dict(result, benchmark="cycle")
+            regressions = _cycle_regressions(
+                result, baseline, args.tolerance)
+            if regressions:
+                regressed += 1
+                result["regressions"] = regressions
+                print("Regression in %s %s: %s" % (
+                    result["cycle"], config, "; ".join(regressions)),
+                    file=sys.stderr)
+            _emit(result)
+    return 1 if regressed else 0
+
+
+# ---------------------------------------------------------------------------
+# Sensor readers: subsystem lock vs. the published snapshot, on a slow bus
+# ---------------------------------------------------------------------------
+def _percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _sensor_readers(args, mode):
+    hardware = importlib.import_module("pi-systems_hardware")
+    simulator = importlib.import_module("pi-systems_simulator")
+    comms = importlib.import_module("pi-systems_communications")
+    sensor_ss = importlib.import_module("pi-systems_sensor-reader")
+    subsys_pool = importlib.import_module("pi-systems_subsystem-pool")
+
+    sim = hardware.select(hardware.Backend.Simulator, latency_s=args.latency)
+    comms.bus_manager.bus = sim.bus
+    addresses = [sim.sensors.address]
+    for i in range(1, args.sensors):
+        addresses.append(sim.bus.attach(simulator.SensorBoard(
+            address=sim.sensors.address + i,
+            clock=sim.clock,
+            source=sim.chamber.readings)).address)
+    sensors = sensor_ss.SensorSubsystem(
+        name="bench_sensors_%s" % mode,
+        thread_id="bench_sensors_%s" % mode,
+        addresses=addresses)
+
+    stop = threading.Event()
+
+    # "locked" holds the subsystem lock over the whole bus acquisition and
+    # reads under it, as the sensor loop and handle_cmd used to.
+    def write():
+        while not stop.is_set():
+            if mode == "locked":
+                with sensors:
+                    sensors.loop()
+            else:
+                sensors.loop()
+
+    def read(latencies):
+        while not stop.is_set():
+            started = time.perf_counter()
+            if mode == "locked":
+                with sensors:
+                    sensors.sensor_data['pressure']
+            else:
+                sensors.sensor_data['pressure']
+            latencies.append(time.perf_counter() - started)
+            time.sleep(args.read_interval)
+
+    latencies = [[] for _ in range(args.readers)]
+    threads = [threading.Thread(target=write)] + [
+        threading.Thread(target=read, args=(reader,))
+        for reader in latencies]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    subsys_pool.remove(sensors)
+
+    ordered = sorted(latency for reader in latencies for latency in reader)
+    return {
+        "benchmark": "sensors",
+        "mode": mode,
+        "bus_latency_s": args.latency,
+        "sensors": args.sensors,
+        "readers": args.readers,
+        "reads": len(ordered),
+        "updates": sensors.version,
+        "read_p50_us": _percentile(ordered, 0.5) * 1e6,
+        "read_p99_us": _percentile(ordered, 0.99) * 1e6,
+        "read_max_us": ordered[-1] * 1e6
+    }
+
+
+def bench_sensors(args):
+    for mode in ("locked", "snapshot"):
+        with contextlib.redirect_stdout(_NullWriter()):
+            result = _sensor_readers(args, mode)
+        _emit(result)
+
+
+# ---------------------------------------------------------------------------
+# Command latency: request to acknowledgement, with and without notify()
+# ---------------------------------------------------------------------------
+def _command_latency(args, wake):
+    hardware = importlib.import_module("pi-systems_hardware")
+    comms = importlib.import_module("pi-systems_communications")
+    pressure_ss = importlib.import_module("pi-systems_pressure-manager")
+    door_ss = importlib.import_module("pi-systems_door-subsystem")
+
+    sim = hardware.select(hardware.Backend.Simulator, latency_s=args.latency)
+    comms.bus_manager.bus = sim.bus
+    pressure = pressure_ss.PressureSubsystem(
+        name="bench_pressure_%s" % wake, thread_id="bench_pressure_%s" % wake)
+    door = door_ss.DoorSubsystem(
+        name="bench_door_%s" % wake, thread_id="bench_door_%s" % wake,
+        address=sim.door.address)
+    states = pressure_ss.PressureSubsystem.TargetState
+    procedures = door_ss.DoorSubsystem.Procedure
+    requests = {
+        "pressure": lambda i: pressure.request_new_state(
+            (states.Pressurize, states.close)[i % 2]),
+        "door": lambda i: door.request_door_state(procedures.getDoorState)
+    }
+
+    results = []
+    rng = random.Random(args.seed)
+    for name, subsystem in (("pressure", pressure), ("door", door)):
+        if wake == "off":
+            # Requests wait for the next loop, as before notify().
+            subsystem.thread.notify = lambda: None
+        subsystem.start()
+        latencies = []
+        for i in range(args.requests):
+            # Land the requests at random points of the loop period.
+            time.sleep(rng.uniform(0, subsystem.thread.loop_delay_ms / 1000))
+            started = time.perf_counter()
+            requests[name](i).result()
+            latencies.append(time.perf_counter() - started)
+        subsystem.stop()
+
+        latencies.sort()
+        results.append({
+            "benchmark": "commands",
+            "subsystem": name,
+            "wake": wake,
+            "loop_delay_ms": subsystem.thread.loop_delay_ms,
+            "bus_latency_s": args.latency,
+            "requests": len(latencies),
+            "p50_ms": _percentile(latencies, 0.5) * 1000,
+            "max_ms": latencies[-1] * 1000,
+            "command_latency": subsystem.command_latency.report()
+        })
+    return results
+
+
+def bench_commands(args):
+    for wake in args.wake:
+        with contextlib.redirect_stdout(_NullWriter()):
+            results = _command_latency(args, wake)
+        for result in results:
+            _emit(result)
+
+
+# ---------------------------------------------------------------------------
+# Watchdog: how long a stalled sensor board freezes the readings
+# ---------------------------------------------------------------------------
+def _stalled_sensors(args, mode):
+    hardware = importlib.import_module("pi-systems_hardware")
+    comms = importlib.import_module("pi-systems_communications")
+    sensor_ss = importlib.import_module("pi-systems_sensor-reader")
+    subsys_pool = importlib.import_module("pi-systems_subsystem-pool")
+    watchdog = importlib.import_module("pi-systems_watchdog")
+
+    sim = hardware.select(hardware.Backend.Simulator, latency_s=args.latency)
+    comms.bus_manager.bus = sim.bus
+    sensors = sensor_ss.SensorSubsystem(
+        name="bench_stalled_%s" % mode,
+        thread_id="bench_stalled_%s" % mode,
+        addresses=sim.sensors.address)
+    sensors.thread.loop_delay_ms = args.sensor_period
+    dog = watchdog.Watchdog(
+        [sensors],
+        check_ms=args.check,
+        bus_timeout_ms=args.bus_timeout,
+        reset_bus=lambda: comms.bus_manager.reset(sim.bus))
+
+    # Longest time between two published readings, around each stall.
+    stop = threading.Event()
+    updates = []
+
+    def watch():
+        version = sensors.version
+        while not stop.is_set():
+            if sensors.version != version:
+                version = sensors.version
+                updates.append(time.perf_counter())
+            time.sleep(0.001)
+
+    watcher = threading.Thread(target=watch)
+    sensors.start()
+    watcher.start()
+    if mode == "on":
+        dog.start()
+    freezes = []
+    period = args.sensor_period / 1000
+    for _ in range(args.stalls):
+        time.sleep(3 * period)
+        stalled = time.perf_counter()
+        sim.bus.stall(sim.sensors.address, args.stall)
+        time.sleep(args.stall + 3 * period)
+        window = [t for t in updates if t > stalled]
+        window[:0] = [t for t in updates if t <= stalled][-1:]
+        if len(window) > 1:
+            freezes.append(max(b - a for a, b in zip(window, window[1:])))
+        else:
+            freezes.append(float("inf"))
+    dog.stop()
+    stop.set()
+    watcher.join()
+    sensors.stop()
+    subsys_pool.remove(sensors)
+
+    freezes.sort()
+    result = {
+        "benchmark": "watchdog",
+        "watchdog": mode,
+        "stall_s": args.stall,
+        "sensor_period_ms": args.sensor_period,
+        "stalls": args.stalls,
+        "freeze_p50_ms": _percentile(freezes, 0.5) * 1000,
+        "freeze_max_ms": freezes[-1] * 1000
+    }
+    if mode == "on":
+        result["watchdog_stats"] = dog.stats
+    return result
+
+
+def bench_watchdog(args):
+    for mode in args.watchdog:
+        with contextlib.redirect_stdout(_NullWriter()):
+            result = _stalled_sensors(args, mode)
+        _emit(result)
+
+
+# ---------------------------------------------------------------------------
+# Inputs: button press to on_change callback, edge-dispatched vs. polled
+# ---------------------------------------------------------------------------
+def _input_latency(args, mode):
+    hardware = importlib.import_module("pi-systems_hardware")
+    interface_ss = importlib.import_module("pi-systems_interface-subsystem")
+    subsys_pool = importlib.import_module("pi-systems_subsystem-pool")
+
+    sim = hardware.select(hardware.Backend.Simulator)
+    sim.gpio.setmode(sim.gpio.BCM)
+    pressed = threading.Event()
+    button = interface_ss.InputComponent(
+        "bench_button", 5, "Button", debounce_ms=args.debounce,
+        on_change_callbacks={"bench": lambda state: pressed.set()})
+    interface = interface_ss.InterfaceSubsystem(
+        name="bench_inputs_%s" % mode,
+        thread_id="bench_inputs_%s" % mode,
+        inputs=[button],
+        loop_delay_ms=args.poll_delay if mode == "polling" else None,
+        input_mode=mode)
+    interface.start()
+
+    latencies = []
+    rng = random.Random(args.seed)
+    for i in range(args.presses):
+        # Land the presses at random points of the poll period, after
+        # the debounce window of the last one has closed.
+        time.sleep(2 * args.debounce / 1000
+                   + rng.uniform(0, args.poll_delay / 1000))
+        pressed.clear()
+        started = time.perf_counter()
+        sim.gpio.drive(button.pin, (i + 1) % 2)
+        if pressed.wait(1):
+            latencies.append(time.perf_counter() - started)
+    interface.stop()
+    subsys_pool.remove(interface)
+
+    latencies.sort()
+    result = {
+        "benchmark": "inputs",
+        "mode": mode,
+        "poll_delay_ms": args.poll_delay,
+        "presses": args.presses,
+        "missed": args.presses - len(latencies),
+        "p50_ms": _percentile(latencies, 0.5) * 1000,
+        "max_ms": latencies[-1] * 1000
+    }
+    if mode == "edge":
+        result["edge_stats"] = interface.edge_stats
+    return result
+
+
+def bench_inputs(args):
+    for mode in args.mode:
+        with contextlib.redirect_stdout(_NullWriter()):
+            result = _input_latency(args, mode)
+        _emit(result)
+
+
+# ---------------------------------------------------------------------------
+# Metrics: cost of the instrumentation on a subsystem loop
+# ---------------------------------------------------------------------------
+def bench_metrics(args):
+    subsys = importlib.import_module("pi-systems_subsystem-base")
+    subsys_pool = importlib.import_module("pi-systems_subsystem-pool")
+    metrics = importlib.import_module("pi-systems_metrics")
+
+    class LockingSubsystem(subsys.Subsystem):
+        def loop(self):
+            with self:
+                pass
+
+    with contextlib.redirect_stdout(_NullWriter()):
+        subsystem = LockingSubsystem(
+            "bench_metrics", thread_id="bench_metrics")
+    # One loop and one lock acquisition per iteration, as dispatched by
+    # the scheduler.
+    for mode in ("disabled", "enabled"):
+        metrics.enable(mode == "enabled")
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            subsystem._loop()
+        elapsed = time.perf_counter() - started
+        _emit({
+            "benchmark": "metrics",
+            "metrics": mode,
+            "iterations": args.iterations,
+            "loop_ns": elapsed * 1e9 / args.iterations,
+            "exposition_bytes": len(metrics.exposition())
+        })
+    metrics.enable(False)
+    subsys_pool.remove(subsystem)
+
+
+# ---------------------------------------------------------------------------
+# Logging: time a loop spends writing a line to a slow console or SD card
+# ---------------------------------------------------------------------------
+class _SlowWriter(_NullWriter):
+    def __init__(self, delay_s):
+        self.delay_s = delay_s
+
+    def write(self, text):
+        time.sleep(self.delay_s)
+        return len(text)
+
+
+def bench_log(args):
+    log = importlib.import_module("pi-systems_log")
+    log.configure(level=0, console=True, rate_burst=args.lines)
+    for mode in args.mode:
+        latencies = []
+        sink = _SlowWriter(args.write_delay)
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(sink):
+            for line in range(args.lines):
+                called = time.perf_counter()
+                if mode == "print":
+                    print("PRESSURIZING...", line)
+                else:
+                    log.v("bench", "PRESSURIZING... %i", line)
+                latencies.append(time.perf_counter() - called)
+                time.sleep(args.interval)
+            looped = time.perf_counter() - started
+            log.flush(timeout=args.lines * args.write_delay + 1)
+        latencies.sort()
+        _emit({
+            "benchmark": "log",
+            "mode": mode,
+            "lines": args.lines,
+            "write_delay_ms": args.write_delay * 1000,
+            "call_p50_us": _percentile(latencies, 0.5) * 1e6,
+            "call_max_us": latencies[-1] * 1e6,
+            "loop_s": looped
+        })
+    log.configure(console=False)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="UBC Mars Colony - Airlock pi systems benchmarks")
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    execution = benchmarks.add_parser(
+        "execution",
+        help="Compare wakeups and RSS of thread-per-subsystem "
+             "against the shared worker pool.")
+    execution.add_argument("--mode", choices=["thread", "pool"],
+                           help="Run a single mode (default: both).")
+    execution.add_argument("--workers", type=int, default=2)
+    execution.add_argument("--subsystems", type=int, default=8)
+    execution.add_argument("--duration", type=float, default=5.0)
+    execution.set_defaults(run=bench_execution)
+
+    messages = benchmarks.add_parser(
+        "messages",
+        help="Messages per second generated, validated and decoded, "
+             "before and after the struct-backed IntraModCommMessage.")
+    messages.add_argument("--iterations", type=int, default=200000)
+    messages.set_defaults(run=bench_messages)
+
+    pressurization = benchmarks.add_parser(
+        "pressurization",
+        help="Simulated time of a full pressurize and depressurize cycle "
+             "for a given chamber and valves, on a virtual clock.")
+    pressurization.add_argument("--volume", type=float, default=3.0,
+                                help="Chamber volume, m^3.")
+    pressurization.add_argument("--conductance", type=float, default=5e-8,
+                                help="Valve sonic conductance, m^3/(s Pa).")
+    pressurization.add_argument("--leak", type=float, default=1e-11,
+                                help="Leak sonic conductance, m^3/(s Pa).")
+    pressurization.add_argument("--sensor_period", type=float, default=2.0,
+                                help="Seconds between pressure readings.")
+    pressurization.add_argument("--target_p", type=int, default=1013)
+    pressurization.add_argument("--target_d", type=int, default=6)
+    pressurization.add_argument("--timeout", type=float, default=4 * 3600,
+                                help="Simulated seconds before giving up.")
+    pressurization.set_defaults(run=bench_pressurization)
+
+    fsm = benchmarks.add_parser(
+        "fsm",
+        help="Transitions per second of each airlock FSM over a scripted "
+             "cycle, with python-statemachine and compiled.")
+    fsm.add_argument("--cycles", type=int, default=200)
+    fsm.add_argument("--hold", type=int, default=50,
+                     help="Self-loop transitions per state of a cycle.")
+    fsm.set_defaults(run=bench_fsm)
+
+    cycle = benchmarks.add_parser(
+        "cycle",
+        help="Pressurize and depressurize cycles of the PressureSubsystem, "
+             "SensorSubsystem and PressureFSM against the simulated "
+             "chamber and bus, on a virtual clock, for every combination "
+             "of the swept options.")
+    cycle.add_argument("--loop_delay", type=int, nargs="+", default=[750],
+                       help="PressureSubsystem loop delays, ms.")
+    cycle.add_argument("--sensor_period", type=int, nargs="+",
+                       default=[2000],
+                       help="SensorSubsystem loop delays, ms.")
+    cycle.add_argument("--sensors", type=int, nargs="+", default=[1, 3],
+                       help="Numbers of sensor boards.")
+    cycle.add_argument("--latency", type=float, nargs="+",
+                       default=[0.0, 0.002],
+                       help="Bus latencies per transaction, s.")
+    cycle.add_argument("--controller", choices=["off", "on"], nargs="+",
+                       default=["off", "on"],
+                       help="Run with and/or without the PressureController.")
+    cycle.add_argument("--control_delay", type=int,
+                       default=100,
+                       help="PressureController period, ms.")
+    cycle.add_argument("--supply", type=float, default=1013.25,
+                       help="Pressure behind the pressurizer valve, hPa.")
+    cycle.add_argument("--settle", type=float, default=10.0,
+                       help="Simulated seconds after a cycle over which "
+                            "the overshoot is measured.")
+    cycle.add_argument("--timeout", type=float, default=4 * 3600,
+                       help="Simulated seconds before giving up a cycle.")
+    cycle.add_argument("--baseline",
+                       help="JSON lines of an earlier run. Exits with 1 if "
+                            "a cycle got slower, overshot more or used "
+                            "more I2C transactions.")
+    cycle.add_argument("--tolerance", type=float, default=0.05,
+                       help="Relative slack allowed against the baseline.")
+    cycle.set_defaults(run=bench_cycle)
+
+    sensors = benchmarks.add_parser(
+        "sensors",
+        help="Latency of reading the sensor subsystem while it polls a "
+             "slow bus, under the subsystem lock and from the published "
+             "snapshot.")
+    sensors.add_argument("--latency", type=float, default=0.005,
+                         help="Bus latency per transaction, s.")
+    sensors.add_argument("--sensors", type=int, default=3,
+                         help="Number of sensor boards.")
+    sensors.add_argument("--readers", type=int, default=4)
+    sensors.add_argument("--read_interval", type=float, default=0.001,
+                         help="Pause between the reads of a reader, s.")
+    sensors.add_argument("--duration", type=float, default=2.0)
+    sensors.set_defaults(run=bench_sensors)
+
+    commands = benchmarks.add_parser(
+        "commands",
+        help="Time from a PressureSubsystem or DoorSubsystem request to "
+             "the Arduino acknowledging it, with the loop woken by the "
+             "request and/or left to its period.")
+    commands.add_argument("--wake", choices=["off", "on"], nargs="+",
+                          default=["off", "on"])
+    commands.add_argument("--requests", type=int, default=5,
+                          help="Requests per subsystem.")
+    commands.add_argument("--latency", type=float, default=0.001,
+                          help="Bus latency per transaction, s.")
+    commands.add_argument("--seed", type=int, default=1)
+    commands.set_defaults(run=bench_commands)
+
+    watchdog = benchmarks.add_parser(
+        "watchdog",
+        help="Longest gap between sensor readings while the sensor board "
+             "stalls the bus, with and/or without the Watchdog.")
+    watchdog.add_argument("--watchdog", choices=["off", "on"], nargs="+",
+                          default=["off", "on"])
+    watchdog.add_argument("--stalls", type=int, default=3)
+    watchdog.add_argument("--stall", type=float, default=5.0,
+                          help="Length of each stall, s.")
+    watchdog.add_argument("--sensor_period", type=int, default=200,
+                          help="SensorSubsystem loop delay, ms.")
+    watchdog.add_argument("--check", type=int, default=50,
+                          help="Watchdog check period, ms.")
+    watchdog.add_argument("--bus_timeout", type=int, default=500,
+                          help="Watchdog bus timeout, ms.")
+    watchdog.add_argument("--latency", type=float, default=0.001,
+                          help="Bus latency per transaction, s.")
+    watchdog.set_defaults(run=bench_watchdog)
+
+    inputs = benchmarks.add_parser(
+        "inputs",
+        help="Time from a button press on the simulated GPIO to its "
+             "on_change callback, with edge detection and/or polling.")
+    inputs.add_argument("--mode", choices=["polling", "edge"], nargs="+",
+                        default=["polling", "edge"])
+    inputs.add_argument("--presses", type=int, default=20)
+    inputs.add_argument("--poll_delay", type=int, default=100,
+                        help="InterfaceSubsystem loop delay when polling, "
+                             "ms.")
+    inputs.add_argument("--debounce", type=int, default=20,
+                        help="Debounce window of the button, ms.")
+    inputs.add_argument("--seed", type=int, default=1)
+    inputs.set_defaults(run=bench_inputs)
+
+    metrics = benchmarks.add_parser(
+        "metrics",
+        help="Time of a subsystem loop that takes its lock, with the "
+             "metrics disabled and enabled.")
+    metrics.add_argument("--iterations", type=int, default=200000)
+    metrics.set_defaults(run=bench_metrics)
+
+    logging = benchmarks.add_parser(
+        "log",
+        help="Time a loop spends per line written to a slow console, "
+             "printing and through pi-systems_log.")
+    logging.add_argument("--mode", choices=["print", "log"], nargs="+",
+                         default=["print", "log"])
+    logging.add_argument("--lines", type=int, default=200)
+    logging.add_argument("--write_delay", type=float, default=0.002,
+                         help="Time taken by every write to the console, "
+                              "s.")
+    logging.add_argument("--interval", type=float, default=0.001,
+                         help="Pause of the loop between lines, s.")
+    logging.set_defaults(run=bench_log)
+
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # Records are written after the benchmarks' redirect_stdout has ended,
+    # and would end up between the JSON lines.
+    importlib.import_module("pi-systems_log").configure(console=False)
+    sys.exit(args.run(args))
@@ -0,0 +1,189 @@
+import math
+import threading
+import importlib
+clocks = importlib.import_module('pi-systems_clock')
+
+"""
+Purpose: Physical model of the airlock chamber pressure for the simulator.
+
+    The chamber is a fixed volume of air at constant temperature, so its
+    pressure is proportional to the mass of air inside (p V = m R T).
+    Air moves through three paths:
+        pressurizer valve: from the habitat supply into the chamber
+        depressurizer valve: from the chamber out to the Martian exhaust
+        leak: between the chamber and the outside, always open
+
+    Each path is a flow restriction characterised as in ISO 6358 by its
+    sonic conductance C (m^3 / (s Pa)) and critical pressure ratio b:
+        choked (p_down / p_up <= b):  m' = C p_up rho0
+        subsonic:                     m' = C p_up rho0 sqrt(1 - ((r - b) / (1 - b))^2)
+    so a valve flows at a constant rate until the pressures get close,
+    then tails off, and the pressures meet in finite time.
+
+    The valves are read from a callable on every update, normally the
+    simulated pressurization Arduino, which opens them according to the
+    TargetState sent by PressureSubsystem. An update that spans a valve
+    switch scheduled by the Arduino (the delayed depressurizer) is split
+    at the switch, so each valve state flows only while it held. Time
+    comes from a clock, so the model runs in real time, faster
+    (ScaledClock) or as fast as it is stepped (VirtualClock).
+"""
+
+# Specific gas constant of air, J / (kg K).
+R_AIR = 287.05
+# Reference density of ISO 6358 conductances, kg / m^3.
+RHO_0 = 1.185
+HPA = 100.0
+
+EARTH_PRESSURE_PA = 101325.0
+MARS_PRESSURE_PA = 600.0
+
+
+class ChamberModel:
+    """
+    volume_m3: Free volume of the chamber.
+    temperature_k: Temperature of the air, held constant.
+    supply_pa: Pressure behind the pressurizer valve (the habitat).
+    exhaust_pa: Pressure behind the depressurizer valve and the leak.
+    pressurizer_conductance: Sonic conductance of the pressurizer path.
+    depressurizer_conductance: Sonic conductance of the depressurizer path.
+    leak_conductance: Sonic conductance of all leaks combined.
+    critical_ratio: Critical pressure ratio b of every path.
+    initial_pa: Chamber pressure at the start. Defaults to supply_pa.
+    valves: Callable returning (pressurizer_open, depressurizer_open) at
+        the clock time it is passed.
+    valve_switch: Optional callable returning the clock time of the last
+        valve switch scheduled ahead of time, or None.
+    clock: Clock the model integrates against.
+    max_step_s: Longest integration step.
+    """
+    def __init__(
+        self,
+        volume_m3=3.0,
+        temperature_k=293.15,
+        supply_pa=EARTH_PRESSURE_PA,
+        exhaust_pa=MARS_PRESSURE_PA,
+        pressurizer_conductance=5e-8,
+        depressurizer_conductance=5e-8,
+        leak_conductance=1e-11,
+        critical_ratio=0.528,
+        initial_pa=None,
+        valves=None,
+        valve_switch=None,
+        clock=None,
+        max_step_s=0.1
+    ):
+        self.volume_m3 = volume_m3
+        self.temperature_k = temperature_k
+        self.supply_pa = supply_pa
+        self.exhaust_pa = exhaust_pa
+        self.pressurizer_conductance = pressurizer_conductance
+        self.depressurizer_conductance = depressurizer_conductance
+        self.leak_conductance = leak_conductance
+        self.critical_ratio = critical_ratio
+        self.valves = valves or (lambda at: (False, False))
+        self.valve_switch = valve_switch or (lambda: None)
+        self.clock = clock or clocks.WallClock()
+        self.max_step_s = max_step_s
+
+        # Readings the model does not simulate.
+        self.O2 = 21
+        self.humidity = 40
+        self.CO2 = 400
+
+        self._lock = threading.Lock()
+        self._pressure = supply_pa if initial_pa is None else initial_pa
+        self._updated = self.clock.now()
+
+    def __repr__(self):
+        return "ChamberModel (pressure=%.1f hPa, volume=%.1f m^3)" % (
+            self.pressure_hpa, self.volume_m3)
+
+    @property
+    def pressure_pa(self):
+        return self.update()
+
+    @property
+    def pressure_hpa(self):
+        return self.update() / HPA
+
+    """
+    Readings as reported by the integrated sensors board (pressure in hPa,
+    temperature in C). Usable as SensorBoard.source.
+    """
+    def readings(self):
+        return {
+            'O2': self.O2,
+            'humidity': self.humidity,
+            'temperature': self.temperature_k - 273.15,
+            'pressure': self.pressure_hpa,
+            'CO2': self.CO2
+        }
+
+    """
+    Integrate up to the current clock time. Returns the pressure in Pa.
+    """
+    def update(self):
+        with self._lock:
+            now = self.clock.now()
+            if now <= self._updated:
+                return self._pressure
+
+            switch = self.valve_switch()
+            if switch is not None and self._updated < switch < now:
+                self._integrate(switch)
+            self._integrate(now)
+            return self._pressure
+
+    # Integrate from the last update to until, with the valves as they
+    # were at the last update.
+    def _integrate(self, until):
+        pressurizer, depressurizer = self.valves(self._updated)
+        remaining = until - self._updated
+        self._updated = until
+        while remaining > 0:
+            dt = min(remaining, self.max_step_s)
+            self._pressure = self._step(self._pressure, dt,
+                                        pressurizer, depressurizer)
+            remaining -= dt
+
+    """
+    Rate of change of the chamber pressure in Pa/s for the given valve
+    states, without advancing the model.
+    """
+    def rate(self, pressure_pa=None, pressurizer=False, depressurizer=False):
+        pressure = self._pressure if pressure_pa is None else pressure_pa
+        mass_flow = self._flow(
+            self.leak_conductance, self.exhaust_pa, pressure)
+        if pressurizer:
+            mass_flow += self._flow(
+                self.pressurizer_conductance, self.supply_pa, pressure)
+        if depressurizer:
+            mass_flow += self._flow(
+                self.depressurizer_conductance, self.exhaust_pa, pressure)
+        return mass_flow * R_AIR * self.temperature_k / self.volume_m3
+
+    def _step(self, pressure, dt, pressurizer, depressurizer):
+        new = pressure + self.rate(pressure, pressurizer, depressurizer) * dt
+
+        # The chamber cannot overshoot the pressures it is flowing towards.
+        ends = [self.exhaust_pa]
+        if pressurizer:
+            ends.append(self.supply_pa)
+        if new > pressure:
+            return min(new, max(ends))
+        return max(new, min(ends))
+
+    def _flow(self, conductance, outside, pressure):
+        # Mass flow into the chamber (negative when flowing out).
+        upstream, downstream = max(outside, pressure), min(outside, pressure)
+        if upstream <= 0 or upstream == downstream:
+            return 0.0
+        ratio = downstream / upstream
+        b = self.critical_ratio
+        if ratio <= b:
+            factor = 1.0
+        else:
+            factor = math.sqrt(max(0.0, 1 - ((ratio - b) / (1 - b)) ** 2))
+        flow = conductance * upstream * RHO_0 * factor
+        return flow if outside > pressure else -flow
@@ -0,0 +1,95 @@
+import threading
+import time
+
+"""
+Purpose: Clocks that code under test or simulation can use in place of
+    the time module. All clocks expose the same methods:
+        now(): current time in seconds.
+        sleep(seconds): wait for the given amount of clock time.
+"""
+
+
+class WallClock:
+    """
+    Purpose: The real clock. Reads time.time() and sleeps for real.
+    """
+    def now(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class VirtualClock:
+    """
+    Purpose: A clock that only moves when told to. sleep() advances the
+        clock instantly, so code can be run as fast as the CPU allows
+        while still seeing consistent timestamps.
+    start: Initial clock time, in seconds.
+    """
+    def __init__(self, start=0.0):
+        self._now = start
+        self._lock = threading.Lock()
+
+    def now(self):
+        return self._now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        if seconds < 0:
+            raise ValueError("VirtualClock cannot move backwards!")
+        with self._lock:
+            self._now += seconds
+            return self._now
+
+    def advance_to(self, timestamp):
+        with self._lock:
+            if timestamp > self._now:
+                self._now = timestamp
+            return self._now
+
+
+class ScaledClock:
+    """
+    Purpose: A clock running scale times faster than real time. sleep()
+        takes 1/scale of the requested time, so a simulated 10 minute
+        pressurization takes 10 s of wall time at scale=60.
+    scale: Clock seconds per real second.
+    start: Initial clock time, in seconds. Defaults to the current time.
+    """
+    def __init__(self, scale=1.0, start=None):
+        if scale <= 0:
+            raise ValueError("ScaledClock scale must be positive!")
+        self._lock = threading.Lock()
+        self._scale = scale
+        self._origin = time.time() if start is None else start
+        self._real_origin = time.monotonic()
+
+    @property
+    def scale(self):
+        return self._scale
+
+    @scale.setter
+    def scale(self, scale):
+        if scale <= 0:
+            raise ValueError("ScaledClock scale must be positive!")
+        # Re-anchor so the clock does not jump when the scale changes.
+        with self._lock:
+            self._origin = self._now()
+            self._real_origin = time.monotonic()
+            self._scale = scale
+
+    def now(self):
+        with self._lock:
+            return self._now()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self._scale)
+
+    def _now(self):
+        return self._origin + \
+            (time.monotonic() - self._real_origin) * self._scale
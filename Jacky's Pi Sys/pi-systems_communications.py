@@ -1,54 +1,124 @@
 from enum import Enum
-from threading import Lock
+from concurrent.futures import Future
+import heapq
+import itertools
 import struct
+import threading
+import time
+import importlib
+telemetry = importlib.import_module('pi-systems_telemetry-log')
+hardware = importlib.import_module('pi-systems_hardware')
+metrics = importlib.import_module('pi-systems_metrics')
+log = importlib.import_module('pi-systems_log')
 
 # pi-ststems_communications file enables the subsystem to use I2C methods
 # for data transfer between arduino and pi.
 
-try:
-    # Initialization needed for the class to run properly
-    __lock = Lock()
-    import smbus
-    import RPi.GPIO as gpio
-    # Static bus object
-    gpio.setmode(gpio.BCM)
-    __bus = smbus.SMBus(1)
-    # NOTE: for RPI version 1, use “__bus = smbus.SMBus(0)”
-except ModuleNotFoundError:
-    print("RPi not being used, skipping RPi imports...")
+# Static bus object. Simulated when not running on a Pi, see
+# pi-systems_hardware.py.
+hardware.GPIO.setmode(hardware.GPIO.BCM)
+__bus = hardware.open_bus(1)
+# NOTE: for RPI version 1, use “__bus = hardware.open_bus(0)”
+
+TRANSACTION_SECONDS = metrics.histogram(
+    "airlock_i2c_transaction_seconds",
+    "Time from queueing an I2C transaction to it leaving the bus.",
+    ["address", "kind"])
 
 
 class IntraModCommMessage:
+    """
+    Purpose: An intra-modular message backed by an immutable byte buffer.
+        Properties read straight from the buffer and payloads are decoded
+        with precompiled struct codecs, so decoding allocates nothing
+        beyond the values themselves.
+    raw_array: bytes, bytearray, memoryview or a list of byte values.
+        Lists (as returned by smbus) are copied into one bytes object.
+    """
+    __slots__ = ("_buffer",)
+
+    HIGH_BIT = 1 << 7
+    LOW_BITS = HIGH_BIT - 1
+
+    # Precompiled codecs, keyed by their struct format string.
+    _codecs = {}
+
     def __init__(self, raw_array):
-        self.raw_array = raw_array
+        if not isinstance(raw_array, (bytes, bytearray, memoryview)):
+            raw_array = bytes(raw_array)
+        self._buffer = raw_array
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def __bytes__(self):
+        return bytes(self._buffer)
+
+    def __repr__(self):
+        return "IntraModCommMessage(%s)" % (list(self._buffer))
+
+    @property
+    def raw_array(self):
+        # Read-only, zero-copy view over the message bytes.
+        return memoryview(self._buffer).toreadonly()
 
     @property
     def action(self):
         # Gets the action without the signed bit.
-        return self.raw_array[0] & ~(1 << 7)
+        return self._buffer[0] & IntraModCommMessage.LOW_BITS
 
     @property
     def is_response(self):
-        return (self.raw_array[0] >> 7) & 0b1
+        return (self._buffer[0] >> 7) & 0b1
 
     @property
     def procedure(self):
         # Gets the procedure byte without the signed bit.
-        return self.raw_array[1] & ~(1 << 7)
+        return self._buffer[1] & IntraModCommMessage.LOW_BITS
+
+    @property
+    def priority(self):
+        return self._buffer[2] if len(self._buffer) > 2 else 0
 
     @property
     def has_data(self):
         # Checks the high-bit of the procedure byte.
         # If set, more data is present.
-        return (self.raw_array[1] >> 7) & 0b1
+        return (self._buffer[1] >> 7) & 0b1
 
     @property
     def data(self):
         return self.raw_array[2:]
 
+    """
+    Return the precompiled struct.Struct for a format string, compiling
+    it on first use. Subsystems should keep the result (for example as a
+    class attribute per procedure) rather than pass format strings around.
+    """
+    @staticmethod
+    def codec(fmt):
+        codec = IntraModCommMessage._codecs.get(fmt)
+        if codec is None:
+            codec = IntraModCommMessage._codecs[fmt] = struct.Struct(fmt)
+        return codec
+
+    """
+    Decode the start of the message with a codec (or format string).
+    Raises ValueError if the message is too short, matching the
+    struct.error raised by struct.unpack.
+    """
+    def unpack(self, codec):
+        if not isinstance(codec, struct.Struct):
+            codec = IntraModCommMessage.codec(codec)
+        if len(self._buffer) < codec.size:
+            raise ValueError(
+                "message of %i bytes is too short for codec '%s' (%i bytes)"
+                % (len(self._buffer), codec.format, codec.size))
+        return codec.unpack_from(self._buffer)
+
     def validate(self):
         # Check if the specified action is a valid integer value.
-        if self.action not in set(a.value for a in IntraModCommAction):
+        if self.action not in _ACTION_VALUES:
             return False
 
         # TODO Implement this at a later date
@@ -62,8 +132,8 @@ class IntraModCommMessage:
 
     @staticmethod
     def generate(*, action=-1, procedure=-1, priority=0, data=None, is_response=False):
-        max_value = 1 << 7
-        high_bit = 1 << 7
+        max_value = IntraModCommMessage.HIGH_BIT
+        high_bit = IntraModCommMessage.HIGH_BIT
 
         if isinstance(action, IntraModCommAction):
             action = action.value
@@ -71,7 +141,7 @@ class IntraModCommMessage:
         if action > max_value:
             raise ValueError("action must not use the signing bit!")
 
-        if action not in set(action.value for action in IntraModCommAction):
+        if action not in _ACTION_VALUES:
             raise ValueError("specified action %i is not defined!" % (action))
 
         if is_response:
@@ -82,10 +152,12 @@ class IntraModCommMessage:
 
         if data is not None:
             procedure += high_bit
-
-        generated_message = [action, procedure, priority]
-        if data is not None:
-            generated_message.extend(data)
+            # Header and payload share a single allocation.
+            generated_message = bytearray(_HEADER.size + len(data))
+            generated_message[_HEADER.size:] = data
+        else:
+            generated_message = bytearray(_HEADER.size)
+        _HEADER.pack_into(generated_message, 0, action, procedure, priority)
 
         return IntraModCommMessage(generated_message)
 
@@ -97,38 +169,351 @@ class IntraModCommAction(Enum):
     Shutdown = 4
 
 
+# Lookup tables built once rather than on every validate()/generate().
+_ACTION_VALUES = frozenset(a.value for a in IntraModCommAction)
+# action, procedure and priority bytes shared by every message.
+_HEADER = IntraModCommMessage.codec('BBB')
+
+
+class I2CBusManager:
+    """
+    Purpose: Own the SMBus handle and serialize every transaction on it.
+        Callers queue read/write transactions and get a Future back; a
+        single thread drains the queue in priority order (highest first,
+        FIFO within a priority). A read identical to the last transaction
+        queued for its address is coalesced with it instead of being sent
+        twice; a read is never served across a write queued after it, and
+        writes are never coalesced. Throughput and latency are recorded
+        per address.
+        busy_since tells how long the transaction on the bus has been
+        running; reset() abandons one that hangs (see pi-systems_watchdog).
+    bus: An smbus.SMBus-like object (see pi-systems_hardware.py), or None
+        if no bus is available.
+    """
+
+    READ = "read"
+    WRITE = "write"
+
+    # Any non-zero priority byte is treated as an emergency.
+    PRIORITY_NORMAL = 0
+    PRIORITY_EMERGENCY = 1
+
+    class Transaction:
+        __slots__ = (
+            "kind", "address", "register", "data", "priority",
+            "futures", "enqueued", "done")
+
+        def __init__(self, kind, address, register, data, priority):
+            self.kind = kind
+            self.address = address
+            self.register = register
+            self.data = data
+            self.priority = priority
+            self.futures = [Future()]
+            self.enqueued = time.monotonic()
+            self.done = False
+
+        @property
+        def key(self):
+            return (self.kind, self.address, self.register, self.data)
+
+    class AddressStats:
+        __slots__ = (
+            "transactions", "bus_ops", "coalesced", "errors", "bytes",
+            "total_latency", "max_latency", "first", "last")
+
+        def __init__(self):
+            self.transactions = 0
+            self.bus_ops = 0
+            self.coalesced = 0
+            self.errors = 0
+            self.bytes = 0
+            self.total_latency = 0
+            self.max_latency = 0
+            self.first = None
+            self.last = None
+
+        def report(self):
+            elapsed = (self.last - self.first) if self.first else 0
+            return {
+                "transactions": self.transactions,
+                "bus_ops": self.bus_ops,
+                "coalesced": self.coalesced,
+                "errors": self.errors,
+                "bytes": self.bytes,
+                "mean_latency_ms": self.total_latency * 1000
+                / self.transactions if self.transactions else 0,
+                "max_latency_ms": self.max_latency * 1000,
+                "transactions_per_s":
+                    self.transactions / elapsed if elapsed else 0
+            }
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.running = False
+
+        self._queue = []
+        # Address: last transaction queued for it, until it is taken.
+        self._pending = {}
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._stats = {}
+        self._thread = None
+
+        # Transaction on the bus, and the time.monotonic() it started.
+        self.busy_since = None
+        self.resets = 0
+        self._current = None
+        # Bumped by reset(); a thread of an older generation was
+        # abandoned and must not touch the queue or the futures.
+        self._generation = 0
+
+    def submit_read(self, address, register, priority=PRIORITY_NORMAL):
+        return self._submit(
+            I2CBusManager.READ, address, register, None, priority)
+
+    def submit_write(self, address, cmd, data, priority=PRIORITY_NORMAL):
+        return self._submit(
+            I2CBusManager.WRITE, address, cmd, bytes(data), priority)
+
+    def start(self):
+        with self._cond:
+            if self.running:
+                return
+            self.running = True
+            self._thread = threading.Thread(
+                name="i2c-bus-manager",
+                target=self._run,
+                args=(self._generation,),
+                daemon=True)
+            self._thread.start()
+
+    """
+    Stop the bus thread once the transaction on the bus is done. The
+    transactions still queued fail with RuntimeError, so no caller is
+    left waiting on them; a later submit starts the thread again.
+    """
+    def stop(self):
+        with self._cond:
+            self.running = False
+            queued = [entry[2] for entry in self._queue
+                      if not entry[2].done]
+            for transaction in queued:
+                transaction.done = True
+            self._queue = []
+            self._pending = {}
+            self._cond.notify()
+
+        error = RuntimeError("The I2C bus manager was stopped")
+        for transaction in queued:
+            I2CBusManager._resolve(transaction.futures, error=error)
+
+    """
+    Switch to a fresh bus handle. A transaction hung on the old one is
+    abandoned (its futures fail with TimeoutError, unblocking the loops
+    waiting on it) along with the thread running it, and a new thread
+    carries on with the queue. Returns the abandoned transaction, or None.
+    """
+    def reset(self, bus):
+        with self._cond:
+            self._generation += 1
+            self.bus = bus
+            self.resets += 1
+            stuck, self._current = self._current, None
+            self.busy_since = None
+            running, self.running = self.running, False
+            if stuck is not None:
+                self._address_stats(stuck.address).errors += 1
+            self._cond.notify_all()
+        if running:
+            self.start()
+
+        if stuck is not None:
+            error = TimeoutError(
+                "I2C %s at address %s was abandoned by a bus reset"
+                % (stuck.kind, stuck.address))
+            I2CBusManager._resolve(stuck.futures, error=error)
+        return stuck
+
+    def stats(self):
+        with self._cond:
+            return {
+                address: stats.report()
+                for address, stats in self._stats.items()
+            }
+
+    def _submit(self, kind, address, register, data, priority):
+        transaction = I2CBusManager.Transaction(
+            kind, address, register, data, priority)
+
+        with self._cond:
+            queued = self._pending.get(address)
+            if kind is I2CBusManager.READ and queued is not None \
+                    and queued.key == transaction.key:
+                # Share the queued transaction rather than repeat it.
+                future = transaction.futures[0]
+                queued.futures.append(future)
+                self._address_stats(address).coalesced += 1
+                if priority > queued.priority:
+                    # Re-queue at the higher priority; the old heap
+                    # entry is skipped once the transaction is done.
+                    queued.priority = priority
+                    self._push(queued)
+                return future
+
+            self._pending[address] = transaction
+            self._push(transaction)
+            self._cond.notify()
+
+        if not self.running:
+            self.start()
+        return transaction.futures[0]
+
+    def _push(self, transaction):
+        heapq.heappush(
+            self._queue,
+            (-transaction.priority, next(self._counter), transaction))
+
+    def _address_stats(self, address):
+        stats = self._stats.get(address)
+        if stats is None:
+            stats = self._stats[address] = I2CBusManager.AddressStats()
+        return stats
+
+    def _run(self, generation):
+        while True:
+            with self._cond:
+                while self.running and not self._queue \
+                        and generation == self._generation:
+                    self._cond.wait()
+                if not self.running or generation != self._generation:
+                    return
+
+                _, _, transaction = heapq.heappop(self._queue)
+                if transaction.done:
+                    continue
+                transaction.done = True
+                if self._pending.get(transaction.address) is transaction:
+                    del self._pending[transaction.address]
+                self._current = transaction
+                self.busy_since = time.monotonic()
+
+            result, error = None, None
+            try:
+                result = self._execute(transaction)
+            except Exception as e:
+                error = e
+            finished = time.monotonic()
+
+            if error is None:
+                if transaction.kind is I2CBusManager.READ:
+                    telemetry.record_i2c(
+                        telemetry.I2CDirection.Read, transaction.address,
+                        transaction.register, result)
+                else:
+                    telemetry.record_i2c(
+                        telemetry.I2CDirection.Write, transaction.address,
+                        transaction.register, transaction.data)
+
+            with self._cond:
+                if generation != self._generation:
+                    return  # Abandoned by reset() while on the bus.
+                self._current = None
+                self.busy_since = None
+                stats = self._address_stats(transaction.address)
+                latency = finished - transaction.enqueued
+                stats.transactions += len(transaction.futures)
+                stats.bus_ops += 1
+                stats.total_latency += latency * len(transaction.futures)
+                stats.max_latency = max(stats.max_latency, latency)
+                stats.first = stats.first or transaction.enqueued
+                stats.last = finished
+                if error is not None:
+                    stats.errors += 1
+                elif transaction.kind is I2CBusManager.READ:
+                    stats.bytes += len(result or ())
+                else:
+                    stats.bytes += len(transaction.data) + 1
+            if metrics.enabled:
+                TRANSACTION_SECONDS.labels(
+                    str(transaction.address), transaction.kind
+                ).observe(latency)
+
+            I2CBusManager._resolve(transaction.futures, result, error)
+
+    """
+    Resolve the futures of a transaction, skipping those a caller has
+    cancelled (or that are already resolved): resolving them again would
+    raise InvalidStateError and kill the bus thread.
+    """
+    @staticmethod
+    def _resolve(futures, result=None, error=None):
+        for future in futures:
+            try:
+                if not future.set_running_or_notify_cancel():
+                    continue  # Cancelled.
+            except RuntimeError:
+                continue  # Already running or resolved.
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _execute(self, transaction):
+        if self.bus is None:
+            raise RuntimeError("No I2C bus is available on this machine!")
+
+        if transaction.kind is I2CBusManager.READ:
+            return self.bus.read_i2c_block_data(
+                transaction.address, transaction.register)
+
+        self.bus.write_i2c_block_data(
+            transaction.address,
+            transaction.register,
+            list(transaction.data))
+
+
+bus_manager = I2CBusManager(__bus)
+
+
 # WRITING
-def intra_write(address, message):
-    if isinstance(message, IntraModCommMessage):
-        message = message.raw_array
+"""
+Queue a write and return a Future resolved once it is on the bus.
+If no priority is given, the priority byte of the message is used, so
+emergency messages jump the queue.
+"""
+def intra_write_async(address, message, priority=None):
+    if not isinstance(message, IntraModCommMessage):
+        message = IntraModCommMessage(message)
 
-    cmd, data = message.pop(0), message
-    global __bus
-    global __lock
-    with __lock:
-        pass
-        __bus.write_i2c_block_data(address, cmd, data)
-    # for byte in message:
-        # __bus.write_byte(address, ord(byte))
-        # time.sleep(1)
+    if priority is None:
+        priority = message.priority
+
+    # Slicing the view leaves the caller's message untouched.
+    view = message.raw_array
+    return bus_manager.submit_write(address, view[0], view[1:], priority)
+
+
+def intra_write(address, message, priority=None):
+    intra_write_async(address, message, priority).result()
 
 
 # READING
-def intra_read(address, procedure):
+"""
+Queue a read and return a Future resolved with the raw response list.
+"""
+def intra_read_async(address, procedure, priority=0):
     if not isinstance(procedure, int):
         raise TypeError('rocedure value provided is not an integer!')
-    global __lock
-    global __bus
-    with __lock:
-        pass
-        msg = __bus.read_i2c_block_data(address, procedure)
-    # for index in range(93):
-    #     num = __bus.read_byte(address)
-    #     if num:
-    #         msg.append(num)
+    return bus_manager.submit_read(address, procedure, priority)
+
+
+def intra_read(address, procedure, priority=0):
+    msg = intra_read_async(address, procedure, priority).result()
 
     if not msg:
-        print('I2C message expected but not read. Discarding')
+        log.w("i2c", "I2C message expected but not read from %s. "
+              "Discarding", address)
         return
 
     message = IntraModCommMessage(msg)
@@ -137,6 +522,44 @@ def intra_read(address, procedure):
         return message
 
 
+def bus_stats():
+    return bus_manager.stats()
+
+
+"""
+Give the bus manager a fresh bus handle from the hardware backend,
+abandoning any transaction hung on the current one.
+"""
+def reset_bus():
+    return bus_manager.reset(hardware.open_bus(1))
+
+
+"""
+Counts of the bus manager, per address, read when the metrics are
+scraped.
+"""
+def _collect_metrics():
+    reports = bus_manager.stats()
+    families = [
+        ("transactions", "Transactions requested, coalesced ones included."),
+        ("bus_ops", "Transactions put on the bus."),
+        ("coalesced", "Requests served by a transaction already queued."),
+        ("errors", "Transactions that failed."),
+        ("bytes", "Bytes transferred.")
+    ]
+    return [
+        ("airlock_i2c_%s_total" % field, "counter", help,
+         [({"address": str(address)}, report[field])
+          for address, report in reports.items()])
+        for field, help in families
+    ] + [("airlock_i2c_resets_total", "counter",
+          "Bus handles replaced by reset_bus().",
+          [({}, bus_manager.resets)])]
+
+
+metrics.register_collector(_collect_metrics)
+
+
 # IF NO VALID SENSOR DATA RECEIVED,
 # ACCEPT EXCEPTION AS "SENSORS ARE OFF SO DONT CRASH PLS"
 
@@ -1,9 +1,10 @@
 import importlib
 from enum import Enum
 from struct import Struct
-import RPi.GPIO as GPIO
 import time
 
+hardware = importlib.import_module('pi-systems_hardware')
+GPIO = hardware.GPIO
 subsys = importlib.import_module('pi-systems_subsystem-base')
 comms = importlib.import_module('pi-systems_communications')
 door_ss = importlib.import_module('pi-systems_door-subsystem')
@@ -1,7 +1,17 @@
 import importlib
+import time
+from collections import namedtuple
+from concurrent.futures import Future
 from enum import IntEnum
 subsys = importlib.import_module('pi-systems_subsystem-base')
 comms = importlib.import_module('pi-systems_communications')
+schemas = importlib.import_module('pi-systems_payload-schemas')
+reconciler = importlib.import_module('pi-systems_reconciler')
+log = importlib.import_module('pi-systems_log')
+
+# Door state last read from the Arduino, published whole by the loop.
+# timestamp is None until the first reading.
+DoorReading = namedtuple("DoorReading", ["door_state", "angle", "timestamp"])
 
 
 class DoorSubsystem(subsys.Subsystem):
@@ -23,60 +33,150 @@ class DoorSubsystem(subsys.Subsystem):
         doorIsClosed = 0
         doorInTransit = 1
 
-    def __init__(self, name=None, thread_id=None, address=None):
-        super().__init__(name=name, thread_id=thread_id, loop_delay_ms=5000)
-
+    # SetDoorState_t targetState for each Procedure the DoorFSM asks for.
+    # Idle and Emergency send nothing: the door stays where it is.
+    TARGETS = {
+        'OpenDoor': DoorState.open,
+        'CloseDoor': DoorState.close,
+        'Idle': None,
+        'Emergency': None
+    }
+
+    # The DoorFSM assigns desired_state = 'OpenDoor' etc. on every pass;
+    # that only publishes the desired door state, which the loop sends when
+    # it changes (see pi-systems_reconciler.py).
+    desired_state = reconciler.DesiredState(TARGETS)
+
+    """
+    loop_delay_ms: Period of the loop, and of the door state polling,
+        while the door is where it was asked to be.
+    moving_poll_ms: Period while it is not, so the DoorFSM sees the door
+        arrive soon after it does.
+    """
+    def __init__(self, name=None, thread_id=None, address=None,
+                 loop_delay_ms=5000, moving_poll_ms=200):
+        super().__init__(name=name, thread_id=thread_id,
+                         loop_delay_ms=loop_delay_ms)
+
+        self.idle_poll_ms = loop_delay_ms
+        self.moving_poll_ms = moving_poll_ms
+        # Latest door state. Replaced, never modified, by the loop, so the
+        # FSM supervisor reads it without waiting on the bus.
+        self.door_reading = DoorReading(DoorSubsystem.DoorState.unknown,
+                                        0, None)
         self.new_state = None
+        # Future of the request in new_state, and when it was made.
+        self._request = None
         self.address = address
+        self.reconciler = reconciler.Reconciler(
+            self._send_target, on_desire=self.notify, name=name)
+        # Shared by the requests and the DoorFSM's targets.
+        self.command_latency = self.reconciler.command_latency
+        schemas.register(address, DoorSubsystem.Procedure.getDoorState,
+                         schemas.DOOR_STATE)
+        schemas.register(address, DoorSubsystem.Procedure.setDoorState,
+                         schemas.SET_DOOR_STATE)
 
     def loop(self):
+        self.reconciler.reconcile()
+        self._send_request()
+        self._poll_door_state()
+
+    """
+    True once the last door state read is the one the DoorFSM asked for.
+    Never waits on the bus.
+    """
+    @property
+    def in_position(self):
+        desired = self.reconciler.desired
+        return desired is not None and \
+            self.door_reading.door_state == desired
+
+    def _send_request(self):
         with self.lock:
-            if self.new_state is not None:
-                print("Door state updating (%s)" %
-                      (self.Procedure(self.new_state).name))
-
-                # Check sensors and things
-
-                comms.intra_write(self.address,
-                                  comms.generate
-                                  (action=comms.IntraModCommAction.
-                                   ExecuteProcedure, procedure=self.new_state))
-
-                self.new_state = None
+            new_state, self.new_state = self.new_state, None
+            request, self._request = self._request, None
+        if new_state is None:
+            return
+
+        log.d(self.name, "Door state updating (%s)",
+              DoorSubsystem.Procedure(new_state).name)
+
+        # Check sensors and things
+
+        # Sent outside the lock, so requests are never held up by the bus.
+        future, requested_at = request or (Future(), time.monotonic())
+        try:
+            comms.intra_write(self.address,
+                              comms.IntraModCommMessage.generate
+                              (action=comms.IntraModCommAction.
+                               ExecuteProcedure, procedure=new_state))
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        self.command_latency.record(time.monotonic() - requested_at)
+        future.set_result(new_state)
+
+    def _poll_door_state(self):
+        door_state, angle = self.get_current_door_state()
+        self.door_reading = DoorReading(door_state, angle, time.monotonic())
+
+        moving = self.reconciler.desired is not None and not self.in_position
+        poll_ms = self.moving_poll_ms if moving else self.idle_poll_ms
+        if self.thread.loop_delay_ms != poll_ms:
+            self.thread.set_loop_delay(poll_ms)
+
+    def _send_target(self, target):
+        priority = 1 if vars(self).get('priority') == 'high' else 0
+        message = comms.IntraModCommMessage.generate(
+            action=comms.IntraModCommAction.ExecuteProcedure,
+            procedure=DoorSubsystem.Procedure.setDoorState,
+            priority=priority,
+            data=schemas.SET_DOOR_STATE.encode_payload(target.value))
+        comms.intra_write(self.address, message)
 
     # function to get current door state from door control arduino using I2C
     # return: doorState and doorAngle as a tuple
+    # Waits on the bus; other threads read door_reading instead.
     def get_current_door_state(self):
         doorStateRaw = comms.intra_read(self.address,
-                                        self.Procedure.getDoorState.value)
-        # March9doorcontrol_I2C.ino struct returns 4 bytes and a short struct
-        doorStateVals = struct.unpack('cccch', bytes(doorStateRaw.raw_array[
-                                      0:struct.calcsize('cccch')]))
-
-        doorState = doorStateVals[3]
-        doorAngle = doorStateVals[4]
+                                        DoorSubsystem.Procedure.getDoorState.value)
+        # March9doorcontrol_I2C.ino GetDoorState_t, see DOOR_STATE schema
+        doorStateVals = schemas.decode(
+            self.address, DoorSubsystem.Procedure.getDoorState, doorStateRaw)
 
-        return doorState, doorAngle
+        return doorStateVals.door_state, doorStateVals.angle
 
     #add calibrate message to be sent to doorcontrol
     #def calibrateDoor(self):
     #   comms.intra_write(self.address, )
 
     # other subsystems use this function to get the door subsys to get
-    # the door state form the arduino controller through I2C on the loop
+    # the door state form the arduino controller through I2C on the loop.
+    # The loop is woken right away. Returns a Future resolved once the
+    # Arduino has acknowledged the request, or cancelled if another
+    # request replaces it first.
     def request_door_state(self, state=None):
         if not state:
             raise TypeError("Door state must be an integer defined in DoorSubsystem.Procedure")
 
         if not isinstance(state, int):
-            if isinstance(state, self.Procedure):
+            if isinstance(state, DoorSubsystem.Procedure):
                 state = state.value
             else:
                 raise TypeError("Door state must be an integer or alias defined by DoorSubsystem.Procedure")
 
-        if state not in set(p.value for p in self.Procedure):
+        if state not in set(p.value for p in DoorSubsystem.Procedure):
             raise ValueError("Door state must be defined in DoorSubsystem.Procedure")
 
-        self.new_state = state
-
-        print("Door state requested: %s" % (self.Procedure(state).name))
+        future = Future()
+        with self.lock:
+            if self._request is not None:
+                self._request[0].cancel()
+            self.new_state = state
+            self._request = (future, time.monotonic())
+        self.notify()
+
+        log.d(self.name, "Door state requested: %s",
+              DoorSubsystem.Procedure(state).name)
+        return future
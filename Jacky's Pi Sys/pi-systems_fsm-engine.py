@@ -0,0 +1,207 @@
+"""
+Purpose: Table-driven finite state machines for the airlock FSMs.
+    A drop-in for the parts of python-statemachine that
+    pi-systems-defn-FSMs.py uses, declared the same way:
+
+        class DoorFSM(StateMachine):
+            idle = State("Idle", initial=True)
+            door_open = State("Open")
+
+            start_open = idle.to(door_open)
+            keep_opening = door_open.to(door_open)
+
+            def on_start_open(self, airlock_door_ss):
+                ...
+
+    When the class is created its states are numbered in the order they
+    are declared and every event is compiled to a tuple indexed by state
+    number that holds the number of the target state (or -1 if the event
+    is not allowed there). Firing an event is one tuple lookup and a call
+    to its on_<event> callback with the arguments of the event. No
+    listeners, no argument injection, no per-call dispatch.
+
+    Self-loops (keep_idling, keep_pressurize, ...) are fired on every
+    pass of the control loop and their callbacks only re-assert what the
+    same call asserted last time. When a self-loop is fired again with the
+    same arguments and nothing else has happened to the machine since,
+    its callback is skipped. If something outside the machine may have
+    changed what the callback asserts, call invalidate() and the next
+    self-loop runs its callback again. Set elide_self_loops = False on the
+    class or the instance to always run it.
+"""
+
+
+class TransitionNotAllowed(Exception):
+    def __init__(self, event, state):
+        self.event = event
+        self.state = state
+        super().__init__("Can't %s when in %s." % (event, state.name))
+
+
+class State:
+    """
+    name: Name reported by current_state.name.
+    initial: The machine starts in this state. Exactly one per machine.
+    """
+    __slots__ = ("name", "initial", "id", "value")
+
+    def __init__(self, name, initial=False):
+        self.name = name
+        self.initial = initial
+        # Set when the machine class is compiled.
+        self.id = None
+        self.value = None
+
+    def __repr__(self):
+        return "State (name=%s, id=%s)" % (self.name, self.id)
+
+    def to(self, target):
+        return Transitions([(self, target)])
+
+
+class Transitions:
+    """
+    Purpose: The (source, target) pairs of one event, as returned by
+        State.to(). Pairs of several sources are combined with |.
+    """
+    __slots__ = ("pairs",)
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+    def __or__(self, other):
+        return Transitions(self.pairs + other.pairs)
+
+
+class StateMachine:
+    """
+    Purpose: Base class of the compiled machines. Subclasses declare State
+        and Transitions attributes, which are replaced by event methods.
+    Class attributes set when compiled:
+        states: Tuple of the States, indexed by State.id
+        events: Tuple of the event names, indexed by event id
+    """
+    elide_self_loops = True
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        _compile(cls)
+
+    def __init__(self):
+        self._state = self._initial
+        self._last_loop = None
+        # Callbacks are bound here rather than when compiling, so class
+        # decorators that wrap on_<event> (telemetry) are picked up.
+        self._callbacks = tuple(
+            getattr(self, "on_" + event, None) for event in self.events)
+        self.stats = {"transitions": 0, "elided": 0}
+
+    def __repr__(self):
+        return "%s (state=%s)" % (type(self).__name__, self.current_state.name)
+
+    @property
+    def current_state(self):
+        return self.states[self._state]
+
+    @property
+    def current_state_value(self):
+        return self.states[self._state].value
+
+    """
+    Fire an event by name.
+    """
+    def send(self, event, *args, **kwargs):
+        return self._fire(self._event_ids[event], args, kwargs)
+
+    """
+    Events that can be fired from the current state.
+    """
+    @property
+    def allowed_events(self):
+        return [event for event, row in zip(self.events, self._table)
+                if row[self._state] >= 0]
+
+    """
+    Run the callback of the next self-loop even if it repeats the last
+    one, e.g. because what it asserted was changed from outside.
+    """
+    def invalidate(self):
+        self._last_loop = None
+
+    """
+    State an event leads to from the current state. Raises
+    TransitionNotAllowed if it is not allowed there.
+    """
+    def target_of(self, event):
+        target = self._table[self._event_ids[event]][self._state]
+        if target < 0:
+            raise TransitionNotAllowed(event, self.current_state)
+        return self.states[target]
+
+    def _fire(self, event, args, kwargs):
+        source = self._state
+        target = self._table[event][source]
+        if target < 0:
+            raise TransitionNotAllowed(self.events[event], self.states[source])
+
+        callback = self._callbacks[event]
+        if source == target:
+            call = (event, args, kwargs)
+            if self.elide_self_loops and call == self._last_loop:
+                self.stats["elided"] += 1
+                return None
+            self.stats["transitions"] += 1
+            result = callback(*args, **kwargs) if callback else None
+            self._last_loop = call
+            return result
+
+        self.stats["transitions"] += 1
+        self._last_loop = None
+        result = callback(*args, **kwargs) if callback else None
+        self._state = target
+        return result
+
+
+def _compile(cls):
+    declared = [(name, value) for name, value in vars(cls).items()
+                if isinstance(value, (State, Transitions))]
+    states = []
+    events = []
+    for name, value in declared:
+        if isinstance(value, State):
+            value.id = len(states)
+            value.value = name
+            states.append(value)
+        else:
+            events.append((name, value))
+    if not states:
+        return  # Abstract intermediate class.
+
+    initial = [state for state in states if state.initial]
+    if len(initial) != 1:
+        raise ValueError("%s must have exactly one initial state!"
+                         % cls.__name__)
+
+    table = []
+    for number, (name, transitions) in enumerate(events):
+        row = [-1] * len(states)
+        for source, target in transitions.pairs:
+            if source.id is None or target.id is None:
+                raise ValueError("%s.%s uses a state of another machine!"
+                                 % (cls.__name__, name))
+            row[source.id] = target.id
+        table.append(tuple(row))
+        setattr(cls, name, _event_method(name, number))
+
+    cls.states = tuple(states)
+    cls.events = tuple(name for name, _ in events)
+    cls._event_ids = {name: number for number, name in enumerate(cls.events)}
+    cls._table = tuple(table)
+    cls._initial = initial[0].id
+
+
+def _event_method(name, number):
+    def event(self, *args, **kwargs):
+        return self._fire(number, args, kwargs)
+    event.__name__ = name
+    return event
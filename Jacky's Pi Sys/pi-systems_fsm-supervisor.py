@@ -0,0 +1,382 @@
+import threading
+import time
+import importlib
+FSM = importlib.import_module('pi-systems-defn-FSMs')
+metrics = importlib.import_module('pi-systems_metrics')
+log = importlib.import_module('pi-systems_log')
+
+"""
+Purpose: Run the PressureFSM, DoorFSM and LightFSM together without
+    blocking.
+
+    loop_FSMs used to wait inside the FSM it was serving: while pressurizing
+    it spun in "while pressure < target", and while paused in
+    "while H is pressed", so the door and lights were not handled and the
+    emergency button was only seen by whichever loop happened to be
+    running. The supervisor instead ticks: every tick takes one snapshot
+    of the inputs, the pressure and the door position, and fires at most
+    one event on each FSM, with the emergency checked first by all of them.
+    Nothing in a tick waits: the pressure and the door position are the
+    values last published by the sensor and door subsystems. So the
+    emergency button always reaches every FSM within one tick. An FSM
+    step that raises is logged and counted in stats, and the other FSMs
+    are still stepped.
+
+    Ticks are run by a thread that sleeps until it is woken by an input
+    change (set_input, or the on_change callbacks of attached
+    InputComponents), a sensor update (wake) or, as a safety net, every
+    tick_s. After being woken it ticks until no FSM changes state.
+    tick() and settle() can also be called directly, which is how
+    pi-systems_replay.py drives it on a virtual clock.
+"""
+
+ON = 1
+OFF = 0
+
+# Input names and their idle states. E is active low.
+INPUT_DEFAULTS = {
+    'E': 1,
+    'P': 0,
+    'D': 0,
+    'L': 0,
+    'O': 0,
+    'Cl': 0,
+    'Enable P/D/H': 0,
+    'H': 0,
+    'C': 0
+}
+
+# Order of the inputs list used by loop_FSMs.
+INPUT_ORDER = ['E', 'P', 'D', 'L', 'O', 'Cl', 'Enable P/D/H', 'H', 'C']
+
+LED_NAMES = [
+    'Pressurized LED',
+    'In Progress LED',
+    'Depressurized LED',
+    'SPST Active LED',
+    'Confirm LED',
+    'Emergency LED',
+    'Hold LED'
+]
+
+TRANSITIONS = metrics.counter(
+    "airlock_fsm_transitions_total",
+    "Events fired on the airlock FSMs, self-loops included.",
+    ["fsm", "event"])
+
+# Integer target pressures, hPa.
+TARGET_PRESSURE = 1013  # Earth atmosphere roughly 101.3kPa
+TARGET_DEPRESSURE = 6   # Martian Atmosphere 600 Pascals
+
+
+class FSMSupervisor:
+    """
+    pressure_ss: PressureSubsystem (or anything with desired_state and
+        priority) driven by the PressureFSM.
+    door_ss: DoorSubsystem (or anything with desired_state and priority)
+        driven by the DoorFSM.
+    light_ss: LightingSubsystem toggled by the LightFSM. The LightFSM is
+        not stepped if None.
+    leds: The outputs, in LED_NAMES order.
+    read_pressure: Callable returning the chamber pressure in hPa, or None
+        while it is unknown.
+    target_reached: Callable returning whether the pressure target of the
+        current cycle has been reached, or None to compare read_pressure
+        with TARGET_PRESSURE / TARGET_DEPRESSURE instead. Defaults to
+        pressure_ss.target_reached if it has one (the PressureController).
+    door_in_position: Callable returning True once the door has reached
+        the position of its current Procedure. Only called while the door
+        is opening or closing, from the tick, so it must not wait on the
+        bus. Defaults to door_ss.in_position.
+    tick_s: Longest time between ticks when nothing wakes the supervisor.
+    on_transition: Callable (fsm_name, event, source, target) invoked
+        for every event fired.
+    """
+    def __init__(
+        self,
+        pressure_ss,
+        door_ss,
+        light_ss=None,
+        leds=None,
+        read_pressure=None,
+        door_in_position=None,
+        target_reached=None,
+        tick_s=0.1,
+        on_transition=None
+    ):
+        self.pressure_ss = pressure_ss
+        self.door_ss = door_ss
+        self.light_ss = light_ss
+        self.leds = leds
+        self.read_pressure = read_pressure or (lambda: None)
+        self.door_in_position = door_in_position or \
+            (lambda: getattr(door_ss, 'in_position', False))
+        self.target_reached = target_reached or \
+            getattr(pressure_ss, 'target_reached', None) or (lambda: None)
+        self.tick_s = tick_s
+        self.on_transition = on_transition
+
+        self.fsm_pressure = FSM.PressureFSM()
+        self.fsm_door = FSM.DoorFSM()
+        self.fsm_lights = FSM.LightFSM()
+        self.inputs = dict(INPUT_DEFAULTS)
+        self._paused = None
+
+        self._wake = threading.Event()
+        self._thread = None
+        self._running = False
+
+        self.ticks = 0
+        self.errors = 0
+        # desired_state of each FSM's subsystem after its last event.
+        self._published = {}
+        self._max_tick = 0
+        # perf_counter() of the emergency press not yet handled by a tick.
+        self._emergency_at = None
+        self._emergency = {"count": 0, "total": 0, "max": 0}
+
+    def __repr__(self):
+        return "FSMSupervisor (pressure=%s, door=%s, lights=%s)" % (
+            self.fsm_pressure.current_state.name,
+            self.fsm_door.current_state.name,
+            self.fsm_lights.current_state.name)
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(
+            name="fsm-supervisor", target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        self._wake.set()
+        self._thread.join()
+
+    """
+    Have the supervisor tick as soon as possible. Safe to call from any
+    thread, e.g. as the on_loop callback of the SensorSubsystem.
+    """
+    def wake(self):
+        self._wake.set()
+
+    def set_input(self, name, state):
+        if name not in self.inputs:
+            return
+        if name == 'E' and state == 0 and self.inputs['E'] != 0 \
+                and self._emergency_at is None:
+            self._emergency_at = time.perf_counter()
+        self.inputs[name] = state
+        self._wake.set()
+
+    """
+    Follow the inputs of loop_FSMs: either InputComponents, whose changes
+    are then pushed to set_input, or a list of plain states in INPUT_ORDER
+    (for debugging without an interface).
+    """
+    def attach_inputs(self, inputs):
+        for name, component in zip(INPUT_ORDER, inputs):
+            if hasattr(component, 'attach_callback'):
+                component.attach_callback(
+                    lambda state, name=component.name:
+                        self.set_input(name, state),
+                    (id(self), component.name))
+                self.set_input(component.name, component.state)
+            else:
+                self.set_input(name, component)
+
+    """
+    Tick until no FSM changes state. Returns the number of ticks.
+    """
+    def settle(self, max_ticks=16):
+        for ticks in range(1, max_ticks + 1):
+            if not self.tick():
+                return ticks
+        return max_ticks
+
+    """
+    Step every FSM once from one snapshot of the inputs. Returns True if
+    any FSM changed state.
+    """
+    def tick(self):
+        started = time.perf_counter()
+        emergency_at = self._emergency_at
+        inputs = dict(self.inputs)
+
+        changed = False
+        steps = [self._step_pressure, self._step_door]
+        if self.light_ss is not None:
+            steps.append(self._step_lights)
+        for step in steps:
+            # One failing FSM must not keep the others from their step,
+            # least of all from the emergency.
+            try:
+                changed = step(inputs) or changed
+            except Exception as e:
+                self.errors += 1
+                log.e("fsm-supervisor", "%s failed: %s", step.__name__, e)
+        if self.leds:
+            self.leds[3].write(ON if inputs['Enable P/D/H'] == 1 else OFF)
+            self.leds[4].write(ON if inputs['C'] == 1 else OFF)
+
+        done = time.perf_counter()
+        self.ticks += 1
+        self._max_tick = max(self._max_tick, done - started)
+        if emergency_at is not None and inputs['E'] != 0:
+            self._emergency_at = None  # Released before it was handled.
+        elif emergency_at is not None and self.in_emergency:
+            self._emergency_at = None
+            latency = done - emergency_at
+            self._emergency["count"] += 1
+            self._emergency["total"] += latency
+            self._emergency["max"] = max(self._emergency["max"], latency)
+        return changed
+
+    """
+    True once the PressureFSM and the DoorFSM are both in Emergency.
+    """
+    @property
+    def in_emergency(self):
+        return self.fsm_pressure.current_state.name == 'Emergency' and \
+            self.fsm_door.current_state.name == 'Emergency'
+
+    """
+    Time from the emergency button being pressed to the end of the tick
+    that left every FSM in Emergency, the longest tick, and the FSM steps
+    that raised.
+    """
+    @property
+    def stats(self):
+        count = self._emergency["count"]
+        return {
+            "ticks": self.ticks,
+            "errors": self.errors,
+            "max_tick_ms": self._max_tick * 1000,
+            "emergencies": count,
+            "mean_emergency_latency_ms":
+                self._emergency["total"] * 1000 / count if count else 0,
+            "max_emergency_latency_ms": self._emergency["max"] * 1000
+        }
+
+    def _run(self):
+        while self._running:
+            self._wake.wait(self.tick_s)
+            self._wake.clear()
+            if not self._running:
+                return
+            try:
+                self.settle()
+            except Exception as e:
+                self.errors += 1
+                log.e("fsm-supervisor", "Tick failed: %s", e)
+
+    # -----------------------------------------------------------------------
+    # One step of each FSM, with the decisions of the old loop_FSMs.
+    # -----------------------------------------------------------------------
+    def _step_pressure(self, inputs):
+        fsm = self.fsm_pressure
+        ss, leds = self.pressure_ss, self.leds
+        state = fsm.current_state.name
+
+        # NOTE EMERG LOGIC IS ACTIVE LOW
+        if inputs['E'] == 0:
+            event = {
+                'idle': 'detected_emerg_3',
+                'pressurize': 'detected_emerg_1',
+                'depressurize': 'detected_emerg_2',
+                'pause': 'detected_emerg_4',
+                'Emergency': 'emerg_unresolved'
+            }[state]
+            return self._fire(fsm, event, ss, leds)
+
+        if state == 'Emergency':
+            return self._fire(fsm, 'emerg_unresolved', ss, leds)
+
+        if state == 'idle':
+            if inputs['Enable P/D/H'] == 1 and inputs['P'] == 1:
+                return self._fire(fsm, 'start_pressurize', ss, leds)
+            if inputs['Enable P/D/H'] == 1 and inputs['D'] == 1:
+                return self._fire(fsm, 'start_depressurize', ss, leds)
+            return self._fire(fsm, 'keep_idling', ss)
+
+        if state == 'pause':
+            if inputs['H'] == 1:
+                return self._fire(fsm, 'keep_pausing', ss)
+            return self._fire(fsm, self._paused, ss, leds)
+
+        # Pressurizing or depressurizing.
+        pressurizing = state == 'pressurize'
+        suffix = 'press' if pressurizing else 'depress'
+        if inputs['H'] == 1:
+            self._paused = 'resume_' + suffix
+            return self._fire(fsm, 'pause_' + suffix, ss, leds)
+        reached = self.target_reached()
+        if reached is None:
+            pressure = self.read_pressure()
+            reached = pressure is not None and (
+                pressure >= TARGET_PRESSURE if pressurizing
+                else pressure <= TARGET_DEPRESSURE)
+        if reached:
+            return self._fire(fsm, 'done_' + state, ss, leds)
+        return self._fire(fsm, 'keep_' + state, ss, leds)
+
+    def _step_door(self, inputs):
+        fsm = self.fsm_door
+        ss = self.door_ss
+        state = fsm.current_state.name
+
+        if inputs['E'] == 0:
+            event = {
+                'Idle': 'detected_emerg_3',
+                'Open': 'detected_emerg_1',
+                'Close': 'detected_emerg_2',
+                'Emergency': 'emerg_unresolved'
+            }[state]
+            return self._fire(fsm, event, ss)
+
+        if state == 'Emergency':
+            return self._fire(fsm, 'emerg_unresolved', ss)
+        if state == 'Idle':
+            if inputs['O'] == 1:
+                return self._fire(fsm, 'start_open', ss)
+            if inputs['Cl'] == 1:
+                return self._fire(fsm, 'start_close', ss)
+            return self._fire(fsm, 'keep_idling', ss)
+        if state == 'Open':
+            if self.door_in_position():
+                return self._fire(fsm, 'done_open', ss)
+            return self._fire(fsm, 'keep_opening', ss)
+        if self.door_in_position():
+            return self._fire(fsm, 'done_close', ss)
+        return self._fire(fsm, 'keep_closing', ss)
+
+    def _step_lights(self, inputs):
+        fsm = self.fsm_lights
+        state = fsm.current_state.name
+        if inputs['L'] == 1 and state == 'OFF':
+            return self._fire(fsm, 'turn_on', self.light_ss)
+        if inputs['L'] == 0 and state == 'ON':
+            return self._fire(fsm, 'turn_off', self.light_ss)
+        return False
+
+    def _fire(self, fsm, event, *args):
+        # The FSM's self-loops skip their callback while nothing has
+        # changed (see pi-systems_fsm-engine). If the desired state was
+        # changed outside the FSM, e.g. by request_new_state(), the
+        # callback must run to assert the FSM's own again.
+        ss = args[0]
+        if getattr(ss, 'desired_state', None) != self._published.get(fsm):
+            fsm.invalidate()
+        source = fsm.current_state
+        getattr(fsm, event)(*args)
+        target = fsm.current_state
+        self._published[fsm] = getattr(ss, 'desired_state', None)
+        if metrics.enabled:
+            TRANSITIONS.labels(type(fsm).__name__, event).inc()
+        if self.on_transition:
+            self.on_transition(
+                type(fsm).__name__, event, source.name, target.name)
+        return source is not target
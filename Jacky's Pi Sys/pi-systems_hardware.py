@@ -0,0 +1,237 @@
+import importlib
+import os
+import threading
+from contextlib import contextmanager
+from enum import Enum
+log = importlib.import_module('pi-systems_log')
+
+"""
+Purpose: Pluggable hardware backend for the I2C bus and the GPIO pins.
+    Subsystems never import smbus or RPi.GPIO themselves. They go through
+    this module, which hands out either the real libraries or the
+    in-process simulator (pi-systems_simulator.py):
+
+        hardware = importlib.import_module('pi-systems_hardware')
+        GPIO = hardware.GPIO        # Same API as RPi.GPIO
+        bus = hardware.open_bus(1)  # Same API as smbus.SMBus
+
+    The backend is picked from the AIRLOCK_BACKEND environment variable
+    ("hardware" or "simulator"). If it is not set, the real hardware is
+    used when its libraries can be imported and the simulator otherwise.
+    To choose in code, call select() before importing any subsystem: the
+    I2C bus is opened when pi-systems_communications is imported.
+
+    GPIOPort groups pins so they can be read in one go and written as one
+    masked update, using the bank registers where the backend exposes
+    them (pigpio, when its daemon is running, or the simulator).
+"""
+
+
+class Backend(Enum):
+    Hardware = "hardware"
+    Simulator = "simulator"
+
+
+class _GPIOProxy:
+    # Forwards to the GPIO module of the selected backend, so modules can
+    # bind GPIO at import time and still follow select().
+    def __getattr__(self, name):
+        if _gpio is None:
+            raise RuntimeError("No GPIO backend has been selected!")
+        return getattr(_gpio, name)
+
+    def __repr__(self):
+        return "GPIO (%s)" % (backend.value if backend else "none")
+
+
+backend = None
+# The running Simulator when the simulator backend is selected.
+simulator = None
+GPIO = _GPIOProxy()
+
+_gpio = None
+_smbus = None
+_pigpio = None
+
+
+class _PigpioBank:
+    # Bank 1 (GPIO 0-31) of a connected pigpio.pi.
+    def __init__(self, pi):
+        self.pi = pi
+
+    def read_bank(self):
+        return self.pi.read_bank_1()
+
+    def write_bank(self, set_mask, clear_mask):
+        if set_mask:
+            self.pi.set_bank_1(set_mask)
+        if clear_mask:
+            self.pi.clear_bank_1(clear_mask)
+
+
+"""
+Select the backend. simulator_options are passed to the Simulator
+(clock, latency_s, byte_time_s, nack_rate, seed, chamber).
+Raises ModuleNotFoundError if the hardware libraries are missing.
+"""
+def select(new_backend, **simulator_options):
+    global backend, simulator, _gpio, _smbus, _pigpio
+    new_backend = Backend(new_backend)
+
+    if new_backend is Backend.Hardware:
+        import smbus
+        import RPi.GPIO as gpio
+        _smbus, _gpio, simulator = smbus, gpio, None
+        _pigpio = _connect_pigpio()
+    else:
+        simulator_module = importlib.import_module('pi-systems_simulator')
+        simulator = simulator_module.Simulator(**simulator_options)
+        _smbus, _gpio, _pigpio = None, simulator.gpio, None
+
+    backend = new_backend
+    return simulator
+
+
+def open_bus(bus_number=1):
+    if backend is Backend.Hardware:
+        return _smbus.SMBus(bus_number)
+    return simulator.bus
+
+
+"""
+Whole-bank GPIO access (read_bank() and write_bank(set_mask, clear_mask),
+bit n being channel n), or None if the backend only has per-pin access.
+pigpio numbers pins by BCM, so it is only used in BCM mode.
+"""
+def bank():
+    if backend is Backend.Simulator:
+        return simulator.gpio
+    if _pigpio is not None and _gpio.getmode() == _gpio.BCM:
+        return _pigpio
+    return None
+
+
+def _connect_pigpio():
+    try:
+        import pigpio
+    except ModuleNotFoundError:
+        return None
+    pi = pigpio.pi()
+    return _PigpioBank(pi) if pi.connected else None
+
+
+class GPIOPort:
+    """
+    Purpose: A group of GPIO pins read and written together.
+        read() snapshots every pin with a single bank read.
+        write() skips pins already at the requested level, then applies
+        the rest as one masked bank write (or one GPIO.output call with a
+        list of pins when there is no bank access).
+        batch() collects the writes made inside it into one write() at
+        the end.
+    pins: Channels of the port. Outputs must already be set up.
+    """
+    def __init__(self, pins=()):
+        self.pins = list(pins)
+        self.gpio_calls = 0
+        self.skipped = 0
+        self._levels = {}
+        self._pending = {}
+        self._depth = 0
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return "GPIOPort (pins=%s)" % self.pins
+
+    def add(self, pin):
+        with self._lock:
+            if pin not in self.pins:
+                self.pins.append(pin)
+
+    def remove(self, pin):
+        with self._lock:
+            if pin in self.pins:
+                self.pins.remove(pin)
+            self._levels.pop(pin, None)
+            self._pending.pop(pin, None)
+
+    """
+    Levels of every pin of the port, as a {pin: level} dict.
+    """
+    def read(self):
+        with self._lock:
+            self.gpio_calls += 1
+            io = bank()
+            if io is not None:
+                mask = io.read_bank()
+                return {pin: (mask >> pin) & 1 for pin in self.pins}
+            self.gpio_calls += len(self.pins) - 1
+            return {pin: GPIO.input(pin) for pin in self.pins}
+
+    """
+    Set outputs from a {pin: level} dict.
+    """
+    def write(self, levels):
+        with self._lock:
+            self._pending.update(levels)
+            if self._depth == 0:
+                self._flush()
+
+    @contextmanager
+    def batch(self):
+        with self._lock:
+            self._depth += 1
+            try:
+                yield self
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._flush()
+
+    """
+    Forget the cached levels, e.g. after something else drove the pins.
+    """
+    def invalidate(self):
+        with self._lock:
+            self._levels.clear()
+
+    def _flush(self):
+        changes = {}
+        for pin, level in self._pending.items():
+            level = int(bool(level))
+            if self._levels.get(pin) == level:
+                self.skipped += 1
+            else:
+                changes[pin] = level
+        self._pending.clear()
+        if not changes:
+            return
+
+        self.gpio_calls += 1
+        io = bank()
+        if io is not None:
+            set_mask = clear_mask = 0
+            for pin, level in changes.items():
+                if level:
+                    set_mask |= 1 << pin
+                else:
+                    clear_mask |= 1 << pin
+            io.write_bank(set_mask, clear_mask)
+        else:
+            GPIO.output(list(changes), list(changes.values()))
+        self._levels.update(changes)
+
+
+def _select_default():
+    requested = os.environ.get("AIRLOCK_BACKEND")
+    if requested:
+        return select(requested)
+    try:
+        select(Backend.Hardware)
+    except (ModuleNotFoundError, RuntimeError):
+        log.i("hardware", "RPi not being used, using the simulator "
+              "backend...")
+        select(Backend.Simulator)
+
+
+_select_default()
@@ -1,8 +1,8 @@
 from enum import Enum
-import struct
 import importlib
 subsys = importlib.import_module('pi-systems_subsystem-base')
 comms = importlib.import_module('pi-systems_communications')
+schemas = importlib.import_module('pi-systems_payload-schemas')
 
 """
 Author: Thomas Richmond
@@ -10,7 +10,9 @@ Purpose: Interact with an Arduino which has controls several hex displays.
 Parameter: display_data_fns - A list of functions, each returning an int16.
                               Each cycle, these functions are called and sent,
                               IN ORDER OF THE LIST, to the Arduino at the
-                              I2C address specified.
+                              I2C address specified. There must be one
+                              function per display in UpdateDisplay_t
+                              (o2, co2, temperature, pressure).
 """
 
 
@@ -36,10 +38,18 @@ class HexDisplaySubsystem(subsys.Subsystem):
             display_data_fns if isinstance(display_data_fns, list) \
             else [display_data_fns]
 
+        self.schema = schemas.register(
+            address, self.Procedure.UpdateDisplays, schemas.UPDATE_DISPLAY)
+        displays = len(self.schema.fields) - len(schemas.HEADER_FIELDS)
+        if len(self.display_data_fns) != displays:
+            raise ValueError(
+                "HexDisplaySubsystem needs %i display functions, got %i!"
+                % (displays, len(self.display_data_fns)))
+
     def loop(self):
-        data = []
-        for d in self.display_data_fns:
-            data.extend(struct.unpack('BB', struct.pack('h', int(d()))))
+        # All displays are packed as int16 in a single pass.
+        data = self.schema.encode_payload(
+            *[int(d()) for d in self.display_data_fns])
 
         comms.intra_write(
             self.address,
@@ -59,7 +69,9 @@ if __name__ == "__main__":
       address="FILL ME IN",
       display_data_fns=[
           lambda: 12,
-          lambda: 13
+          lambda: 13,
+          lambda: 22,
+          lambda: 101
       ]
     )
 
@@ -1,14 +1,10 @@
 from enum import Enum
+import threading
 
 import importlib
 
-try:
-    import RPi.GPIO as GPIO
-except RuntimeError:
-    print("Error importing RPi.GPIO!")
-except ModuleNotFoundError:
-    print("Running on non-pi machine")
-
+hardware = importlib.import_module('pi-systems_hardware')
+GPIO = hardware.GPIO
 subsys = importlib.import_module('pi-systems_subsystem-base')
 comms = importlib.import_module('pi-systems_communications')
 
@@ -19,10 +15,17 @@ class InterfaceSubsystem(subsys.Subsystem):
     Purpose: Handle any interfacing with physical in/out boards.
     Can use the following methods:
         - get_input_component(name): Get the input component
-            with a specified name
+            with a specified name, or None
         - read_input(component): Get the GPIO input of a selected component
-        - get_output_component(name): Get the input component
-            with a specified name
+        - get_output_component(name): Get the output component
+            with a specified name, or None
+        - get_component(name): Get the input or output component
+            with a specified name, or None
+        - get_component_by_pin(pin): Likewise, by GPIO pin
+        - add_input(component) / add_output(component): Set up the pin of a
+            new component and start handling it, also while running
+        - remove_input(name) / remove_output(name): Stop handling a
+            component and release its pin
         - write_output(component, state): Write GPIO output
             to a selected component
         - InputComponent.attachCallback(callback, id): Places a state change
@@ -44,37 +47,113 @@ class InterfaceSubsystem(subsys.Subsystem):
             loop_delay_ms=loop_delay_ms,
             on_loop=on_loop)
 
-        self.inputs = inputs if type(inputs) is list else [inputs]
-        for i in self.inputs:
-            GPIO.setup(i.pin, GPIO.IN)
-            for pp in i.pipe_pins:
-                GPIO.setup(pp, GPIO.OUT)
-
-        self.outputs = outputs if type(outputs) is list else [outputs]
-        for o in self.outputs:
-            GPIO.setup(o.pin, GPIO.OUT)
+        # Components by name and by pin. inputs and outputs keep the order
+        # the components were added in.
+        self.inputs = []
+        self.outputs = []
+        self._inputs_by_name = {}
+        self._outputs_by_name = {}
+        self._by_pin = {}
+        # Held while the loop reads the inputs and while components change.
+        self._lock = threading.RLock()
+
+        for i in inputs if type(inputs) is list else [inputs]:
+            self.add_input(i)
+        for o in outputs if type(outputs) is list else [outputs]:
+            self.add_output(o)
 
     def loop(self):
         self._check_inputs()
 
     def _check_inputs(self):
-        for i in self.inputs:
-            i.read()
+        with self._lock:
+            for i in self.inputs:
+                i.read()
 
     def get_input_component(self, name):
-        return [i for i in self.inputs if i.name == name].pop()
+        return self._inputs_by_name.get(name)
 
     # def read_input(self, component):
     #     return GPIO.input(component.pin)
 
     def get_output_component(self, name):
-        return [o for o in self.outputs if o.name == name].pop()
+        return self._outputs_by_name.get(name)
 
     def get_component(self, name):
-        return \
-            self.get_output_component(name) \
-            or self.get_input_component(name) \
-            or None
+        component = self._outputs_by_name.get(name)
+        if component is None:
+            component = self._inputs_by_name.get(name)
+        return component
+
+    def get_component_by_pin(self, pin):
+        return self._by_pin.get(pin)
+
+    """
+    Set up the pin of an InputComponent and start reading it. Raises
+    ValueError if its name or pin is already used by this subsystem.
+    """
+    def add_input(self, component):
+        with self._lock:
+            self._check_free(component)
+            GPIO.setup(component.pin, GPIO.IN)
+            for pp in component.pipe_pins:
+                GPIO.setup(abs(pp), GPIO.OUT)
+            self.inputs.append(component)
+            self._inputs_by_name[component.name] = component
+            self._by_pin[component.pin] = component
+        return component
+
+    """
+    Stop reading an InputComponent, given it or its name, and release its
+    pin. Returns the component, or None if there was none.
+    """
+    def remove_input(self, component):
+        with self._lock:
+            name = getattr(component, 'name', component)
+            component = self._inputs_by_name.pop(name, None)
+            if component is None:
+                return None
+            self.inputs.remove(component)
+            del self._by_pin[component.pin]
+            GPIO.cleanup(component.pin)
+        return component
+
+    """
+    Set up the pin of an OutputComponent. Raises ValueError if its name or
+    pin is already used by this subsystem.
+    """
+    def add_output(self, component):
+        with self._lock:
+            self._check_free(component)
+            GPIO.setup(component.pin, GPIO.OUT)
+            self.outputs.append(component)
+            self._outputs_by_name[component.name] = component
+            self._by_pin[component.pin] = component
+        return component
+
+    """
+    Stop driving an OutputComponent, given it or its name, and release its
+    pin. Returns the component, or None if there was none.
+    """
+    def remove_output(self, component):
+        with self._lock:
+            name = getattr(component, 'name', component)
+            component = self._outputs_by_name.pop(name, None)
+            if component is None:
+                return None
+            self.outputs.remove(component)
+            del self._by_pin[component.pin]
+            GPIO.cleanup(component.pin)
+        return component
+
+    def _check_free(self, component):
+        if component.name in self._inputs_by_name \
+                or component.name in self._outputs_by_name:
+            raise ValueError("%s already has a component named %s" % (
+                self.name, component.name))
+        if component.pin in self._by_pin:
+            raise ValueError("%s: pin %i is already used by %s" % (
+                self.name, component.pin, self._by_pin[component.pin]))
 
     # def write_output(self, component, state):
     #     GPIO.output(component.pin, state)
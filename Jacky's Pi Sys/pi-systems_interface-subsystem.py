@@ -1,9 +1,15 @@
-import RPi.GPIO as GPIO
+from collections import deque
 from enum import Enum
+import threading
+import time
 
 import importlib
+hardware = importlib.import_module('pi-systems_hardware')
+GPIO = hardware.GPIO
 subsys = importlib.import_module('pi-systems_subsystem-base')
 comms = importlib.import_module('pi-systems_communications')
+telemetry = importlib.import_module('pi-systems_telemetry-log')
+log = importlib.import_module('pi-systems_log')
 
 
 class InterfaceSubsystem(subsys.Subsystem):
@@ -12,83 +18,360 @@ class InterfaceSubsystem(subsys.Subsystem):
     Purpose: Handle any interfacing with physical in/out boards.
     Can use the following methods:
         - get_input_component(name): Get the input component
-            with a specified name
+            with a specified name, or None
         - read_input(component): Get the GPIO input of a selected component
-        - get_output_component(name): Get the input component
-            with a specified name
+        - get_output_component(name): Get the output component
+            with a specified name, or None
+        - get_component(name): Get the input or output component
+            with a specified name, or None
+        - get_component_by_pin(pin): Likewise, by GPIO pin
+        - add_input(component) / add_output(component): Set up the pin of a
+            new component and start handling it, also while running
+        - remove_input(name) / remove_output(name): Stop handling a
+            component and release its pin
         - write_output(component, state): Write GPIO output
             to a selected component
         - InputComponent.attachCallback(callback, id): Places a state change
             callback on an input component
+    input_mode: How input changes are picked up:
+        InputMode.Edge (default): GPIO edge interrupts are queued and
+            dispatched by a dedicated thread as soon as they happen. The
+            loop only re-reads every input once per loop_delay_ms as a
+            safety net for lost edges. Falls back to Polling if the GPIO
+            backend cannot detect edges.
+        InputMode.Polling: every input is read once per loop_delay_ms.
+    loop_delay_ms: Defaults to 100 ms when polling and 1 s for Edge.
+    The inputs are read through one GPIOPort (input_port), so a loop is a
+    single snapshot of every pin rather than a GPIO.input per component.
+    The outputs share another (output_port): writes that do not change a
+    pin are skipped, and writes made inside output_port.batch() go out
+    together as one masked write.
     """
 
+    class InputMode(Enum):
+        Polling = "polling"
+        Edge = "edge"
+
+    DEFAULT_POLL_DELAY_MS = 100
+    DEFAULT_RESYNC_DELAY_MS = 1000
+
     def __init__(
         self,
         name,
         thread_id,
         inputs=[],
         outputs=[],
-        loop_delay_ms=100,
-        on_loop=None
+        loop_delay_ms=None,
+        on_loop=None,
+        input_mode=InputMode.Edge
     ):
+        self.input_mode = InterfaceSubsystem.InputMode(input_mode)
+        if loop_delay_ms is None:
+            loop_delay_ms = InterfaceSubsystem.DEFAULT_POLL_DELAY_MS \
+                if self.input_mode is InterfaceSubsystem.InputMode.Polling \
+                else InterfaceSubsystem.DEFAULT_RESYNC_DELAY_MS
+
         super().__init__(
             name=name,
             thread_id=thread_id,
             loop_delay_ms=loop_delay_ms,
             on_loop=on_loop)
 
-        self.inputs = inputs if type(inputs) is list else [inputs]
-        for i in self.inputs:
-            GPIO.setup(i.pin, GPIO.IN)
-            for pp in i.pipe_pins:
-                GPIO.setup(abs(pp), GPIO.OUT)
-
-        self.outputs = outputs if type(outputs) is list else [outputs]
-        for o in self.outputs:
-            GPIO.setup(o.pin, GPIO.OUT)
+        # Edge mode. GPIO callbacks only append (channel, time) to the
+        # deque, which is safe without a lock; the dispatcher thread does
+        # the reading, debouncing and callbacks.
+        self._edges = deque()
+        self._edge_ready = threading.Event()
+        self._dispatcher = None
+        self._dispatching = False
+        # Serializes state changes between the dispatcher and the loop, and
+        # changes to the components.
+        self._input_lock = threading.RLock()
+        self._latency = EdgeLatency()
+
+        # Components by name and by pin. inputs and outputs keep the order
+        # the components were added in.
+        self.inputs = []
+        self.outputs = []
+        self._inputs_by_name = {}
+        self._outputs_by_name = {}
+        self._by_pin = {}
+        self.input_port = hardware.GPIOPort()
+        self.output_port = hardware.GPIOPort()
+
+        for i in inputs if type(inputs) is list else [inputs]:
+            self.add_input(i)
+        for o in outputs if type(outputs) is list else [outputs]:
+            self.add_output(o)
+
+    def start(self):
+        if self.thread.running:
+            return
+        if self.input_mode is InterfaceSubsystem.InputMode.Edge:
+            self._start_edge_detection()
+        super().start()
+
+    def stop(self):
+        self._stop_edge_detection()
+        super().stop()
 
     def loop(self):
         self._check_inputs()
 
     def _check_inputs(self):
-        for i in self.inputs:
-            i.read()
+        with self._input_lock:
+            levels = self.input_port.read()
+            for i in self.inputs:
+                i.read(levels[i.pin])
 
+    """
+    Press-to-callback latency of edge-dispatched input changes.
+    """
+    @property
+    def edge_stats(self):
+        return self._latency.report()
+
+    # -----------------------------------------------------------------------
+    # Edge detection
+    # -----------------------------------------------------------------------
+    def _start_edge_detection(self):
+        with self._input_lock:
+            try:
+                for i in self.inputs:
+                    GPIO.add_event_detect(
+                        i.pin, GPIO.BOTH, callback=self._on_edge)
+            except (RuntimeError, AttributeError) as e:
+                log.w(self.name, "Edge detection unavailable (%s), polling "
+                      "inputs instead.", e)
+                for i in self.inputs:
+                    try:
+                        GPIO.remove_event_detect(i.pin)
+                    except (RuntimeError, AttributeError):
+                        pass
+                self.input_mode = InterfaceSubsystem.InputMode.Polling
+                return
+
+            self._dispatching = True
+            self._dispatcher = threading.Thread(
+                name="%s-edges" % self.name,
+                target=self._dispatch_edges,
+                daemon=True)
+            self._dispatcher.start()
+
+    def _stop_edge_detection(self):
+        if not self._dispatching:
+            return
+        for i in self.inputs:
+            try:
+                GPIO.remove_event_detect(i.pin)
+            except RuntimeError:
+                pass
+        self._dispatching = False
+        self._edge_ready.set()
+        self._dispatcher.join()
+
+    # Runs on the GPIO library's callback thread. Must stay short.
+    def _on_edge(self, channel):
+        self._edges.append((channel, time.perf_counter()))
+        self._edge_ready.set()
+
+    def _dispatch_edges(self):
+        # Components whose debounce window is still open, mapped to the
+        # time it closes. They are re-read when it does, so a level that
+        # settled during the window is not missed.
+        settling = {}
+        while self._dispatching:
+            timeout = None
+            if settling:
+                timeout = max(0, min(settling.values()) - time.perf_counter())
+            self._edge_ready.wait(timeout)
+            self._edge_ready.clear()
+
+            while self._edges:
+                channel, edge_time = self._edges.popleft()
+                component = self._by_pin.get(channel)
+                if not isinstance(component, InputComponent):
+                    continue
+                if component in settling:
+                    continue  # Bounce; the level is re-read when it settles.
+                if self._accept(component):
+                    self._latency.add(time.perf_counter() - edge_time)
+                settling[component] = \
+                    time.perf_counter() + component.debounce_ms / 1000
+
+            now = time.perf_counter()
+            for component, until in list(settling.items()):
+                if until <= now:
+                    del settling[component]
+                    if self._by_pin.get(component.pin) is not component:
+                        continue  # Removed while settling.
+                    if self._accept(component):
+                        # Settled at a new level: open a fresh window.
+                        settling[component] = \
+                            now + component.debounce_ms / 1000
+
+    def _accept(self, component):
+        with self._input_lock:
+            previous = component.state
+            return component.read() != previous
+
+    # -----------------------------------------------------------------------
+    # Components
+    # -----------------------------------------------------------------------
     def get_input_component(self, name):
-        return [i for i in self.inputs if i.name == name].pop()
+        return self._inputs_by_name.get(name)
 
     # def read_input(self, component):
     #     return GPIO.input(component.pin)
 
     def get_output_component(self, name):
-        return [o for o in self.outputs if o.name == name].pop()
+        return self._outputs_by_name.get(name)
 
     def get_component(self, name):
-        return \
-            self.get_output_component(name) \
-            or self.get_input_component(name) \
-            or None
+        component = self._outputs_by_name.get(name)
+        if component is None:
+            component = self._inputs_by_name.get(name)
+        return component
+
+    def get_component_by_pin(self, pin):
+        return self._by_pin.get(pin)
+
+    """
+    Set up the pin of an InputComponent and start reading it. Raises
+    ValueError if its name or pin is already used by this subsystem.
+    """
+    def add_input(self, component):
+        with self._input_lock:
+            self._check_free(component)
+            GPIO.setup(component.pin, GPIO.IN)
+            for pp in component.pipe_pins:
+                GPIO.setup(abs(pp), GPIO.OUT)
+            self.inputs.append(component)
+            self._inputs_by_name[component.name] = component
+            self._by_pin[component.pin] = component
+            self.input_port.add(component.pin)
+            if self._dispatching:
+                GPIO.add_event_detect(
+                    component.pin, GPIO.BOTH, callback=self._on_edge)
+        return component
+
+    """
+    Stop reading an InputComponent, given it or its name, and release its
+    pin. Returns the component, or None if there was none.
+    """
+    def remove_input(self, component):
+        with self._input_lock:
+            name = getattr(component, 'name', component)
+            component = self._inputs_by_name.pop(name, None)
+            if component is None:
+                return None
+            if self._dispatching:
+                try:
+                    GPIO.remove_event_detect(component.pin)
+                except RuntimeError:
+                    pass
+            self.inputs.remove(component)
+            del self._by_pin[component.pin]
+            self.input_port.remove(component.pin)
+            GPIO.cleanup(component.pin)
+        return component
+
+    """
+    Set up the pin of an OutputComponent and write through output_port.
+    Raises ValueError if its name or pin is already used by this subsystem.
+    """
+    def add_output(self, component):
+        with self._input_lock:
+            self._check_free(component)
+            GPIO.setup(component.pin, GPIO.OUT)
+            self.outputs.append(component)
+            self._outputs_by_name[component.name] = component
+            self._by_pin[component.pin] = component
+            self.output_port.add(component.pin)
+            component.port = self.output_port
+        return component
+
+    """
+    Stop driving an OutputComponent, given it or its name, and release its
+    pin. Returns the component, or None if there was none.
+    """
+    def remove_output(self, component):
+        with self._input_lock:
+            name = getattr(component, 'name', component)
+            component = self._outputs_by_name.pop(name, None)
+            if component is None:
+                return None
+            self.outputs.remove(component)
+            del self._by_pin[component.pin]
+            self.output_port.remove(component.pin)
+            component.port = None
+            GPIO.cleanup(component.pin)
+        return component
+
+    def _check_free(self, component):
+        if component.name in self._inputs_by_name \
+                or component.name in self._outputs_by_name:
+            raise ValueError("%s already has a component named %s" % (
+                self.name, component.name))
+        if component.pin in self._by_pin:
+            raise ValueError("%s: pin %i is already used by %s" % (
+                self.name, component.pin, self._by_pin[component.pin]))
 
     # def write_output(self, component, state):
     #     GPIO.output(component.pin, state)
 
 
+class EdgeLatency:
+    """
+    Purpose: Running statistics of the time from a GPIO edge to the end of
+        its on_change callbacks.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def report(self):
+        return {
+            "edges": self.count,
+            "mean_latency_ms":
+                self.total * 1000 / self.count if self.count else 0,
+            "max_latency_ms": self.max * 1000
+        }
+
+
 class InputComponent:
     class Subtype(Enum):
         Button = "Button"  # State is 1 or 0
         Switch = "Switch"     # State is 1 or 0
 
-    def __init__(self, name, pin, subtype, initial=False, on_change_callbacks={}, pipe_pins=[]):
+    # Software debounce in edge mode: after a change is accepted, further
+    # edges are ignored for this long and the pin is then re-read.
+    # Toggle switches bounce for longer than push buttons.
+    DEBOUNCE_MS = {
+        Subtype.Button.value: 20,
+        Subtype.Switch.value: 50
+    }
+
+    def __init__(self, name, pin, subtype, initial=False, on_change_callbacks=None, pipe_pins=[], debounce_ms=None):
         self.name = name
         self.pin = pin
         self.subtype = subtype if type(subtype) is str else subtype.value
+        self.debounce_ms = debounce_ms if debounce_ms is not None \
+            else InputComponent.DEBOUNCE_MS.get(self.subtype, 20)
         self._state = initial or 0
 
         # The Pi will automatically forward signals to these pins.
         # If negative, forwads the inverted signal.
         self.pipe_pins = pipe_pins if isinstance(pipe_pins, list) else [pipe_pins]
         self._read = self._get_reader()
-        self.on_change_callbacks = on_change_callbacks
+        # Copied, so components never share one dict of callbacks.
+        self.on_change_callbacks = dict(on_change_callbacks or {})
 
     def __repr__(self):
         return "%s (name=%s, pin=%i, state=%i)" % (
@@ -104,8 +387,12 @@ class InputComponent:
                 return GPIO.input(self.pin)
             return swt_reader
 
-    def read(self):
-        self.state = self._read()
+    """
+    Update the state from the pin, or from level if it was already read
+    (e.g. as part of a GPIOPort snapshot).
+    """
+    def read(self, level=None):
+        self.state = self._read() if level is None else level
         return self.state
 
     @property
@@ -117,6 +404,7 @@ class InputComponent:
         prev_state = self.state
         self._state = value
         if prev_state != self.state:
+            telemetry.record_input(self.name, self.state)
             for id in self.on_change_callbacks:
                 self.on_change_callbacks[id](self.state)
             for pin in self.pipe_pins:
@@ -141,13 +429,24 @@ class OutputComponent:
         self.pin = pin
         self.subtype = subtype if type(subtype) is str else subtype.value
         self.state = initial
+        # Set by the InterfaceSubsystem that owns the component.
+        self.port = None
+        self._written = None
 
     def __repr__(self):
         return "%s (name=%s, pin=%i, state=%i)" % (
             self.subtype, self.name, self.pin, int(self.state))
 
+    """
+    Drive the pin. Nothing is sent if it is already at value.
+    """
     def write(self, value):
-        GPIO.output(self.pin, value)
+        self.state = value
+        if self.port is not None:
+            self.port.write({self.pin: value})
+        elif self._written != value:
+            GPIO.output(self.pin, value)
+            self._written = value
         return value
 
 
@@ -22,22 +22,14 @@ import time
 #import importlib
 import importlib
 subsys = importlib.import_module("pi-systems_subsystem-base")
+hardware = importlib.import_module("pi-systems_hardware")
 
 # needed to define a missing argument (loop delay) for the subsystems FSM, 
 # so we make a global constant
 DEFAULT_LOOP_DELAY = 750
 
-#Try importing, gives error message if it fails
-
-try:
-    import RPi.GPIO as GPIO
-except RuntimeError:
-    print(
-        "Error importing RPi.GPIO!  This is probably because you need \
-         superuser privileges.  You can achieve this by using 'sudo' to \
-         run your script")
-except ModuleNotFoundError:
-    print("Running on non-pi machine")
+# Real RPi.GPIO on a Pi, simulated elsewhere (see pi-systems_hardware.py).
+GPIO = hardware.GPIO
 
 
 class LightingSubsystem(subsys.Subsystem):
@@ -0,0 +1,256 @@
+import atexit
+import json
+import queue
+import sys
+import threading
+import time
+from enum import IntEnum
+
+"""
+Purpose: Leveled, tagged logging that never makes a control loop wait on
+    the console or the SD card.
+
+        log = importlib.import_module('pi-systems_log')
+        log.w(self.name, "Could not send %s (%s)", state, e, retry_s=0.5)
+
+    The tag is usually the subsystem's name. The message is formatted
+    with its arguments (%-style) and the keyword arguments are kept as
+    structured fields. A record below the configured level is dropped
+    before anything is formatted. Otherwise it is put on a bounded queue
+    and formatted and written by a background thread; when the queue is
+    full the record is dropped and counted rather than blocking.
+
+    The same message (tag, level and format string) is written at most
+    rate_burst times per rate_interval_s. The repeats after that are
+    counted, and the count is attached to the next one written as the
+    suppressed field.
+
+    Levels follow init.py --log_lev: 0 = Verbose, 1 = Info, 2 = Debug,
+    3 = Warning, 4 = Error, 5 = WTF.
+"""
+
+
+class Level(IntEnum):
+    Verbose = 0
+    Info = 1
+    Debug = 2
+    Warning = 3
+    Error = 4
+    WTF = 5
+
+
+LEVEL_LETTERS = {
+    Level.Verbose: "V",
+    Level.Info: "I",
+    Level.Debug: "D",
+    Level.Warning: "W",
+    Level.Error: "E",
+    Level.WTF: "WTF"
+}
+
+QUEUE_SIZE = 4096
+
+# Records below this level are dropped. Everything is written by
+# default, as the prints were.
+level = Level.Verbose
+# int(level), compared with the plain ints below on every call.
+_threshold = int(level)
+_VERBOSE, _INFO, _DEBUG, _WARNING, _ERROR = (
+    int(Level.Verbose), int(Level.Info), int(Level.Debug),
+    int(Level.Warning), int(Level.Error))
+rate_burst = 5
+rate_interval_s = 10.0
+
+_console = True
+_json = False
+_file = None
+_queue = queue.Queue(QUEUE_SIZE)
+_writer = None
+_lock = threading.Lock()
+# (tag, level, msg): [window start, records in window, suppressed].
+_rates = {}
+_stats = {"written": 0, "dropped": 0, "suppressed": 0}
+
+
+"""
+Set the level, the destinations and the rate limit. Arguments left as
+None are unchanged.
+level: Level (or its number) below which records are dropped.
+path: File the records are appended to as well, e.g. on the SD card.
+    "" closes the current one.
+console: Whether records are written to stdout.
+as_json: Write one JSON object per record instead of a line of text.
+"""
+def configure(level=None, path=None, console=None, as_json=None,
+              rate_burst=None, rate_interval_s=None):
+    global _console, _json, _file, _threshold
+    module = sys.modules[__name__]
+    if level is not None:
+        module.level = Level(int(level))
+        _threshold = int(module.level)
+    if rate_burst is not None:
+        module.rate_burst = rate_burst
+    if rate_interval_s is not None:
+        module.rate_interval_s = rate_interval_s
+    if console is not None:
+        _console = console
+    if as_json is not None:
+        _json = as_json
+    if path is not None:
+        flush()
+        old, _file = _file, open(path, "a") if path else None
+        if old is not None:
+            old.close()
+
+
+def v(tag, msg, *args, **fields):
+    if _threshold <= _VERBOSE:
+        _log(Level.Verbose, tag, msg, args, fields)
+
+
+def i(tag, msg, *args, **fields):
+    if _threshold <= _INFO:
+        _log(Level.Info, tag, msg, args, fields)
+
+
+def d(tag, msg, *args, **fields):
+    if _threshold <= _DEBUG:
+        _log(Level.Debug, tag, msg, args, fields)
+
+
+def w(tag, msg, *args, **fields):
+    if _threshold <= _WARNING:
+        _log(Level.Warning, tag, msg, args, fields)
+
+
+def e(tag, msg, *args, **fields):
+    if _threshold <= _ERROR:
+        _log(Level.Error, tag, msg, args, fields)
+
+
+def wtf(tag, msg, *args, **fields):
+    _log(Level.WTF, tag, msg, args, fields)
+
+
+"""
+Records written, dropped because the queue was full, and suppressed by
+the rate limit.
+"""
+def stats():
+    return dict(_stats)
+
+
+"""
+Wait until every record queued so far has been written, at most
+timeout seconds. Returns False on timeout.
+"""
+def flush(timeout=2.0):
+    if _writer is None:
+        return True
+    done = threading.Event()
+    try:
+        _queue.put(done, timeout=timeout)
+    except queue.Full:
+        return False
+    return done.wait(timeout)
+
+
+def _log(record_level, tag, msg, args, fields):
+    now = time.time()
+    key = (tag, record_level, msg)
+    with _lock:
+        rate = _rates.get(key)
+        if rate is None:
+            rate = _rates[key] = [now, 0, 0]
+        elif now - rate[0] >= rate_interval_s:
+            rate[0] = now
+            rate[1] = 0
+        if rate[1] >= rate_burst:
+            rate[2] += 1
+            _stats["suppressed"] += 1
+            return
+        rate[1] += 1
+        suppressed, rate[2] = rate[2], 0
+
+    if suppressed:
+        fields["suppressed"] = suppressed
+    if _writer is None:
+        _start_writer()
+    try:
+        _queue.put_nowait((now, record_level, tag, msg, args, fields))
+    except queue.Full:
+        with _lock:
+            _stats["dropped"] += 1
+
+
+def _start_writer():
+    global _writer
+    with _lock:
+        if _writer is not None:
+            return
+        _writer = threading.Thread(
+            name="log-writer", target=_write_records, daemon=True)
+        _writer.start()
+
+
+def _write_records():
+    while True:
+        batch = [_queue.get()]
+        # Write whatever else is queued in one go.
+        try:
+            while len(batch) < QUEUE_SIZE:
+                batch.append(_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        lines = []
+        flushed = []
+        for record in batch:
+            if isinstance(record, threading.Event):
+                flushed.append(record)
+            else:
+                lines.append(_format(record))
+        if lines:
+            text = "\n".join(lines) + "\n"
+            try:
+                if _console:
+                    sys.stdout.write(text)
+                    sys.stdout.flush()
+                if _file is not None:
+                    _file.write(text)
+                    _file.flush()
+            except (OSError, ValueError) as err:
+                sys.stderr.write("Could not write the log: %s\n" % err)
+            _stats["written"] += len(lines)
+        for done in flushed:
+            done.set()
+
+
+def _format(record):
+    timestamp, record_level, tag, msg, args, fields = record
+    if args:
+        try:
+            msg = msg % args
+        except (TypeError, ValueError):
+            msg = "%s %r" % (msg, args)
+
+    if _json:
+        entry = {
+            "time": timestamp,
+            "level": record_level.name,
+            "tag": str(tag),
+            "msg": msg
+        }
+        entry.update(fields)
+        return json.dumps(entry, default=str)
+
+    line = "%s.%03i %s/%s: %s" % (
+        time.strftime("%H:%M:%S", time.localtime(timestamp)),
+        timestamp % 1 * 1000, LEVEL_LETTERS[record_level], tag, msg)
+    if fields:
+        line += " " + " ".join(
+            "%s=%s" % (name, value) for name, value in fields.items())
+    return line
+
+
+atexit.register(flush)
@@ -0,0 +1,320 @@
+import bisect
+import importlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+log = importlib.import_module('pi-systems_log')
+
+"""
+Purpose: Runtime metrics of the pi systems (loop durations, lock waits,
+    I2C transactions, FSM transitions) in a registry that can be scraped
+    over HTTP in the Prometheus text exposition format:
+
+        curl http://localhost:9108/metrics
+
+    Metrics are declared once, at import time, by the module they
+    measure:
+
+        LOOP_SECONDS = metrics.histogram(
+            "airlock_subsystem_loop_seconds", "...", ["subsystem"])
+
+    and updated from the hot path only while metrics are enabled:
+
+        if metrics.enabled:
+            LOOP_SECONDS.labels(self.name).observe(elapsed)
+
+    While disabled (the default) that check is the whole cost. Counts the
+    code keeps anyway (scheduler overruns, I2C address stats, ...) are not
+    duplicated: a collector registered with register_collector reads them
+    when the registry is scraped.
+"""
+
+# Checked by the instrumented code before it times or counts anything.
+enabled = False
+
+DEFAULT_PORT = 9108
+
+# Upper bounds of the default histogram buckets, seconds.
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    """
+    Purpose: A value that only goes up, e.g. transitions fired. Its name
+        ends in _total.
+    """
+    kind = "counter"
+
+    class Child:
+        __slots__ = ("value", "_lock")
+
+        def __init__(self):
+            self.value = 0
+            self._lock = threading.Lock()
+
+        def inc(self, amount=1):
+            with self._lock:
+                self.value += amount
+
+        def samples(self, name, labels):
+            return [(name, labels, self.value)]
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "%s (name=%s, labels=%s)" % (
+            type(self).__name__, self.name, self.labelnames)
+
+    """
+    The child of one combination of label values, in labelnames order.
+    Created on first use.
+    """
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("%s expects the labels %s!" % (
+                    self.name, self.labelnames))
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        with self._lock:
+            children = list(self._children.items())
+        samples = []
+        for values, child in children:
+            samples.extend(
+                child.samples(self.name, dict(zip(self.labelnames, values))))
+        return samples
+
+    def _new_child(self):
+        return self.Child()
+
+
+class Gauge(Counter):
+    """
+    Purpose: A value that goes up and down, e.g. a queue length.
+    """
+    kind = "gauge"
+
+    class Child(Counter.Child):
+        __slots__ = ()
+
+        def set(self, value):
+            self.value = value
+
+        def dec(self, amount=1):
+            self.inc(-amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(Counter):
+    """
+    Purpose: Distribution of observed values, e.g. loop durations, as the
+        count of observations at or below each bucket bound.
+    buckets: Increasing upper bounds. +Inf is added.
+    """
+    kind = "histogram"
+
+    class Child:
+        __slots__ = ("bounds", "counts", "sum", "count", "_lock")
+
+        def __init__(self, bounds):
+            self.bounds = bounds
+            self.counts = [0] * (len(bounds) + 1)
+            self.sum = 0
+            self.count = 0
+            self._lock = threading.Lock()
+
+        def observe(self, value):
+            bucket = bisect.bisect_left(self.bounds, value)
+            with self._lock:
+                self.counts[bucket] += 1
+                self.sum += value
+                self.count += 1
+
+        def samples(self, name, labels):
+            with self._lock:
+                counts, total, count = list(self.counts), self.sum, self.count
+            samples = []
+            cumulative = 0
+            for bound, bucket_count in zip(
+                    self.bounds + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append((name + "_bucket",
+                                dict(labels, le=_format_value(bound)),
+                                cumulative))
+            samples.append((name + "_sum", labels, total))
+            samples.append((name + "_count", labels, count))
+            return samples
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _new_child(self):
+        return self.Child(self.buckets)
+
+
+class Registry:
+    """
+    Purpose: The metrics and collectors rendered by a scrape.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "Registry (metrics=%i, collectors=%i)" % (
+            len(self._metrics), len(self._collectors))
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError("A metric named %s already exists!"
+                                 % metric.name)
+            self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    """
+    Add a callable run on every scrape, returning an iterable of
+    (name, kind, help, samples) families, samples being (labels, value)
+    pairs. For values the code already keeps.
+    """
+    def register_collector(self, collect):
+        with self._lock:
+            self._collectors.append(collect)
+
+    """
+    Every metric and collected family, in the text exposition format.
+    """
+    def exposition(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+
+        lines = []
+        for metric in metrics:
+            _write_family(lines, metric.name, metric.kind, metric.help,
+                          metric.samples())
+        for collect in collectors:
+            try:
+                families = list(collect())
+            except Exception as e:
+                log.e("metrics", "Collector %s failed: %s",
+                      getattr(collect, "__name__", collect), e)
+                continue
+            for name, kind, help, samples in families:
+                _write_family(lines, name, kind, help,
+                              [(name, labels, value)
+                               for labels, value in samples])
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def counter(name, help, labels=()):
+    return registry.register(Counter(name, help, labels))
+
+
+def gauge(name, help, labels=()):
+    return registry.register(Gauge(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, help, labels, buckets))
+
+
+def register_collector(collect):
+    registry.register_collector(collect)
+
+
+def exposition():
+    return registry.exposition()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # No line per scrape.
+
+
+"""
+Enable metrics and serve them at http://host:port/metrics from a daemon
+thread. Only listens locally by default. Returns the server; call its
+shutdown() to stop.
+"""
+def serve(port=DEFAULT_PORT, host="127.0.0.1"):
+    enable()
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(
+        name="metrics-http", target=server.serve_forever,
+        daemon=True).start()
+    log.i("metrics", "Serving metrics at http://%s:%i/metrics",
+          host, server.server_address[1])
+    return server
+
+
+def _write_family(lines, name, kind, help, samples):
+    lines.append("# HELP %s %s" % (
+        name, help.replace("\\", "\\\\").replace("\n", "\\n")))
+    lines.append("# TYPE %s %s" % (name, kind))
+    for sample_name, labels, value in samples:
+        if labels:
+            lines.append("%s{%s} %s" % (sample_name, ",".join(
+                '%s="%s"' % (key, _escape(value))
+                for key, value in labels.items()), _format_value(value)))
+        else:
+            lines.append("%s %s" % (sample_name, _format_value(value)))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if value == float("-inf"):
+        return "-Inf"
+    return repr(value) if isinstance(value, float) else str(value)
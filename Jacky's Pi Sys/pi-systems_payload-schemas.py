@@ -0,0 +1,189 @@
+import importlib
+from collections import namedtuple
+comms = importlib.import_module('pi-systems_communications')
+
+"""
+Purpose: Declare each I2C payload format once, in one place.
+    Every schema mirrors a C struct in one of the Arduino sketches and
+    is compiled into a single struct.Struct when this module is imported.
+    Frames decode straight into slotted namedtuple records.
+
+    The Arduinos are little-endian and their structs are packed, so every
+    format uses '<' (standard sizes, no padding). The compiled size of a
+    schema must therefore equal sizeof() of its C struct; verify() checks
+    this against the sizes recorded below.
+
+    Schemas are looked up by (address, procedure). Subsystems register the
+    addresses they talk to when they are constructed.
+"""
+
+
+# Fields shared by every message (see IntraModCommMessage).
+HEADER_FIELDS = [
+    ("action", "B"),
+    ("procedure", "B"),
+    ("priority", "B")
+]
+
+
+class PayloadSchema:
+    """
+    name: Name of the record type produced by decode().
+    fields: List of (field_name, struct_format) pairs following the header,
+        in the order they appear in the C struct.
+    sketch: The sketch and struct this schema mirrors.
+    sketch_size: sizeof() of that struct on the Arduino, in bytes.
+    """
+    def __init__(self, name, fields, sketch, sketch_size):
+        self.name = name
+        self.sketch = sketch
+        self.sketch_size = sketch_size
+        self.fields = HEADER_FIELDS + fields
+
+        self.codec = comms.IntraModCommMessage.codec(
+            '<' + ''.join(fmt for _, fmt in self.fields))
+        self.payload_codec = comms.IntraModCommMessage.codec(
+            '<' + ''.join(fmt for _, fmt in fields))
+        self.Record = namedtuple(name, [n for n, _ in self.fields])
+
+    def __repr__(self):
+        return "PayloadSchema (name=%s, size=%i, sketch=%s)" % (
+            self.name, self.codec.size, self.sketch)
+
+    """
+    Decode a full frame (header included) into a record.
+    Raises ValueError if the message is too short.
+    """
+    def decode(self, message):
+        return self.Record._make(message.unpack(self.codec))
+
+    """
+    Encode the fields after the header, for use as the data argument of
+    IntraModCommMessage.generate().
+    """
+    def encode_payload(self, *values):
+        return self.payload_codec.pack(*values)
+
+
+# ---------------------------------------------------------------------------
+# Schemas
+# ---------------------------------------------------------------------------
+SENSOR_DATA = PayloadSchema(
+    "SensorData",
+    [
+        ("data_flags", "B"),  # Bit 7..3 set if O2..CO2 are valid.
+        ("O2", "B"),
+        ("humidity", "B"),
+        ("temperature", "h"),
+        ("pressure", "H"),
+        ("CO2", "H")
+    ],
+    sketch="sensors/Integrated sensors/integrated_sensors/"
+           "integrated_sensors.ino: send_data",
+    sketch_size=12)
+
+DOOR_STATE = PayloadSchema(
+    "DoorState",
+    [
+        ("door_state", "B"),
+        ("angle", "h")
+    ],
+    sketch="motors/motor_driver/March9doorcontrol_I2C_.ino/"
+           "March9doorcontrol_I2C_.ino.ino: GetDoorState_t",
+    sketch_size=6)
+
+SET_DOOR_STATE = PayloadSchema(
+    "SetDoorState",
+    [
+        ("target_state", "B")
+    ],
+    sketch="motors/motor_driver/March9doorcontrol_I2C_.ino/"
+           "March9doorcontrol_I2C_.ino.ino: SetDoorState_t",
+    sketch_size=4)
+
+SET_PRESSURE = PayloadSchema(
+    "SetPressure",
+    [
+        ("target_state", "B")
+    ],
+    sketch="Pressurization/pressurization_procedure/"
+           "pressurization_procedure.ino: SetPressure_t",
+    sketch_size=4)
+
+UPDATE_DISPLAY = PayloadSchema(
+    "UpdateDisplay",
+    [
+        ("o2", "h"),
+        ("co2", "h"),
+        ("temperature", "h"),
+        ("pressure", "h")
+    ],
+    sketch="hexdisplay/hexdisplay.ino: UpdateDisplay_t",
+    sketch_size=11)
+
+SCHEMAS = [
+    SENSOR_DATA,
+    DOOR_STATE,
+    SET_DOOR_STATE,
+    SET_PRESSURE,
+    UPDATE_DISPLAY
+]
+
+
+# ---------------------------------------------------------------------------
+# Registry
+# ---------------------------------------------------------------------------
+# Maps (address, procedure) to the schema of that payload.
+schema_registry = {}
+
+
+def register(address, procedure, schema):
+    procedure = int(getattr(procedure, "value", procedure))
+    key = (address, procedure)
+    if key in schema_registry and schema_registry[key] is not schema:
+        raise KeyError(
+            'Address %s procedure %i is already registered to %s!'
+            % (address, procedure, schema_registry[key].name))
+
+    schema_registry[key] = schema
+    return schema
+
+
+def get(address, procedure):
+    procedure = int(getattr(procedure, "value", procedure))
+    if (address, procedure) in schema_registry:
+        return schema_registry[(address, procedure)]
+    else:
+        raise KeyError(
+            "No schema registered for address %s procedure %i!"
+            % (address, procedure))
+
+
+def decode(address, procedure, message):
+    return get(address, procedure).decode(message)
+
+
+"""
+Check every schema against the size of the Arduino struct it mirrors.
+Returns a list of mismatch descriptions (empty if all schemas match).
+"""
+def verify(schemas=None):
+    mismatches = []
+    for schema in schemas or SCHEMAS:
+        if schema.codec.size != schema.sketch_size:
+            mismatches.append(
+                "%s is %i bytes but %s is %i bytes" % (
+                    schema.name, schema.codec.size,
+                    schema.sketch, schema.sketch_size))
+    return mismatches
+
+
+if __name__ == "__main__":
+    for schema in SCHEMAS:
+        print(schema)
+
+    mismatches = verify()
+    for mismatch in mismatches:
+        print("MISMATCH: %s" % mismatch)
+    print("%i schema(s) checked, %i mismatch(es)" % (
+        len(SCHEMAS), len(mismatches)))
@@ -1,19 +1,21 @@
-try:
-    import RPi.GPIO as gpio
-except ImportError:
-    print("Could not find the GPIO library. Are you on a Pi machine?")
-
 from collections import namedtuple
 from enum import Enum
+import threading
+import time
 
 import importlib
-import struct
+hardware = importlib.import_module('pi-systems_hardware')
+gpio = hardware.GPIO
 subsys = importlib.import_module('pi-systems_subsystem-base')
 comms = importlib.import_module('pi-systems_communications')
+schemas = importlib.import_module('pi-systems_payload-schemas')
+reconciler = importlib.import_module('pi-systems_reconciler')
 
 # needed to define a missing argument (loop delay) for the subsystems FSM, 
 # so we make a global constant
 DEFAULT_LOOP_DELAY = 750
+# Period of the closed-loop valve control, see PressureController.
+DEFAULT_CONTROL_DELAY = 100
 
 
 class PressureSubsystem(subsys.Subsystem):
@@ -39,36 +41,85 @@ class PressureSubsystem(subsys.Subsystem):
         Pressurize = 1
         Depressurize = 2
         Idle = 3
+        Emergency = 0  # Alias of close: valves shut
+
+    # The FSMs assign desired_state = 'Pressurize' etc. on every pass;
+    # that only publishes the desired mode to the controller, which decides
+    # the valve command, which the loop sends to the Arduino when it
+    # changes (see pi-systems_reconciler.py).
+    desired_state = reconciler.DesiredState(TargetState, target="controller")
 
-    def __init__(self, name=None, thread_id=None):
+    """
+    sensors: SensorSubsystem whose pressure history drives the closed-loop
+        control. Without it the FSM's desired_state is sent as is.
+    control_delay_ms: Period of the control loop, which runs on its own
+        thread next to the 750 ms loop that talks to the Arduino.
+    controller_options: Keyword arguments for the PressureController
+        (targets_hpa, bands_hpa, max_rate_hpa_s, lead_s, ...).
+    """
+    def __init__(self, name=None, thread_id=None, sensors=None,
+                 control_delay_ms=DEFAULT_CONTROL_DELAY,
+                 controller_options=None):
         super().__init__(name=name, thread_id=thread_id, loop_delay_ms = DEFAULT_LOOP_DELAY)
 
-        self.new_state = None
+        self.reconciler = reconciler.Reconciler(
+            self._send_state, on_desire=self.notify, name=name)
+        self.command_latency = self.reconciler.command_latency
+        self.controller = PressureController(
+            self.reconciler,
+            history=sensors.history if sensors else None,
+            **(controller_options or {}))
+        self.control_thread = subsys.Subsystem.SubsystemThread(
+            thread_id="%s-control" % thread_id,
+            loop=self.controller.step,
+            loop_delay_ms=control_delay_ms)
+        schemas.register(0x14, self.Procedure.SetPressure,
+                         schemas.SET_PRESSURE)
+
+    def start(self):
+        if self.thread.running:
+            return
+        super().start()
+        self.control_thread.start()
+
+    def stop(self):
+        self.control_thread.stop()
+        super().stop()
+
+    """
+    Whether the chamber is within the band of the target of the current
+    desired_state, as judged by the controller. None without sensors.
+    """
+    def target_reached(self):
+        if self.controller.history is None:
+            return None
+        return self.controller.reached
 
     # Task to run in a seperate thread
     def loop(self):
-        # Check if a new valve state has been requested
-        with self:
-            # Stub: Implement as shown below (and any extra if needed)
-            # Proceed if:
-            #       A new state has been requested
-            #       and the valve subsystem is not currently applying another state.
-
-                # Send the new state information to the Arduino - package data according to protocol.
-                if self.new_state is not None:
-                    self.data = [self.priority.Low_pri.value, self.new_state.value]
-                    #self.new_message = generate_intra_protocol_message(action=action1, procedure=self.Procedure.Procedure1)      
-                    self.new_message = comms.IntraModCommMessage.generate(action=comms.IntraModCommAction.ExecuteProcedure.value,
-                                                procedure=self.Procedure.SetPressure.value, 
-                                                data=self.data)
-                    comms.intra_write(0x14,self.new_message) # send new_message to arduino
-
-        # Set next_state to None, which will make sure the loop doesn't run again until the next request.
-        self.new_state = None
+        # Send the desired valve state to the Arduino if it does not have
+        # it yet, retrying with backoff if the bus fails.
+        self.reconciler.reconcile()
 
+    def _send_state(self, state):
+        # The FSMs set priority to 'low' or 'high' next to desired_state.
+        level = vars(self).get('priority', 'low')
+        # SetPressure_t: the priority travels in the header.
+        self.data = schemas.SET_PRESSURE.encode_payload(state.value)
+        self.new_message = comms.IntraModCommMessage.generate(action=comms.IntraModCommAction.ExecuteProcedure.value,
+                                    procedure=self.Procedure.SetPressure.value,
+                                    priority=PressureSubsystem.priority[level].value,
+                                    data=self.data)
+        comms.intra_write(0x14,self.new_message) # send new_message to arduino
+
+    """
+    Ask for a new TargetState. Returns a Future resolved once the Arduino
+    has acknowledged the valve command chosen for it (see
+    Reconciler.acknowledgement).
+    """
     def request_new_state(self, new_state):
 
-        if not isinstance(new_state, self.TargetState):  # new_state is not the expected object type:
+        if not isinstance(new_state, PressureSubsystem.TargetState):  # new_state is not the expected object type:
             raise TypeError("Type Error message")
 
         # the following is a data validity check (not an official error detection). Checks if data is out of range
@@ -78,8 +129,184 @@ class PressureSubsystem(subsys.Subsystem):
         # Any other checks that are needed - may want to discuss with team!
 
         # This should only run so long as all other condiitons pass.
-        with self:
-            self.new_state = new_state
+        self.controller.desire(new_state, new_state.name)
+        return self.reconciler.acknowledgement(self.reconciler.desired)
+
+
+class PressureController:
+    """
+    Purpose: Closed-loop stage between the PressureFSM and the valves.
+        The FSM asks for a mode (TargetState); the controller turns it into
+        the valve command handed to the reconciler. While pressurizing or
+        depressurizing it closes the valves (TargetState.close):
+            - Predictive close-off: once the pressure, extrapolated lead_s
+              ahead at its current rate, reaches the target. They stay
+              closed until a sample taken lead_s after closing shows the
+              pressure more than the band away from the target
+              (hysteresis), then reopen.
+            - Rate limit: while the pressure moves towards the target
+              faster than max_rate_hpa_s. The valves are on/off, so the
+              rate is limited by pulsing them.
+        reached is True once the valves have closed at the target and a
+        sample taken lead_s later is within the band of it, which is when
+        the FSM should end the cycle. The band is only a hysteresis: the
+        valves are never closed on it.
+        Any other mode is passed through unchanged.
+
+        The pressure is read from the SensorSubsystem history (lock-free):
+        the latest sample, and the least-squares rate over the last
+        rate_samples. The close-off extrapolates the latest sample at the
+        rate last measured with the valves open the whole window (pulsing
+        for the rate limit lowers the average rate, not the flow), which
+        is what lets the control loop run faster than the sensors.
+    reconciler: Reconciler the valve commands are published to.
+    history: SensorHistory with a 'pressure' channel in hPa. Without it,
+        or while its latest sample is older than max_age_s, the mode is
+        passed through.
+    targets_hpa: Target pressure of each controlled mode.
+    bands_hpa: Hysteresis band of each controlled mode.
+    max_rate_hpa_s: Fastest allowed pressure change, or None for no limit.
+    lead_s: How far ahead the close-off looks: valve response plus the
+        delay of a sensor reading.
+    clock: Callable returning the time of the history's timestamps.
+    """
+    TargetState = PressureSubsystem.TargetState
+
+    DEFAULT_TARGETS_HPA = {
+        TargetState.Pressurize: 1013,   # Earth atmosphere roughly 101.3kPa
+        TargetState.Depressurize: 6     # Martian Atmosphere 600 Pascals
+    }
+    DEFAULT_BANDS_HPA = {
+        TargetState.Pressurize: 3.0,
+        TargetState.Depressurize: 0.5
+    }
+    # +1 when the mode raises the pressure, -1 when it lowers it.
+    DIRECTIONS = {
+        TargetState.Pressurize: 1,
+        TargetState.Depressurize: -1
+    }
+
+    def __init__(
+        self,
+        reconciler,
+        history=None,
+        targets_hpa=None,
+        bands_hpa=None,
+        max_rate_hpa_s=None,
+        lead_s=1.0,
+        rate_samples=3,
+        max_age_s=10.0,
+        clock=time.time
+    ):
+        self.reconciler = reconciler
+        self.history = history
+        self.targets_hpa = dict(targets_hpa or
+                                PressureController.DEFAULT_TARGETS_HPA)
+        self.bands_hpa = dict(bands_hpa or
+                              PressureController.DEFAULT_BANDS_HPA)
+        self.max_rate_hpa_s = max_rate_hpa_s
+        self.lead_s = lead_s
+        self.rate_samples = rate_samples
+        self.max_age_s = max_age_s
+        self.clock = clock
+
+        self.mode = None
+        self.desired_name = None
+        self.holding = False
+        self.rate_limited = False
+        self.reached = False
+        self.pressure = None
+        self.rate = None
+        self.flow_rate = None
+        self._sampled = None
+        self._age = None
+        self._held_at = None
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "PressureController (mode=%s, pressure=%s, rate=%s, " \
+            "holding=%s, rate_limited=%s, reached=%s)" % (
+                self.desired_name, self.pressure, self.rate,
+                self.holding, self.rate_limited, self.reached)
+
+    """
+    Set the mode asked for by the FSM, and apply it right away.
+    """
+    def desire(self, state, name=None):
+        with self._lock:
+            self.desired_name = name
+            if state != self.mode:
+                self.mode = state
+                self.holding = self.rate_limited = self.reached = False
+                self.flow_rate = self._held_at = self._opened_at = None
+        self.step()
+
+    """
+    One pass of the control loop: publish the valve command for the
+    current mode and pressure.
+    """
+    def step(self):
+        with self._lock:
+            mode = self.mode
+            if mode is None:
+                return
+            command = mode
+            if mode in self.targets_hpa and self._measure():
+                if self._control(mode):
+                    command = PressureController.TargetState.close
+            else:
+                self.holding = self.rate_limited = self.reached = False
+            if command is not mode:
+                self._opened_at = None
+            elif self._opened_at is None:
+                self._opened_at = self.clock()
+        self.reconciler.desire(command, command.name)
+
+    def _measure(self):
+        if self.history is None:
+            return False
+        channel = self.history['pressure']
+        window = channel.snapshot(samples=self.rate_samples)
+        if not window:
+            return False
+        self._sampled, self.pressure = window[-1]
+        self._age = self.clock() - self._sampled
+        if self._age > self.max_age_s:
+            return False
+        self.rate = channel.slope(samples=self.rate_samples) or 0.0
+        if self._opened_at is not None and \
+                window[0][0] >= self._opened_at + self.lead_s:
+            self.flow_rate = self.rate
+        return True
+
+    # Returns True if the valves should be closed.
+    def _control(self, mode):
+        direction = PressureController.DIRECTIONS[mode]
+        target = self.targets_hpa[mode]
+        band = self.bands_hpa.get(mode, 0)
+        # Rates > 0 when moving towards the target.
+        rate = direction * self.rate
+        flow = direction * (self.rate if self.flow_rate is None
+                            else self.flow_rate)
+
+        # Distance still to go, measured and extrapolated.
+        error = direction * (target - self.pressure)
+        if not self.holding:
+            predicted = error - flow * (self._age + self.lead_s)
+            if predicted <= 0:
+                self.holding = True
+                self._held_at = self.clock()
+        # The rate of a closed chamber is not extrapolated.
+        settled = self.holding and \
+            self._sampled >= self._held_at + self.lead_s
+        if settled and error > band:
+            self.holding = False
+        self.reached = settled and error <= band
+
+        self.rate_limited = self.max_rate_hpa_s is not None \
+            and rate > self.max_rate_hpa_s
+        return self.holding or self.rate_limited
 
 # take dssp out in final code revision
 def dssp():
@@ -0,0 +1,233 @@
+import threading
+import time
+from concurrent.futures import Future
+import importlib
+log = importlib.import_module('pi-systems_log')
+
+"""
+Purpose: Desired-state reconciliation between the FSMs and the Arduinos.
+
+    The FSM callbacks assign the state they want on every pass of the
+    control loop (airlock_press_ss.desired_state = 'Pressurize',
+    airlock_door_ss.desired_state = 'OpenDoor', ...). Sending each of those
+    over I2C would repeat the same frame forever while nothing changes.
+    Instead the assignment only publishes the desired state, and the
+    subsystem's loop calls reconcile(), which sends a command only when
+    the desired state differs from the last one the Arduino acknowledged
+    (accepted on the bus). A failed send is retried with exponential
+    backoff, from the subsystem's loop.
+
+    acknowledgement() hands out a Future for callers that need to know
+    when the Arduino has the state, and the time from a new desired state
+    to its acknowledgement is kept in command_latency.
+
+    DesiredState is the class attribute that turns those assignments into
+    Reconciler.desire() calls.
+"""
+
+
+class CommandLatency:
+    """
+    Purpose: Time from a command being requested to the Arduino
+        acknowledging it.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total_s = 0
+        self.max_s = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "CommandLatency (%s)" % self.report()
+
+    def record(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total_s += seconds
+            self.max_s = max(self.max_s, seconds)
+
+    def report(self):
+        with self._lock:
+            return {
+                "commands": self.count,
+                "mean_ms":
+                    self.total_s * 1000 / self.count if self.count else 0,
+                "max_ms": self.max_s * 1000
+            }
+
+
+class Reconciler:
+    """
+    send: Callable sending one desired state to the Arduino. It must
+        raise (OSError, RuntimeError, ...) if the command was not accepted.
+    on_desire: Optional callable run when the desired state changes, e.g.
+        to wake the subsystem loop instead of waiting out its period.
+    initial_backoff_s: Delay before the first retry of a failed send.
+        Doubled on every further failure, up to max_backoff_s. Retries
+        run from the subsystem loop, so the delay is rounded up to its
+        period.
+    clock: Callable returning the current time in seconds.
+    name: Tag of the log records, e.g. the subsystem's name.
+    """
+    def __init__(
+        self,
+        send,
+        on_desire=None,
+        initial_backoff_s=0.5,
+        max_backoff_s=30.0,
+        clock=time.monotonic,
+        name="reconciler"
+    ):
+        self.send = send
+        self.on_desire = on_desire
+        self.initial_backoff_s = initial_backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.clock = clock
+        self.name = name
+
+        # Name the desired state was published under, and what it sends.
+        self.desired_name = None
+        self.desired = None
+        self.acknowledged = None
+        self.failures = 0
+        self.retry_at = None
+        self.stats = {"desired": 0, "unchanged": 0, "sent": 0, "failed": 0}
+        self.command_latency = CommandLatency()
+        self._desired_at = None
+        # (state, Future) of acknowledgement() calls not yet resolved.
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "Reconciler (desired=%s, acknowledged=%s, failures=%i)" % (
+            self.desired, self.acknowledged, self.failures)
+
+    """
+    True while the desired state has not been acknowledged. A desired
+    state of None means "no command", and is never sent.
+    """
+    @property
+    def pending(self):
+        return self.desired is not None and self.desired != self.acknowledged
+
+    """
+    Publish the desired state. Cheap enough to call on every FSM pass.
+    """
+    def desire(self, state, name=None):
+        with self._lock:
+            self.desired_name = name
+            if state == self.desired:
+                self.stats["unchanged"] += 1
+                return
+            self.desired = state
+            self._desired_at = self.clock()
+            self.stats["desired"] += 1
+            # A new target is sent right away, whatever the old one's
+            # backoff.
+            self.failures = 0
+            self.retry_at = None
+            superseded = [w for w in self._waiters if w[0] != state]
+            self._waiters = [w for w in self._waiters if w[0] == state]
+        for _, future in superseded:
+            future.cancel()
+        if self.on_desire and self.pending:
+            self.on_desire()
+
+    """
+    Send the desired state if the Arduino does not have it yet and no
+    backoff is running. Returns True if a command was acknowledged.
+    """
+    def reconcile(self):
+        with self._lock:
+            if not self.pending:
+                return False
+            now = self.clock()
+            if self.retry_at is not None and now < self.retry_at:
+                return False
+            state = self.desired
+
+        try:
+            self.send(state)
+        except Exception as e:
+            with self._lock:
+                self.failures += 1
+                self.stats["failed"] += 1
+                backoff = min(self.max_backoff_s, self.initial_backoff_s
+                              * 2 ** (self.failures - 1))
+                self.retry_at = self.clock() + backoff
+            log.w(self.name, "Could not send %s (%s), retrying in %.1f s",
+                  state, e, backoff)
+            return False
+
+        with self._lock:
+            self.acknowledged = state
+            self.failures = 0
+            self.retry_at = None
+            self.stats["sent"] += 1
+            latency = self.clock() - self._desired_at
+            acknowledged = [w for w in self._waiters if w[0] == state]
+            self._waiters = [w for w in self._waiters if w[0] != state]
+        self.command_latency.record(latency)
+        for _, future in acknowledged:
+            future.set_result(state)
+        return True
+
+    """
+    Future resolved with state once the Arduino has acknowledged it, right
+    away if it already has. It is cancelled if another state is desired
+    first. A state of None (no command) resolves right away.
+    """
+    def acknowledgement(self, state):
+        future = Future()
+        with self._lock:
+            if state is None or (state == self.acknowledged
+                                 and state == self.desired):
+                future.set_result(state)
+            elif state != self.desired:
+                future.cancel()
+            else:
+                self._waiters.append((state, future))
+        return future
+
+    """
+    Forget the acknowledged state, so the desired one is sent again (e.g.
+    after the Arduino has been reset).
+    """
+    def invalidate(self):
+        with self._lock:
+            self.acknowledged = None
+            self.retry_at = None
+            self._desired_at = self.clock()
+
+
+class DesiredState:
+    """
+    Purpose: Class attribute through which the FSMs publish a desired
+        state to a subsystem's `reconciler`.
+        Assigned on an instance: the name is looked up in states and
+            passed to instance.reconciler.desire().
+        Read on an instance: the name last assigned, or None.
+    states: Enum or mapping from the names the FSMs assign to the value
+        the reconciler sends (None for no command).
+    target: Attribute of the instance the desired state is published to,
+        for subsystems with a stage in front of their reconciler. It must
+        have desire(state, name) and desired_name.
+    """
+    def __init__(self, states, target="reconciler"):
+        self.states = states
+        self.target = target
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return getattr(instance, self.target).desired_name
+
+    def __set__(self, instance, name):
+        try:
+            state = self.states[name]
+        except KeyError:
+            raise ValueError("%s is not a valid %s!" % (name, self.name))
+        getattr(instance, self.target).desire(state, name)
@@ -0,0 +1,333 @@
+import argparse
+import importlib
+import time
+from collections import namedtuple
+clocks = importlib.import_module('pi-systems_clock')
+telemetry = importlib.import_module('pi-systems_telemetry-log')
+supervisor = importlib.import_module('pi-systems_fsm-supervisor')
+
+"""
+Purpose: Drive the real PressureFSM, DoorFSM and LightFSM from recorded
+    telemetry (sensor readings and input edges) under a virtual clock.
+
+    The FSMs are stepped by the same FSMSupervisor as loop_FSMs in
+    pi-systems_FSMs.py (see pi-systems_fsm-supervisor.py): every tick
+    looks at the current inputs and pressure and fires at most one event
+    per FSM. Instead of its thread, the replay ticks whenever a record
+    changes the inputs, so a full pressurization cycle replays in
+    milliseconds and every run of the same records gives the same
+    transitions at the same virtual times.
+
+    The subsystems are replaced by stand-ins that only remember what the
+    FSMs asked of them. The door stand-in reaches the requested position
+    after a fixed travel time on the virtual clock.
+
+Usage:
+    python pi-systems_replay.py --telemetry_dir /home/pi/telemetry
+    python pi-systems_replay.py            # Replays a synthetic cycle.
+"""
+
+ON = 1
+OFF = 0
+
+INPUT_DEFAULTS = supervisor.INPUT_DEFAULTS
+LED_NAMES = supervisor.LED_NAMES
+TARGET_PRESSURE = supervisor.TARGET_PRESSURE
+TARGET_DEPRESSURE = supervisor.TARGET_DEPRESSURE
+
+Transition = namedtuple(
+    "Transition", ["timestamp", "fsm", "event", "source", "target"])
+Cycle = namedtuple("Cycle", ["kind", "start", "end", "duration_s"])
+
+
+# ---------------------------------------------------------------------------
+# Subsystem stand-ins
+# ---------------------------------------------------------------------------
+class ReplayPressure:
+    def __init__(self):
+        self.desired_state = 'Idle'
+        self.priority = 'low'
+
+
+class ReplayDoor:
+    """
+    Purpose: Door stand-in. The door is reported in position travel_s
+        after OpenDoor or CloseDoor is requested.
+    """
+    def __init__(self, clock, travel_s=5.0):
+        self.clock = clock
+        self.travel_s = travel_s
+        self.priority = 'low'
+        self.position = 'closed'
+        self.deadline = None
+        self._procedure = 'Idle'
+
+    @property
+    def desired_state(self):
+        return self._procedure
+
+    @desired_state.setter
+    def desired_state(self, value):
+        if value != self._procedure and value in ('OpenDoor', 'CloseDoor'):
+            self.deadline = self.clock.now() + self.travel_s
+        elif value not in ('OpenDoor', 'CloseDoor'):
+            self.deadline = None
+        self._procedure = value
+
+    def update(self):
+        if self.deadline is not None and self.clock.now() >= self.deadline:
+            self.position = 'open' if self._procedure == 'OpenDoor' \
+                else 'closed'
+            self.deadline = None
+
+    @property
+    def in_position(self):
+        self.update()
+        return self.deadline is None and self.position == {
+            'OpenDoor': 'open', 'CloseDoor': 'closed'
+        }.get(self._procedure)
+
+
+class ReplayLights:
+    def __init__(self):
+        self.on = False
+
+    def toggle(self):
+        self.on = not self.on
+
+
+class ReplayLED:
+    def __init__(self, name):
+        self.name = name
+        self.state = OFF
+
+    def write(self, value):
+        self.state = value
+
+
+# ---------------------------------------------------------------------------
+# Replay
+# ---------------------------------------------------------------------------
+class ReplayEngine:
+    """
+    Purpose: Feed telemetry records into fresh FSM instances.
+    clock: Clock the replay runs on. A VirtualClock is created if omitted.
+    door_travel_s: Time the door stand-in takes to open or close.
+    """
+    def __init__(self, clock=None, door_travel_s=5.0):
+        self.clock = clock or clocks.VirtualClock()
+        self.pressure = None
+        self.leds = [ReplayLED(name) for name in LED_NAMES]
+        self.airlock_press_ss = ReplayPressure()
+        self.airlock_door_ss = ReplayDoor(self.clock, door_travel_s)
+        self.airlock_light_ss = ReplayLights()
+
+        self.supervisor = supervisor.FSMSupervisor(
+            self.airlock_press_ss,
+            self.airlock_door_ss,
+            self.airlock_light_ss,
+            self.leds,
+            read_pressure=lambda: self.pressure,
+            on_transition=self._on_transition)
+        self.inputs = self.supervisor.inputs
+        self.fsm_pressure = self.supervisor.fsm_pressure
+        self.fsm_door = self.supervisor.fsm_door
+        self.fsm_lights = self.supervisor.fsm_lights
+
+        self.transitions = []
+        self.records = 0
+        self._entered = {}
+        self._state_time = {}
+
+    """
+    Replay records (any iterable of telemetry.TelemetryRecord, e.g. a
+    TelemetryReader) and return a report of what the FSMs did.
+    """
+    def run(self, records):
+        started = time.perf_counter()
+        first = True
+        for record in records:
+            if first:
+                self.clock.advance_to(record.timestamp)
+                self._enter_all()
+                first = False
+            self._advance_to(record.timestamp)
+            self.apply(record)
+            self.settle()
+            self.records += 1
+
+        # Let a door that is still moving arrive.
+        if self.airlock_door_ss.deadline is not None:
+            self._advance_to(self.airlock_door_ss.deadline)
+        return self.report(time.perf_counter() - started)
+
+    def apply(self, record):
+        if record.type == telemetry.RecordType.SensorReadings:
+            self.pressure = record.data.get('pressure', self.pressure)
+        elif record.type == telemetry.RecordType.InputEdge:
+            self.supervisor.set_input(record.data.name, record.data.state)
+
+    """
+    Tick until no FSM changes state. Self-loop events still fire once per
+    tick, as they do in loop_FSMs.
+    """
+    def settle(self, max_steps=16):
+        self.supervisor.settle(max_steps)
+
+    """
+    One supervisor tick. Returns True if any FSM changed state.
+    """
+    def step(self):
+        return self.supervisor.tick()
+
+    def _on_transition(self, name, event, source, target):
+        now = self.clock.now()
+        self.transitions.append(
+            Transition(now, name, event, source, target))
+        if source != target:
+            self._leave(name, source, now)
+            self._entered[name] = (target, now)
+
+    def _advance_to(self, timestamp):
+        # A door arriving between records is an event of its own.
+        door = self.airlock_door_ss
+        while door.deadline is not None and door.deadline <= timestamp:
+            self.clock.advance_to(door.deadline)
+            self.settle()
+        self.clock.advance_to(timestamp)
+
+    def _enter_all(self):
+        now = self.clock.now()
+        for fsm in (self.fsm_pressure, self.fsm_door, self.fsm_lights):
+            self._entered[type(fsm).__name__] = (fsm.current_state.name, now)
+
+    def _leave(self, name, state, now):
+        _, entered = self._entered.get(name, (state, now))
+        key = (name, state)
+        self._state_time[key] = self._state_time.get(key, 0) + now - entered
+
+    """
+    Summary of the replay:
+        transitions: every event fired, including self-loops.
+        state_changes: only the transitions that changed state.
+        time_in_state_s: virtual seconds spent in each (fsm, state).
+        cycles: pressurize, depressurize, open and close cycles with
+            their virtual durations.
+    """
+    def report(self, wall_s=None):
+        now = self.clock.now()
+        for name, (state, _) in list(self._entered.items()):
+            self._leave(name, state, now)
+            self._entered[name] = (state, now)
+
+        state_changes = [t for t in self.transitions if t.source != t.target]
+        cycles = []
+        starts = {}
+        for t in state_changes:
+            if t.event.startswith('start_'):
+                starts[(t.fsm, t.event[len('start_'):])] = t.timestamp
+            elif t.event.startswith('done_'):
+                kind = t.event[len('done_'):]
+                start = starts.pop((t.fsm, kind), None)
+                if start is not None:
+                    cycles.append(
+                        Cycle(kind, start, t.timestamp, t.timestamp - start))
+
+        return {
+            "records": self.records,
+            "events": len(self.transitions),
+            "transitions": self.transitions,
+            "state_changes": state_changes,
+            "time_in_state_s": dict(self._state_time),
+            "cycles": cycles,
+            "virtual_s": now - (self.transitions[0].timestamp
+                                if self.transitions else now),
+            "wall_s": wall_s
+        }
+
+
+def replay(records, **kwargs):
+    return ReplayEngine(**kwargs).run(records)
+
+
+"""
+Records of a scripted pressurize, open, close and depressurize cycle,
+with sensor frames every sensor_period_s and pressure moving by
+rate_hpa_s. Useful for regression tests without a recorded log.
+"""
+def synthetic_cycle(start=0.0, sensor_period_s=2.0, rate_hpa_s=5.0):
+    t = start
+    pressure = float(TARGET_DEPRESSURE)
+
+    def edge(name, state):
+        return telemetry.TelemetryRecord(
+            telemetry.RecordType.InputEdge, t,
+            telemetry.InputEdge(name, state))
+
+    def sensors():
+        return telemetry.TelemetryRecord(
+            telemetry.RecordType.SensorReadings, t,
+            {'O2': 21, 'humidity': 40, 'temperature': 22,
+             'pressure': pressure, 'CO2': 400})
+
+    yield sensors()
+    yield edge('Enable P/D/H', 1)
+    yield edge('L', 1)
+    t += 0.5
+    yield edge('P', 1)
+    t += 0.2
+    yield edge('P', 0)
+    while pressure < TARGET_PRESSURE:
+        t += sensor_period_s
+        pressure = min(TARGET_PRESSURE,
+                       pressure + rate_hpa_s * sensor_period_s)
+        yield sensors()
+
+    for button in ('O', 'Cl'):
+        t += 1.0
+        yield edge(button, 1)
+        t += 0.2
+        yield edge(button, 0)
+        t += 10.0
+        yield sensors()
+
+    t += 1.0
+    yield edge('D', 1)
+    t += 0.2
+    yield edge('D', 0)
+    while pressure > TARGET_DEPRESSURE:
+        t += sensor_period_s
+        pressure = max(TARGET_DEPRESSURE,
+                       pressure - rate_hpa_s * sensor_period_s)
+        yield sensors()
+    t += 1.0
+    yield edge('L', 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay telemetry through the airlock FSMs")
+    parser.add_argument("--telemetry_dir",
+                        help="Telemetry log to replay. Without it a "
+                             "synthetic cycle is replayed.")
+    parser.add_argument("--since", type=float,
+                        help="Start at this timestamp.")
+    parser.add_argument("--door_travel", type=float, default=5.0)
+    args = parser.parse_args()
+
+    if args.telemetry_dir:
+        records = telemetry.TelemetryReader(args.telemetry_dir).seek(
+            args.since,
+            (telemetry.RecordType.SensorReadings,
+             telemetry.RecordType.InputEdge))
+    else:
+        records = synthetic_cycle()
+
+    result = replay(records, door_travel_s=args.door_travel)
+    for t in result["state_changes"]:
+        print("%10.3f  %-12s %-20s %s -> %s" % t)
+    for cycle in result["cycles"]:
+        print("%-14s %8.1f s" % (cycle.kind, cycle.duration_s))
+    print("%i records, %i events, %.1f s virtual in %.1f ms" % (
+        result["records"], result["events"],
+        result["virtual_s"], result["wall_s"] * 1000))
@@ -0,0 +1,179 @@
+import time
+from array import array
+
+"""
+Purpose: Fixed-capacity time series storage for sensor readings.
+    Each channel is a preallocated pair of arrays (timestamps, values)
+    used as a ring buffer, so memory stays bounded however long the
+    airlock runs. Appends are O(1), and windowed queries walk the buffer
+    in place instead of copying it.
+
+    There is a single writer (the owning subsystem's loop). Readers do
+    not take a lock: they note the write counter, read, then check that
+    the writer has not lapped the samples they read, and retry if it has.
+"""
+
+
+class RingBuffer:
+    """
+    capacity: Maximum number of samples kept. Oldest samples are
+        overwritten first.
+    """
+    __slots__ = ("capacity", "_times", "_values", "_written")
+
+    def __init__(self, capacity):
+        if capacity < 2:
+            raise ValueError("RingBuffer capacity must be at least 2!")
+
+        self.capacity = capacity
+        self._times = array('d', bytes(8 * capacity))
+        self._values = array('d', bytes(8 * capacity))
+        # Total number of samples ever appended. Publishing a sample is a
+        # single assignment to this counter.
+        self._written = 0
+
+    def __len__(self):
+        # The slot about to be overwritten is never handed to readers.
+        return min(self._written, self.capacity - 1)
+
+    def __repr__(self):
+        return "RingBuffer (capacity=%i, samples=%i)" % (
+            self.capacity, len(self))
+
+    def append(self, value, timestamp=None):
+        index = self._written % self.capacity
+        self._times[index] = time.time() if timestamp is None else timestamp
+        self._values[index] = value
+        self._written += 1
+
+    """
+    Most recent (timestamp, value), or None if the buffer is empty.
+    """
+    def latest(self):
+        def latest(seqs):
+            if not len(seqs):
+                return None
+            i = (seqs.stop - 1) % self.capacity
+            return (self._times[i], self._values[i])
+        return self._read(latest, samples=1)
+
+    """
+    Windowed queries. Restrict the window with either:
+        samples: the most recent N samples, or
+        seconds: samples no older than this many seconds before the newest.
+    With neither, the whole buffer is used. Empty windows return None.
+    """
+    def mean(self, samples=None, seconds=None):
+        def mean(seqs):
+            total = 0
+            for i in self._slots(seqs):
+                total += self._values[i]
+            return total / len(seqs) if len(seqs) else None
+        return self._read(mean, samples, seconds)
+
+    def min(self, samples=None, seconds=None):
+        return self._read(
+            lambda seqs: min(
+                (self._values[i] for i in self._slots(seqs)), default=None),
+            samples, seconds)
+
+    def max(self, samples=None, seconds=None):
+        return self._read(
+            lambda seqs: max(
+                (self._values[i] for i in self._slots(seqs)), default=None),
+            samples, seconds)
+
+    """
+    Least-squares rate of change over the window, in units per second.
+    """
+    def slope(self, samples=None, seconds=None):
+        def slope(seqs):
+            n = len(seqs)
+            if n < 2:
+                return None
+
+            # Offset times by the first sample to keep precision.
+            t0 = self._times[seqs.start % self.capacity]
+            sum_t = sum_v = sum_tt = sum_tv = 0
+            for i in self._slots(seqs):
+                t = self._times[i] - t0
+                v = self._values[i]
+                sum_t += t
+                sum_v += v
+                sum_tt += t * t
+                sum_tv += t * v
+
+            denominator = n * sum_tt - sum_t * sum_t
+            if denominator == 0:
+                return None
+            return (n * sum_tv - sum_t * sum_v) / denominator
+        return self._read(slope, samples, seconds)
+
+    """
+    Copy of the window as a list of (timestamp, value), oldest first.
+    """
+    def snapshot(self, samples=None, seconds=None):
+        return self._read(
+            lambda seqs: [
+                (self._times[i], self._values[i]) for i in self._slots(seqs)
+            ],
+            samples, seconds)
+
+    def _slots(self, seqs):
+        capacity = self.capacity
+        for seq in seqs:
+            yield seq % capacity
+
+    def _window(self, written, samples, seconds):
+        oldest = max(0, written - (self.capacity - 1))
+        start = oldest
+        if samples is not None:
+            start = max(oldest, written - samples)
+        if seconds is not None and written > oldest:
+            cutoff = self._times[(written - 1) % self.capacity] - seconds
+            seq = written
+            while seq > start and \
+                    self._times[(seq - 1) % self.capacity] >= cutoff:
+                seq -= 1
+            start = seq
+        return range(start, written)
+
+    def _read(self, query, samples=None, seconds=None):
+        while True:
+            written = self._written
+            seqs = self._window(written, samples, seconds)
+            result = query(seqs)
+
+            # The writer may be filling slot (_written % capacity), which
+            # holds sequence (_written - capacity). Anything newer is
+            # intact.
+            if seqs.start > self._written - self.capacity:
+                return result
+
+
+class SensorHistory:
+    """
+    Purpose: One RingBuffer per sensor channel.
+    channels: Names of the channels to keep.
+    capacity: Samples kept per channel. At the sensor subsystem's 2 s loop
+        the default covers roughly 4.5 hours.
+    """
+    DEFAULT_CAPACITY = 8192
+
+    def __init__(self, channels, capacity=DEFAULT_CAPACITY):
+        self.channels = {
+            channel: RingBuffer(capacity) for channel in channels
+        }
+
+    def __getitem__(self, channel):
+        return self.channels[channel]
+
+    def __repr__(self):
+        return "SensorHistory (%s)" % (
+            ", ".join("%s=%s" % item for item in self.channels.items()))
+
+    def append(self, readings, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        for channel, value in readings.items():
+            if channel in self.channels:
+                self.channels[channel].append(value, timestamp)
@@ -0,0 +1,241 @@
+import heapq
+import itertools
+import threading
+import time
+from enum import Enum
+import importlib
+log = importlib.import_module('pi-systems_log')
+
+"""
+Purpose: Central deadline-ordered scheduler for subsystem loops.
+    Rather than having every subsystem thread wake up periodically to
+    check if its loop is due, all periodic tasks are kept in a heap
+    ordered by their next run time. A single scheduler thread sleeps on
+    a condition variable until the earliest deadline, then dispatches
+    the task.
+More information on this is included in the README file of the directory.
+"""
+
+
+class Scheduler:
+
+    class Mode(Enum):
+        # The next run is planned from the previous deadline, so the loop
+        # period does not drift. Missed periods are skipped, not replayed.
+        FixedRate = "fixed_rate"
+        # The next run is planned from the end of the previous run.
+        FixedDelay = "fixed_delay"
+
+    """
+    Purpose: A single periodic entry in the scheduler, along with the
+        timing statistics collected for it.
+    """
+    class Task:
+        __slots__ = (
+            "name", "period_ms", "mode", "dispatch", "deadline",
+            "in_flight", "woken", "cancelled", "runs", "overruns",
+            "last_jitter_ms", "max_jitter_ms", "total_jitter_ms",
+            "last_duration_ms", "max_duration_ms")
+
+        def __init__(self, name, period_ms, mode, dispatch):
+            self.name = name
+            self.period_ms = period_ms
+            self.mode = mode
+            self.dispatch = dispatch
+            self.deadline = None
+            self.in_flight = False
+            self.woken = False
+            self.cancelled = False
+
+            self.runs = 0
+            self.overruns = 0
+            self.last_jitter_ms = 0
+            self.max_jitter_ms = 0
+            self.total_jitter_ms = 0
+            self.last_duration_ms = 0
+            self.max_duration_ms = 0
+
+        def stats(self):
+            return {
+                "runs": self.runs,
+                "overruns": self.overruns,
+                "last_jitter_ms": self.last_jitter_ms,
+                "max_jitter_ms": self.max_jitter_ms,
+                "mean_jitter_ms":
+                    self.total_jitter_ms / self.runs if self.runs else 0,
+                "last_duration_ms": self.last_duration_ms,
+                "max_duration_ms": self.max_duration_ms
+            }
+
+        def __repr__(self):
+            return "Task (name=%s, period_ms=%s, mode=%s)" % (
+                self.name, self.period_ms, self.mode.value)
+
+    """
+    name: Name given to the scheduler's dispatch thread.
+    clock: Callable returning the current time in seconds. Must be
+        monotonic.
+    """
+    def __init__(self, name="subsystem-scheduler", clock=time.monotonic):
+        self.name = name
+        self.clock = clock
+        self.running = False
+
+        self._heap = []
+        self._tasks = set()
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    """
+    Register a periodic task. The dispatch callable is invoked from the
+    scheduler thread once the task is due, and must return quickly; the
+    owner then calls done() once the run has completed, which plans the
+    next run. A task is never dispatched again while it is in flight.
+    """
+    def add(
+        self,
+        name,
+        period_ms,
+        dispatch,
+        mode=None,
+        start_delay_ms=None
+    ):
+        task = Scheduler.Task(
+            name=name,
+            period_ms=period_ms,
+            mode=mode or Scheduler.Mode.FixedRate,
+            dispatch=dispatch)
+
+        delay_ms = period_ms if start_delay_ms is None else start_delay_ms
+        with self._cond:
+            self._tasks.add(task)
+            self._push(task, self.clock() + delay_ms / 1000)
+            self._cond.notify()
+
+        if not self.running:
+            self.start()
+        return task
+
+    def remove(self, task):
+        with self._cond:
+            # Heap entries are invalidated lazily when popped.
+            task.cancelled = True
+            self._tasks.discard(task)
+            self._cond.notify()
+
+    """
+    Mark a dispatched run as complete and plan the next one.
+    started: Clock time at which the run actually began.
+    """
+    def done(self, task, started=None):
+        finished = self.clock()
+        with self._cond:
+            task.in_flight = False
+            if task.cancelled:
+                return
+
+            if started is not None:
+                task.last_duration_ms = (finished - started) * 1000
+                task.max_duration_ms = max(
+                    task.max_duration_ms, task.last_duration_ms)
+
+            period = task.period_ms / 1000
+            if task.woken:
+                task.woken = False
+                next_deadline = finished
+            elif task.mode is Scheduler.Mode.FixedDelay:
+                next_deadline = finished + period
+            else:
+                next_deadline = task.deadline + period
+                if next_deadline <= finished:
+                    missed = int((finished - next_deadline) // period) + 1
+                    task.overruns += missed
+                    next_deadline += missed * period
+
+            self._push(task, next_deadline)
+            self._cond.notify()
+
+    """
+    Bring a task's next run forward to now. If the task is currently
+    running, it will be dispatched again as soon as it completes.
+    """
+    def wake(self, task):
+        with self._cond:
+            if task.cancelled:
+                return
+            if task.in_flight:
+                task.woken = True
+                return
+            self._push(task, self.clock())
+            self._cond.notify()
+
+    def start(self):
+        with self._cond:
+            if self.running:
+                return
+            self.running = True
+            self._thread = threading.Thread(
+                name=self.name,
+                target=self._run,
+                daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self.running = False
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            tasks = list(self._tasks)
+        return {task.name: task.stats() for task in tasks}
+
+    def _push(self, task, deadline):
+        task.deadline = deadline
+        heapq.heappush(self._heap, (deadline, next(self._counter), task))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                task = None
+                while self.running:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+
+                    deadline, _, task = self._heap[0]
+                    if task.cancelled or deadline != task.deadline:
+                        # Stale entry left behind by remove() or wake().
+                        heapq.heappop(self._heap)
+                        task = None
+                        continue
+
+                    now = self.clock()
+                    if deadline > now:
+                        self._cond.wait(deadline - now)
+                        task = None
+                        continue
+
+                    heapq.heappop(self._heap)
+                    task.in_flight = True
+                    task.runs += 1
+                    task.last_jitter_ms = (now - deadline) * 1000
+                    task.total_jitter_ms += task.last_jitter_ms
+                    task.max_jitter_ms = max(
+                        task.max_jitter_ms, task.last_jitter_ms)
+                    break
+
+                if not self.running:
+                    return
+
+            try:
+                task.dispatch()
+            except Exception as e:
+                log.e(self.name, "Could not dispatch task %s: %s",
+                      task.name, e)
+                self.done(task)
+
+
+# Shared scheduler used by every subsystem thread.
+default_scheduler = Scheduler()
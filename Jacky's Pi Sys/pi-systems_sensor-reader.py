@@ -1,10 +1,74 @@
 import importlib
 import time
-import struct
+import warnings
 from enum import Enum
 from collections import namedtuple
+from collections.abc import Mapping
+import numpy as np
 subsys = importlib.import_module('pi-systems_subsystem-base')
 comms = importlib.import_module('pi-systems_communications')
+schemas = importlib.import_module('pi-systems_payload-schemas')
+ring_buffer = importlib.import_module('pi-systems_ring-buffer')
+telemetry = importlib.import_module('pi-systems_telemetry-log')
+log = importlib.import_module('pi-systems_log')
+
+
+# NumPy equivalents of the struct formats used by the sensor schema, so
+# raw frames can be viewed as a structured array without decoding.
+_FORMAT_DTYPES = {'B': 'u1', 'h': '<i2', 'H': '<u2'}
+SENSOR_DTYPE = np.dtype([
+    (name, _FORMAT_DTYPES[fmt]) for name, fmt in schemas.SENSOR_DATA.fields
+])
+assert SENSOR_DTYPE.itemsize == schemas.SENSOR_DATA.codec.size
+
+
+class SensorSnapshot(Mapping):
+    """
+    Purpose: One complete set of averaged readings, as published by
+        SensorSubsystem. Snapshots are never modified: each reading
+        replaces the subsystem's snapshot with a new one in a single
+        assignment, so a reader holding a snapshot always sees the values
+        of one reading, without taking a lock.
+        Channels read either as a dict (snapshot['pressure']) or as
+        attributes (snapshot.pressure).
+    version: Number of readings published before and including this one.
+        0 for the snapshot in place before the first reading.
+    timestamp: Clock time of the reading, or None for version 0.
+    readings: {channel: value}
+    """
+    __slots__ = ("version", "timestamp", "_readings")
+
+    def __init__(self, version, timestamp, readings):
+        object.__setattr__(self, "version", version)
+        object.__setattr__(self, "timestamp", timestamp)
+        object.__setattr__(self, "_readings", dict(readings))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SensorSnapshot is read-only!")
+
+    def __getitem__(self, channel):
+        return self._readings[channel]
+
+    def __getattr__(self, channel):
+        if channel.startswith("_"):
+            raise AttributeError(channel)
+        try:
+            return self._readings[channel]
+        except KeyError:
+            raise AttributeError(channel)
+
+    def __iter__(self):
+        return iter(self._readings)
+
+    def __len__(self):
+        return len(self._readings)
+
+    def __reduce__(self):
+        return (SensorSnapshot, (self.version, self.timestamp, self._readings))
+
+    def __repr__(self):
+        return "SensorSnapshot (version=%i, %s)" % (
+            self.version, self._readings)
 
 
 class SensorSubsystem(subsys.Subsystem):
@@ -14,107 +78,149 @@ class SensorSubsystem(subsys.Subsystem):
     class Procedure(Enum):
         GetSensorData = 1
 
-    def __init__(self, name=None, thread_id=None, addresses=None):
+    # How readings from several sensor boards are combined into one value.
+    #   Mean: average of all valid readings.
+    #   Median: median of all valid readings; robust to one bad board.
+    #   TrimmedMean: mean after dropping trim_fraction of the readings
+    #                from each end.
+    class Aggregate(Enum):
+        Mean = "mean"
+        Median = "median"
+        TrimmedMean = "trimmed_mean"
+
+    # Channels in sensor_data, in frame order, along with the dataFlags
+    # bit marking each one as valid (see integrated_sensors.ino).
+    CHANNELS = ['O2', 'humidity', 'temperature', 'pressure', 'CO2']
+    CHANNEL_BITS = np.array([1 << 7, 1 << 6, 1 << 5, 1 << 4, 1 << 3])
+
+    def __init__(
+        self,
+        name=None,
+        thread_id=None,
+        addresses=None,
+        aggregate=Aggregate.Mean,
+        trim_fraction=0.25,
+        history_capacity=ring_buffer.SensorHistory.DEFAULT_CAPACITY,
+        clock=time.time
+    ):
         super().__init__(name=name, thread_id=thread_id, loop_delay_ms=2000)
 
-        # namedtuple is temporarily a dict for pickling purposes.
-        self.sensor_data = {}  # self.SensorData(0,0,0,0,0)
         # sets addresses to a list of 1 or more addresses
         self.addresses = addresses if isinstance(addresses,
                                                  list) else [addresses]
+        for address in self.addresses:
+            schemas.register(address, self.Procedure.GetSensorData,
+                             schemas.SENSOR_DATA)
+        self.aggregate = SensorSubsystem.Aggregate(aggregate)
+        self.trim_fraction = trim_fraction
         self.print_updates = False
+        # Timestamps of the history, e.g. a simulator clock's now().
+        self.clock = clock
+
+        # Preallocated buffers, one row per sensor board.
+        self._frames = np.zeros(len(self.addresses), dtype=SENSOR_DTYPE)
+        self._frame_bytes = self._frames.view(np.uint8).reshape(
+            len(self.addresses), SENSOR_DTYPE.itemsize)
+        self._received = np.zeros(len(self.addresses), dtype=bool)
 
-        self.sensor_data = {
-            'O2': 0,
-            'humidity': 0,
-            'temperature': 0,
-            'pressure': 0,
-            'CO2': 0
-        }
+        # Bounded history of every averaged reading, for trend and
+        # rate-of-change queries, e.g. history['pressure'].slope(seconds=10)
+        self.history = ring_buffer.SensorHistory(
+            self.CHANNELS, history_capacity)
 
+        # Latest readings. Replaced, never modified, by the loop, so it
+        # can be read from any thread without the subsystem lock.
+        self.sensor_data = SensorSnapshot(
+            0, None, {channel: 0 for channel in self.CHANNELS})
 
+    """
+    Number of readings published so far.
+    """
+    @property
+    def version(self):
+        return self.sensor_data.version
+
+    # The bus is read without the subsystem lock held, so "with sensors:"
+    # never waits on I2C. Loops of one subsystem never overlap, so the
+    # frame buffers need no lock either.
     def loop(self):
-        with self.lock:
-            self.__update_sensor_data()
+        self.__update_sensor_data()
 
-            if self.print_updates:
-                print(self.sensor_data)
+        if self.print_updates:
+            # Snapshots never change, so formatting it later is safe.
+            log.i(self.name, "%s", self.sensor_data)
 
     def __update_sensor_data(self):
-        # return
-        # comms._write(self.address, comms.IntraModCommMessage.generate(
-        #     action=comms.IntraModCommAction.ExecuteProcedure,
-        #     procedure=1
-        # ))
-        #
-        # init values to 0
-        O2Val = 0
-        humidityVal = 0
-        temperatureVal = 0
-        pressureVal = 0
-        C02Val = 0
-
-        numReadingsO2 = 0
-        numReadingsHumidity = 0
-        numReadingsTemp = 0
-        numReadingsPressure = 0
-        numReadingsC02 = 0
-        # read all the data from multiple addresses if they exist and then
-        # get the average of valid readings and store into sensor_data
-        # dictionary also checking valid dataFlags bitmask
-        for addressVal in self.addresses:
+        self.__read_frames()
+        averages = self.__aggregate_frames()
+
+        now = self.clock()
+        snapshot = SensorSnapshot(
+            self.sensor_data.version + 1, now,
+            zip(self.CHANNELS, averages.tolist()))
+        self.history.append(snapshot, now)
+        telemetry.record_sensors(snapshot, now)
+        self.sensor_data = snapshot
+
+    def __read_frames(self):
+        # Queue a read for every board up front so the bus manager can run
+        # them back to back, then collect the raw frames.
+        procedure = self.Procedure.GetSensorData.value
+        pending = [
+            comms.intra_read_async(address, procedure)
+            for address in self.addresses
+        ]
+
+        frame_size = SENSOR_DTYPE.itemsize
+        for row, request in enumerate(pending):
+            self._received[row] = False
             try:
-                # extract raw sensor data
-                sensor_data_raw = comms.intra_read(
-                    addressVal, self.Procedure.GetSensorData.value)
-                # unpack sensor_data_raw into sensor_data following
-                # struct created in AirlockMasters/sensors/Integrated
-                # sensors/integrated_sensors/integrated_sensors.ino
-                sensor_data = struct.unpack(
-                    'cccBBBhHH', bytes(sensor_data_raw.raw_array[
-                        0:struct.calcsize('cccBBBhHH')]))
-                # sensor_data[3] is validFlag readings mask
-                validData = sensor_data[3]
-                # bitwise AND bitmask to see if data is valid and read
-                if validData & 1 << 7:
-                    O2Val += sensor_data[4]
-                    numReadingsO2 += 1
-                if validData & 1 << 6:
-                    humidityVal += sensor_data[5]
-                    numReadingsHumidity += 1
-                if validData & 1 << 5:
-                    temperatureVal += sensor_data[6]
-                    numReadingsTemp += 1
-                if validData & 1 << 4:
-                    pressureVal += sensor_data[7]
-                    numReadingsPressure += 1
-                if validData & 1 << 3:
-                    C02Val += sensor_data[8]
-                    numReadingsC02 += 1
-            except ValueError as ve:
-                print("Invalid object read from I2C.\n\tStackTrace: " +
-                      str(ve) + "\n\tSkipping line...")
-
-        # computes average of all readings if they have been read at least once
-        if numReadingsO2 != 0:
-            O2Val = O2Val / numReadingsO2
-        if numReadingsHumidity != 0:
-            humidityVal = humidityVal / numReadingsHumidity
-        if numReadingsTemp != 0:
-            temperatureVal = temperatureVal / numReadingsTemp
-        if numReadingsPressure != 0:
-            pressureVal = pressureVal / numReadingsPressure
-        if numReadingsC02 != 0:
-            C02Val = C02Val / numReadingsC02
-
-        # stores average readings into dictionary
-        self.sensor_data = {
-            'O2': O2Val,
-            'humidity': humidityVal,
-            'temperature': temperatureVal,
-            'pressure': pressureVal,
-            'CO2': C02Val
-        }
+                raw = request.result()
+                if not raw or len(raw) < frame_size:
+                    raise ValueError(
+                        "expected a %i byte frame from address %s"
+                        % (frame_size, self.addresses[row]))
+                self._frame_bytes[row] = raw[:frame_size]
+                self._received[row] = True
+            except (ValueError, OSError) as e:
+                log.w(self.name, "Invalid object read from I2C: %s",
+                      e, address=self.addresses[row])
+
+        # Publishing zeros would hide the failure; keep the last reading
+        # and fail the loop so the Watchdog counts it.
+        if not self._received.any():
+            raise OSError("no sensor board answered")
+
+    def __aggregate_frames(self):
+        # (boards x channels) readings and validity mask from dataFlags.
+        values = np.stack(
+            [self._frames[c] for c in self.CHANNELS], axis=1
+        ).astype(np.float64)
+        valid = (self._frames['data_flags'][:, None] & self.CHANNEL_BITS) != 0
+        valid &= self._received[:, None]
+        counts = valid.sum(axis=0)
+
+        if self.aggregate is SensorSubsystem.Aggregate.Mean:
+            totals = np.where(valid, values, 0).sum(axis=0)
+            result = totals / np.maximum(counts, 1)
+        else:
+            masked = np.where(valid, values, np.nan)
+            if self.aggregate is SensorSubsystem.Aggregate.Median:
+                with warnings.catch_warnings():
+                    # Channels with no valid reading are handled below.
+                    warnings.simplefilter("ignore", RuntimeWarning)
+                    result = np.nanmedian(masked, axis=0)
+            else:
+                # NaNs sort last, so valid readings occupy rows [0, count).
+                ordered = np.sort(masked, axis=0)
+                cut = np.floor(counts * self.trim_fraction).astype(int)
+                rank = np.arange(len(self.addresses))[:, None]
+                keep = (rank >= cut) & (rank < counts - cut)
+                result = np.where(keep, ordered, 0).sum(axis=0) \
+                    / np.maximum(keep.sum(axis=0), 1)
+
+        # Channels which were never read report 0, as before.
+        return np.where(counts > 0, result, 0)
 
     def error_check(self):
         CO2 = self.sensor_data.CO2
@@ -124,12 +230,12 @@ class SensorSubsystem(subsys.Subsystem):
         PRESS = self.sensor_data.pressure
 
         if(15 < O2 < 25):
-            print("O2 is nominal")
+            log.i(self.name, "O2 is nominal")
         if(300 < CO2 < 800):
-            print("CO2 is nominal")
+            log.i(self.name, "CO2 is nominal")
         if(-15 < TEMP < 40):
-            print("Temperature is nominal")
+            log.i(self.name, "Temperature is nominal")
         if(80 < PRESS < 140):
-            print("Pressure is nominal")
+            log.i(self.name, "Pressure is nominal")
         if(20 < HUM < 80):
-            print("Humidity is nominal")
+            log.i(self.name, "Humidity is nominal")
@@ -0,0 +1,636 @@
+import errno
+import os
+import random
+import struct
+import threading
+import importlib
+clocks = importlib.import_module('pi-systems_clock')
+chamber_model = importlib.import_module('pi-systems_chamber-model')
+
+"""
+Purpose: In-process stand-ins for smbus.SMBus and RPi.GPIO, so the whole
+    pi stack can run (and be load-tested) on any Linux box.
+
+    SimulatedBus routes block reads and writes to simulated Arduinos.
+    Each one mirrors its sketch: it receives and sends the same bytes,
+    laid out as the C structs in the .ino files. The structs are written
+    out again here, independently of pi-systems_payload-schemas.py, so
+    the simulator also checks the schemas. Bus latency and NACKs
+    (OSError 121, as raised by smbus) can be configured.
+
+    SimulatedGPIO implements the subset of RPi.GPIO used by the
+    subsystems, plus drive() for pushing a button or flipping a switch.
+
+    Use it through pi-systems_hardware.py rather than directly.
+"""
+
+
+# ---------------------------------------------------------------------------
+# Arduinos
+# ---------------------------------------------------------------------------
+class I2CDevice:
+    """
+    Purpose: Base class of a simulated I2C slave.
+    address: 7-bit I2C address the sketch passes to Wire.begin().
+    clock: Clock used for anything that takes time on the device.
+    """
+    def __init__(self, address, clock=None):
+        self.address = address
+        self.clock = clock or clocks.WallClock()
+        # Set to False to make the device NACK every transaction.
+        self.online = True
+
+    def __repr__(self):
+        return "%s (address=%s)" % (type(self).__name__, self.address)
+
+    # Wire.onReceive: the master wrote these bytes.
+    def receive(self, data):
+        pass
+
+    # Wire.onRequest: the bytes the sketch writes back.
+    def request(self):
+        return b""
+
+
+class SensorBoard(I2CDevice):
+    """
+    Purpose: integrated_sensors.ino. Answers every read with its send_data
+        struct.
+    readings: Initial readings (see DEFAULT_READINGS).
+    source: Optional callable returning the current readings dict, e.g. a
+        chamber model. Overrides readings.
+    """
+    SLAVE_ADDRESS = 10
+    # typedef struct { byte action, procedure, priority, dataFlags, s_O2,
+    # s_humidity; tempL, tempH, pressL, pressH, CO2L, CO2H } send_data;
+    SEND_DATA = struct.Struct("<BBBBBBhHH")
+    DATA_MASK = 0b11111000
+
+    DEFAULT_READINGS = {
+        'O2': 21,
+        'humidity': 40,
+        'temperature': 22,
+        'pressure': 1013,
+        'CO2': 400
+    }
+
+    def __init__(self, address=SLAVE_ADDRESS, clock=None, readings=None,
+                 source=None):
+        super().__init__(address, clock)
+        self.readings = dict(readings or SensorBoard.DEFAULT_READINGS)
+        self.source = source
+        self.data_flags = SensorBoard.DATA_MASK
+        self.received_cmd = 0
+
+    def receive(self, data):
+        self.received_cmd = data[-1]
+
+    def request(self):
+        readings = self.source() if self.source else self.readings
+        # The sketch truncates to int and masks to the field width.
+        return SensorBoard.SEND_DATA.pack(
+            0, 0, 0,
+            self.data_flags,
+            int(readings['O2']) & 0xFF,
+            int(readings['humidity']) & 0xFF,
+            ((int(readings['temperature']) + 0x8000) & 0xFFFF) - 0x8000,
+            int(readings['pressure']) & 0xFFFF,
+            int(readings['CO2']) & 0xFFFF)
+
+
+class DoorController(I2CDevice):
+    """
+    Purpose: March9doorcontrol_I2C_.ino. Takes SetDoorState_t and answers
+        reads with GetDoorState_t. The stepper moves at a constant speed
+        (acceleration is ignored) between closed (0) and open (2 * RIGHT).
+    speed: Stepper speed, in steps per second.
+    """
+    SLAVE_ADDRESS = 45
+    SET_DOOR_STATE = 3
+    GET_DOOR_STATE = 4
+    RIGHT = 2308
+    OPEN_POSITION = 2 * RIGHT
+    CLOSED_POSITION = 0
+
+    # DoorState enum
+    UNKNOWN = 0
+    TRANSIT = 3
+    CLOSE = 99
+    OPEN = 111
+    MANUAL_CALIBRATE = 113
+
+    # SetDoorState_t: header, byte targetState
+    SET_DOOR_STATE_T = struct.Struct("<BBBB")
+    # GetDoorState_t: header, byte DoorState, short angle
+    GET_DOOR_STATE_T = struct.Struct("<BBBBh")
+
+    def __init__(self, address=SLAVE_ADDRESS, clock=None, speed=400):
+        super().__init__(address, clock)
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._from = DoorController.CLOSED_POSITION
+        self._to = DoorController.CLOSED_POSITION
+        self._started = self.clock.now()
+
+    @property
+    def position(self):
+        with self._lock:
+            return self._position(self.clock.now())
+
+    @property
+    def door_state(self):
+        position = self.position
+        if position == DoorController.OPEN_POSITION:
+            return DoorController.OPEN
+        if position == DoorController.CLOSED_POSITION:
+            return DoorController.CLOSE
+        return DoorController.TRANSIT
+
+    def receive(self, data):
+        if len(data) < DoorController.SET_DOOR_STATE_T.size:
+            return
+        _, procedure, _, target = DoorController.SET_DOOR_STATE_T.unpack_from(
+            bytes(data))
+        if procedure & 0x7F != DoorController.SET_DOOR_STATE:
+            return
+
+        with self._lock:
+            now = self.clock.now()
+            position = self._position(now)
+            if target == DoorController.OPEN:
+                self._move(position, DoorController.OPEN_POSITION, now)
+            elif target == DoorController.CLOSE:
+                self._move(position, DoorController.CLOSED_POSITION, now)
+            elif target == DoorController.MANUAL_CALIBRATE:
+                self._move(0, 0, now)
+
+    def request(self):
+        return DoorController.GET_DOOR_STATE_T.pack(
+            0, DoorController.GET_DOOR_STATE, 0,
+            self.door_state, int(self.position))
+
+    def _move(self, start, end, now):
+        self._from, self._to, self._started = start, end, now
+
+    def _position(self, now):
+        travelled = (now - self._started) * self.speed
+        if travelled >= abs(self._to - self._from):
+            return self._to
+        direction = 1 if self._to > self._from else -1
+        return self._from + direction * int(travelled)
+
+
+class PressureController(I2CDevice):
+    """
+    Purpose: pressurization_procedure.ino. Takes SetPressure_t and drives
+        the two valves. The sketch waits valve_delay_s between switching
+        the pressurizer and the depressurizer. Reads return nothing, as
+        sendData() is a stub.
+    on_change: Optional callable run just before the valves change, e.g.
+        to bring a chamber model up to date with the old valve states.
+    """
+    SLAVE_ADDRESS = 0x14
+    SET_PRESSURE = 3
+
+    # TargetState enum
+    CLOSE = 0
+    PRESSURIZE = 1
+    DEPRESSURIZE = 2
+    IDLE = 3
+
+    # Valve pin levels (pressurizer, depressurizer) per target state.
+    # The pressurizer opens LOW and the depressurizer opens HIGH.
+    VALVE_STATES = {
+        PRESSURIZE: (0, 0),
+        DEPRESSURIZE: (1, 1),
+        CLOSE: (1, 0),
+        IDLE: (1, 0)
+    }
+
+    # SetPressure_t: action, procedure, priority, targetState
+    SET_PRESSURE_T = struct.Struct("<BBBB")
+
+    def __init__(self, address=SLAVE_ADDRESS, clock=None, valve_delay_s=1.0,
+                 on_change=None):
+        super().__init__(address, clock)
+        self.valve_delay_s = valve_delay_s
+        self.on_change = on_change
+        self.target_state = PressureController.CLOSE
+        self._previous = PressureController.VALVE_STATES[self.target_state]
+        self._changed = self.clock.now() - valve_delay_s
+
+    @property
+    def valves(self):
+        return self.valves_at(self.clock.now())
+
+    """
+    Valve pin levels at a clock time since the last command.
+    """
+    def valves_at(self, at):
+        pressurizer, depressurizer = \
+            PressureController.VALVE_STATES[self.target_state]
+        if at - self._changed < self.valve_delay_s:
+            depressurizer = self._previous[1]
+        return pressurizer, depressurizer
+
+    """
+    (pressurizer_open, depressurizer_open) at a clock time since the last
+    command. Usable as ChamberModel.valves.
+    """
+    def valves_open(self, at):
+        pressurizer, depressurizer = self.valves_at(at)
+        return pressurizer == 0, depressurizer == 1
+
+    """
+    Clock time the depressurizer switches after the last command.
+    Usable as ChamberModel.valve_switch.
+    """
+    def valve_switch(self):
+        return self._changed + self.valve_delay_s
+
+    @property
+    def pressurizer_open(self):
+        return self.valves[0] == 0
+
+    @property
+    def depressurizer_open(self):
+        return self.valves[1] == 1
+
+    def receive(self, data):
+        if len(data) < PressureController.SET_PRESSURE_T.size:
+            return
+        action, procedure, _, target = \
+            PressureController.SET_PRESSURE_T.unpack_from(bytes(data))
+        # evaluateMessage() ignores messages with an empty action byte.
+        if action == 0 or procedure & 0x7F != PressureController.SET_PRESSURE:
+            return
+        if target not in PressureController.VALVE_STATES:
+            return
+
+        if self.on_change:
+            self.on_change()
+        self._previous = self.valves
+        self._changed = self.clock.now()
+        self.target_state = target
+
+
+class HexDisplay(I2CDevice):
+    """
+    Purpose: hexdisplay.ino. Copies UpdateDisplay_t into the values shown
+        on the four TM1637 displays.
+    """
+    SLAVE_ADDRESS = 41
+    DISPLAYS = ['o2', 'co2', 'temperature', 'pressure']
+    # UpdateDisplay_t: header, int16_t o2, co2, temperature, pressure
+    UPDATE_DISPLAY_T = struct.Struct("<BBBhhhh")
+
+    def __init__(self, address=SLAVE_ADDRESS, clock=None):
+        super().__init__(address, clock)
+        self.values = {'o2': 21, 'co2': 31, 'temperature': 10,
+                       'pressure': 101}
+
+    def receive(self, data):
+        # The sketch copies sizeof(UpdateDisplay_t) bytes, zero padded.
+        size = HexDisplay.UPDATE_DISPLAY_T.size
+        frame = bytes(data[:size]).ljust(size, b"\0")
+        fields = HexDisplay.UPDATE_DISPLAY_T.unpack(frame)[3:]
+        self.values = dict(zip(HexDisplay.DISPLAYS, fields))
+
+    """
+    The four digits displayWrite() puts on a display.
+    """
+    def digits(self, display):
+        value = self.values[display]
+        return [int(value / place) % 10 for place in (1000, 100, 10, 1)]
+
+
+# ---------------------------------------------------------------------------
+# Bus
+# ---------------------------------------------------------------------------
+class SimulatedBus:
+    """
+    Purpose: Stand-in for smbus.SMBus. One transaction at a time, like
+        the real bus.
+    devices: I2CDevices to attach.
+    clock: Clock used for the bus latency. Defaults to the wall clock.
+    latency_s: Fixed time taken by every transaction.
+    byte_time_s: Extra time per byte transferred (STANDARD_MODE_BYTE_S
+        for a 100 kHz bus).
+    nack_rate: Probability that a transaction is not acknowledged.
+    seed: Seed for the NACK generator, for repeatable runs.
+    """
+    MAX_BLOCK = 32
+    STANDARD_MODE_BYTE_S = 9 / 100000
+
+    def __init__(self, devices=(), clock=None, latency_s=0.0,
+                 byte_time_s=0.0, nack_rate=0.0, seed=None):
+        self.devices = {}
+        self.clock = clock or clocks.WallClock()
+        self.latency_s = latency_s
+        self.byte_time_s = byte_time_s
+        self.nack_rate = nack_rate
+        self.transactions = 0
+        self.nacks = 0
+        self._stalls = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        for device in devices:
+            self.attach(device)
+
+    def attach(self, device):
+        self.devices[device.address] = device
+        return device
+
+    def detach(self, address):
+        return self.devices.pop(address, None)
+
+    def close(self):
+        pass
+
+    """
+    Make the next transaction with address hang for seconds of clock time
+    before it goes through, like a slave holding the clock line. The
+    transactions of other callers are not held up behind it.
+    """
+    def stall(self, address, seconds):
+        self._stalls[address] = seconds
+
+    def write_i2c_block_data(self, address, cmd, vals):
+        if len(vals) > SimulatedBus.MAX_BLOCK:
+            raise OverflowError("Third argument must be a list of at least "
+                                "one, but not more than 32 integers")
+        self._stall(address)
+        with self._lock:
+            device = self._transfer(address, 1 + len(vals))
+            device.receive(bytes([cmd] + list(vals)))
+
+    def read_i2c_block_data(self, address, cmd, length=MAX_BLOCK):
+        self._stall(address)
+        with self._lock:
+            device = self._transfer(address, 1 + length)
+            device.receive(bytes([cmd]))
+            data = bytes(device.request())[:length]
+        # Bytes the slave did not send read as 0xFF.
+        return list(data) + [0xFF] * (length - len(data))
+
+    def _stall(self, address):
+        seconds = self._stalls.pop(address, 0)
+        if seconds > 0:
+            self.clock.sleep(seconds)
+
+    def _transfer(self, address, nbytes):
+        self.transactions += 1
+        delay = self.latency_s + self.byte_time_s * nbytes
+        if delay > 0:
+            self.clock.sleep(delay)
+
+        device = self.devices.get(address)
+        if device is None or not device.online or (
+                self.nack_rate and self._random.random() < self.nack_rate):
+            self.nacks += 1
+            raise OSError(errno.EREMOTEIO, os.strerror(errno.EREMOTEIO))
+        return device
+
+
+# ---------------------------------------------------------------------------
+# GPIO
+# ---------------------------------------------------------------------------
+class SimulatedGPIO:
+    """
+    Purpose: Stand-in for the RPi.GPIO module. Constants match RPi.GPIO.
+        Edge callbacks run on the thread that calls drive(); RPi.GPIO
+        runs them on its own thread, so callers must not rely on either.
+    clock: Clock used for bouncetime.
+    """
+    VERSION = "simulated"
+    RPI_INFO = {"TYPE": "Simulator"}
+
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    BOARD = 10
+    BCM = 11
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    class _Pin:
+        __slots__ = ("direction", "level", "edge", "callbacks",
+                     "bouncetime", "last_edge", "detected")
+
+        def __init__(self, direction, level):
+            self.direction = direction
+            self.level = level
+            self.edge = None
+            self.callbacks = []
+            self.bouncetime = None
+            self.last_edge = None
+            self.detected = False
+
+    def __init__(self, clock=None):
+        self.clock = clock or clocks.WallClock()
+        self._mode = None
+        self._pins = {}
+        self._lock = threading.RLock()
+
+    def setmode(self, mode):
+        if self._mode is not None and mode != self._mode:
+            raise ValueError("A different mode has already been set!")
+        self._mode = mode
+
+    def getmode(self):
+        return self._mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, channel, direction, pull_up_down=PUD_OFF, initial=-1):
+        if self._mode is None:
+            raise RuntimeError("Please set pin numbering mode using "
+                               "GPIO.setmode(GPIO.BOARD) or "
+                               "GPIO.setmode(GPIO.BCM)")
+        for channel in self._channels(channel):
+            with self._lock:
+                pin = self._pins.get(channel)
+                if direction == SimulatedGPIO.OUT:
+                    level = initial if initial in (0, 1) else \
+                        (pin.level if pin else SimulatedGPIO.LOW)
+                else:
+                    level = pin.level if pin else int(
+                        pull_up_down == SimulatedGPIO.PUD_UP)
+                if pin is None:
+                    self._pins[channel] = SimulatedGPIO._Pin(direction, level)
+                else:
+                    pin.direction, pin.level = direction, level
+
+    def input(self, channel):
+        return self._pin(channel).level
+
+    def output(self, channel, value):
+        channels = self._channels(channel)
+        values = value if isinstance(value, (list, tuple)) \
+            else [value] * len(channels)
+        if len(values) != len(channels):
+            raise RuntimeError("Number of channels != number of values")
+        with self._lock:
+            for channel, value in zip(channels, values):
+                pin = self._pin(channel)
+                if pin.direction != SimulatedGPIO.OUT:
+                    raise RuntimeError(
+                        "The GPIO channel has not been set up as an OUTPUT")
+                pin.level = int(bool(value))
+
+    def cleanup(self, channel=None):
+        with self._lock:
+            if channel is None:
+                self._pins.clear()
+                self._mode = None
+            else:
+                for channel in self._channels(channel):
+                    self._pins.pop(channel, None)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        with self._lock:
+            pin = self._pin(channel)
+            if pin.direction != SimulatedGPIO.IN:
+                raise RuntimeError(
+                    "You must setup() the GPIO channel as an input first")
+            if pin.edge is not None:
+                raise RuntimeError("Conflicting edge detection already "
+                                   "enabled for this GPIO channel")
+            pin.edge = edge
+            pin.bouncetime = bouncetime
+            pin.callbacks = [callback] if callback else []
+
+    def add_event_callback(self, channel, callback):
+        with self._lock:
+            pin = self._pin(channel)
+            if pin.edge is None:
+                raise RuntimeError("Add event detection using "
+                                   "add_event_detect first before adding "
+                                   "a callback")
+            pin.callbacks.append(callback)
+
+    def remove_event_detect(self, channel):
+        with self._lock:
+            pin = self._pin(channel)
+            pin.edge = None
+            pin.callbacks = []
+
+    def event_detected(self, channel):
+        with self._lock:
+            pin = self._pin(channel)
+            detected, pin.detected = pin.detected, False
+            return detected
+
+    # -----------------------------------------------------------------------
+    # Simulation side
+    # -----------------------------------------------------------------------
+    """
+    Drive an input pin from outside, as a button or switch would, and
+    fire any matching edge detection.
+    """
+    def drive(self, channel, level):
+        level = int(bool(level))
+        with self._lock:
+            pin = self._pin(channel)
+            if pin.direction != SimulatedGPIO.IN or pin.level == level:
+                pin.level = level
+                return
+            pin.level = level
+
+            edge = SimulatedGPIO.RISING if level else SimulatedGPIO.FALLING
+            if pin.edge not in (edge, SimulatedGPIO.BOTH):
+                return
+            now = self.clock.now()
+            if pin.bouncetime and pin.last_edge is not None and \
+                    (now - pin.last_edge) * 1000 < pin.bouncetime:
+                return
+            pin.last_edge = now
+            pin.detected = True
+            callbacks = list(pin.callbacks)
+
+        for callback in callbacks:
+            callback(channel)
+
+    def level(self, channel):
+        return self._pin(channel).level
+
+    # -----------------------------------------------------------------------
+    # Bank access, as pigpio's read_bank_1/set_bank_1/clear_bank_1
+    # -----------------------------------------------------------------------
+    def read_bank(self):
+        with self._lock:
+            mask = 0
+            for channel, pin in self._pins.items():
+                if pin.level:
+                    mask |= 1 << channel
+            return mask
+
+    def write_bank(self, set_mask, clear_mask):
+        with self._lock:
+            for channel, pin in self._pins.items():
+                if pin.direction != SimulatedGPIO.OUT:
+                    continue
+                if set_mask >> channel & 1:
+                    pin.level = SimulatedGPIO.HIGH
+                elif clear_mask >> channel & 1:
+                    pin.level = SimulatedGPIO.LOW
+
+    def _pin(self, channel):
+        pin = self._pins.get(channel)
+        if pin is None:
+            raise RuntimeError("You must setup() the GPIO channel first")
+        return pin
+
+    @staticmethod
+    def _channels(channel):
+        return list(channel) if isinstance(channel, (list, tuple)) \
+            else [channel]
+
+
+# ---------------------------------------------------------------------------
+# Whole airlock
+# ---------------------------------------------------------------------------
+class Simulator:
+    """
+    Purpose: The simulated airlock hardware: one of each Arduino at its
+        sketch's address on a SimulatedBus, and a SimulatedGPIO. The
+        sensor board reports the pressure of a ChamberModel whose valves
+        are those of the pressurization Arduino.
+    clock: Clock shared by every simulated device. Defaults to the wall
+        clock; pass a ScaledClock or VirtualClock to run faster than real
+        time.
+    chamber: Optional dict of ChamberModel parameters.
+    The remaining parameters are passed to SimulatedBus.
+    """
+    def __init__(self, clock=None, latency_s=0.0, byte_time_s=0.0,
+                 nack_rate=0.0, seed=None, chamber=None):
+        self.clock = clock or clocks.WallClock()
+        self.pressure = PressureController(clock=self.clock)
+        self.chamber = chamber_model.ChamberModel(
+            clock=self.clock,
+            valves=self.pressure.valves_open,
+            valve_switch=self.pressure.valve_switch,
+            **(chamber or {}))
+        self.pressure.on_change = self.chamber.update
+        self.sensors = SensorBoard(
+            clock=self.clock, source=self.chamber.readings)
+        self.door = DoorController(clock=self.clock)
+        self.hexdisplay = HexDisplay(clock=self.clock)
+        self.bus = SimulatedBus(
+            [self.sensors, self.door, self.pressure, self.hexdisplay],
+            clock=self.clock,
+            latency_s=latency_s,
+            byte_time_s=byte_time_s,
+            nack_rate=nack_rate,
+            seed=seed)
+        self.gpio = SimulatedGPIO(self.clock)
+
+    def __repr__(self):
+        return "Simulator (%s)" % ", ".join(
+            repr(d) for d in self.bus.devices.values())
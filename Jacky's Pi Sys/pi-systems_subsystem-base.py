@@ -6,6 +6,9 @@ import random
 import time
 from enum import Enum
 subsys_pool = importlib.import_module("pi-systems_subsystem-pool")
+scheduler = importlib.import_module("pi-systems_scheduler")
+metrics = importlib.import_module("pi-systems_metrics")
+log = importlib.import_module("pi-systems_log")
 
 """
 Author: ThomasJFR (Thomas Richmond)
@@ -13,6 +16,16 @@ Purpose: Define, contain and execute a subprocess of the airlock.
 More information on this is included in the README file of the directory.
 """
 
+LOOP_SECONDS = metrics.histogram(
+    "airlock_subsystem_loop_seconds",
+    "Time taken by one loop of a subsystem.", ["subsystem"])
+LOCK_WAIT_SECONDS = metrics.histogram(
+    "airlock_subsystem_lock_wait_seconds",
+    "Time spent waiting to acquire a subsystem's lock.", ["subsystem"])
+LOCK_HOLD_SECONDS = metrics.histogram(
+    "airlock_subsystem_lock_hold_seconds",
+    "Time a subsystem's lock was held.", ["subsystem"])
+
 
 class Subsystem(ABC):
 
@@ -25,6 +38,9 @@ class Subsystem(ABC):
     loop_delay_ms: The amount of time to wait between
         loops while operational. Immedaitely
         tunneled to SubsystemThread object.
+    schedule_mode: A Scheduler.Mode deciding whether loop_delay_ms is
+        measured between loop starts (FixedRate, the default) or from
+        the end of one loop to the start of the next (FixedDelay).
     on_start: Callback invoked once the subsystem
         thread begins.
     on_stop: Callback invoked once the subsystem
@@ -37,6 +53,7 @@ class Subsystem(ABC):
         *,
         thread_id,
         loop_delay_ms=None,
+        schedule_mode=None,
         on_start=None,
         on_stop=None,
         on_loop=None
@@ -45,12 +62,15 @@ class Subsystem(ABC):
         self.thread = Subsystem.SubsystemThread(
             thread_id=thread_id,
             loop_delay_ms=loop_delay_ms,
+            schedule_mode=schedule_mode,
             loop=self._loop)
 
         def empty(): pass
         self.on_start = on_start if callable(on_start) else empty
         self.on_stop = on_stop if callable(on_stop) else empty
         self.on_loop = on_loop if callable(on_loop) else empty
+        # Locks acquired by "with" in each thread.
+        self._held = threading.local()
 
         subsys_pool.add(self)
 
@@ -72,6 +92,20 @@ class Subsystem(ABC):
         if (self.on_stop):  # Run callback method if it exists
             self.on_stop()
 
+    """
+    Run the loop now rather than at the end of its period, e.g. after a
+    command has been posted for it. Safe to call from any thread.
+    """
+    def notify(self):
+        self.thread.notify()
+
+    """
+    Replace a hung or failing loop thread with a fresh one (see
+    SubsystemThread.restart). Used by the Watchdog.
+    """
+    def restart(self):
+        self.thread.restart()
+
     """
     Definition contains the code which will be looped
     during the thread's active life.
@@ -85,7 +119,15 @@ class Subsystem(ABC):
     for each loop cycle.
     """
     def _loop(self):
-        self.loop()
+        if metrics.enabled:
+            started = time.perf_counter()
+            try:
+                self.loop()
+            finally:
+                LOOP_SECONDS.labels(self.name).observe(
+                    time.perf_counter() - started)
+        else:
+            self.loop()
         if self.on_loop:
             self.on_loop()
 
@@ -93,13 +135,28 @@ class Subsystem(ABC):
     __enter__, __exit__ and __lock__ are constructs which allow the
     "with" statement to be used on a subsystem. While acquired, a
     subsystems data can be accessed and modified.
+    The lock released is the one acquired, even if a restart replaced it
+    in between.
     """
     def __enter__(self):
-        self.lock.acquire()
+        lock = self.lock
+        if metrics.enabled:
+            waiting = time.perf_counter()
+            lock.acquire()
+            acquired = time.perf_counter()
+            LOCK_WAIT_SECONDS.labels(self.name).observe(acquired - waiting)
+        else:
+            lock.acquire()
+            acquired = None
+        self._held.__dict__.setdefault("locks", []).append((lock, acquired))
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.lock.release()
+        lock, acquired = self._held.locks.pop()
+        lock.release()
+        if acquired is not None:
+            LOCK_HOLD_SECONDS.labels(self.name).observe(
+                time.perf_counter() - acquired)
 
     @property
     def lock(self):
@@ -118,6 +175,11 @@ class Subsystem(ABC):
         predefined "run" method which loops over a target method, rather
         than calling it just once. It also holds a lock object unique to
         the subsystem.
+        The thread does not poll for its next run: it is registered with
+        the shared Scheduler and sleeps until the scheduler signals that
+        its loop is due.
+        Every loop leaves a heartbeat (the clock time it started or
+        finished, and whether it is still running) for the Watchdog.
     """
     class SubsystemThread:
         DEFAULT_LOOP_DELAY_MS = 750
@@ -128,12 +190,14 @@ class Subsystem(ABC):
         loop: The target method to call while looping.
         loop_delay_ms:  The amount of time to wait between
             loops while operational.
+        schedule_mode: The Scheduler.Mode used to plan each loop.
         """
         def __init__(
             self,
             thread_id,
             loop,
-            loop_delay_ms=None
+            loop_delay_ms=None,
+            schedule_mode=None
         ):
             # Thread Data
             self.thread_id = thread_id
@@ -143,36 +207,180 @@ class Subsystem(ABC):
                                     SubsystemThread.\
                                     DEFAULT_LOOP_DELAY_MS
             self.loop = loop
+            self.schedule_mode = schedule_mode \
+                or scheduler.Scheduler.Mode.FixedRate
+            self.scheduler = scheduler.default_scheduler
+            self.task = None
+            # Set by an AsyncRunner that adopted the thread and drives its
+            # loop instead of the scheduler: notify() and restart() are
+            # passed on to the runner.
+            self.on_notify = None
+            self.on_restart = None
+
+            # Heartbeat and health, read by the Watchdog.
+            self.heartbeat = None
+            self.in_loop = False
+            self.errors = 0
+            self.consecutive_errors = 0
+            self.restarts = 0
+            # Bumped by restart(); loops of older generations were
+            # abandoned and must not touch the thread's state.
+            self._generation = 0
 
             # Create Objects
             self.lock = threading.Lock()
-            self._thread = threading.Thread(
-                name=thread_id,
-                target=self._run)
+            self._due = threading.Event()
+            self._thread = self._new_thread()
 
         def start(self):
             self.running = True
-            self._thread.start()
+            if subsys_pool.execution_mode is \
+                    subsys_pool.ExecutionMode.Pool:
+                # No dedicated thread; each due loop becomes a pool task.
+                dispatch = self._dispatch_to_pool
+            else:
+                dispatch = self._due.set
+                self._thread.start()
+
+            self.task = self.scheduler.add(
+                name=self.thread_id,
+                period_ms=self.loop_delay_ms,
+                dispatch=dispatch,
+                mode=self.schedule_mode)
 
         def stop(self):
             self.running = False
+            if self.task is not None:
+                self.scheduler.remove(self.task)
+            self._due.set()
+            if self.on_notify is not None:
+                self.on_notify()  # Lets an adopted loop's driver exit.
+
+        """
+        Bring the next loop forward to now. If the loop is running, it
+        runs again as soon as it completes. Does nothing until started.
+        """
+        def notify(self):
+            if self.on_notify is not None:
+                self.on_notify()
+                return
+            task = self.task
+            if task is not None:
+                self.scheduler.wake(task)
+
+        """
+        Change the loop period. Takes effect from the next loop, or now
+        for a task woken with notify().
+        """
+        def set_loop_delay(self, loop_delay_ms):
+            self.loop_delay_ms = loop_delay_ms
+            task = self.task
+            if task is not None:
+                task.period_ms = loop_delay_ms
+
+        """
+        Abandon the current loop thread and start a new one, with a new
+        lock in case the abandoned loop holds the old one. A thread cannot
+        be killed: a hung loop keeps its OS thread until it returns, and
+        then exits without running again.
+        """
+        def restart(self):
+            self._generation += 1
+            if self.task is not None:
+                self.scheduler.remove(self.task)
+                self.task = None
+            self._due.set()  # Lets an idle old thread exit.
+
+            self.lock = threading.Lock()
+            self._due = threading.Event()
+            self._thread = self._new_thread()
+            self.in_loop = False
+            self.consecutive_errors = 0
+            self.heartbeat = self.scheduler.clock()
+            self.restarts += 1
+            if self.running and self.on_restart is not None:
+                self.on_restart()
+            elif self.running:
+                self.start()
+                self.notify()  # Recover now, not a loop period later.
+
+        """
+        Timing statistics (runs, overruns, jitter and loop duration)
+        collected by the scheduler for this thread.
+        """
+        @property
+        def stats(self):
+            return self.task.stats() if self.task else {}
+
+        def _new_thread(self):
+            return threading.Thread(
+                name=self.thread_id,
+                target=self._run,
+                args=(self._generation, self._due))
+
+        def _run(self, generation, due):
+            while True:
+                due.wait()
+                due.clear()
+                if not self.running or generation != self._generation:
+                    return
+
+                self._run_once(generation)
+
+        def _dispatch_to_pool(self):
+            generation = self._generation
+            subsys_pool.submit(lambda: self._run_once(generation))
+
+        def _run_once(self, generation):
+            task = self.task
+            started = self.scheduler.clock()
+            self.heartbeat = started
+            self.in_loop = True
+            failed = False
+            try:
+                self.loop()
+            except Exception as e:
+                failed = True
+                log.e(self.thread_id, "Subsystem exception: %s", e)
+            if generation != self._generation:
+                return  # Abandoned by restart() while running.
+
+            if failed:
+                self.errors += 1
+                self.consecutive_errors += 1
+            else:
+                self.consecutive_errors = 0
+            self.heartbeat = self.scheduler.clock()
+            self.in_loop = False
+            if task is not None:  # None when driven by an AsyncRunner.
+                self.scheduler.done(task, started)
+
+
+"""
+Scheduler and health counts of every subsystem in the pool, read when
+the metrics are scraped.
+"""
+def _collect_metrics():
+    threads = [(name, subsystem.thread)
+               for name, subsystem in list(subsys_pool.get_all().items())]
+    tasks = [(name, thread.stats) for name, thread in threads]
+    return [
+        ("airlock_subsystem_runs_total", "counter",
+         "Loops dispatched by the scheduler.",
+         [({"subsystem": name}, stats.get("runs", 0))
+          for name, stats in tasks]),
+        ("airlock_subsystem_overruns_total", "counter",
+         "Loop periods missed because a loop ran past its deadline.",
+         [({"subsystem": name}, stats.get("overruns", 0))
+          for name, stats in tasks]),
+        ("airlock_subsystem_errors_total", "counter",
+         "Loops that raised.",
+         [({"subsystem": name}, thread.errors) for name, thread in threads]),
+        ("airlock_subsystem_restarts_total", "counter",
+         "Loop threads replaced by restart().",
+         [({"subsystem": name}, thread.restarts)
+          for name, thread in threads])
+    ]
+
 
-        def _run(self):
-            # Wrapper function to make loop logic statement look nicer
-            def millis():
-                return time.time() * 1000
-
-            last_runtime = millis()
-            while self.running:
-                # convert loop_delay_ms to seconds.
-                if millis() - last_runtime >= self.loop_delay_ms:
-                    try:
-                        self.loop()
-                    except Exception as e:
-                        print(
-                            'Error: Subsystem exception has occured \
-                             for subsystem thread %s: %s' % (
-                                self.thread_id, e))
-                    last_runtime = millis()
-
-                time.sleep(0.05)
+metrics.register_collector(_collect_metrics)
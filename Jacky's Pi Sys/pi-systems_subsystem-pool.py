@@ -1,5 +1,8 @@
 import importlib
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
 subsystem = importlib.import_module('pi-systems_subsystem-base')
+log = importlib.import_module('pi-systems_log')
 
 
 # This variable is a dictionary that contains all subsystems.
@@ -8,6 +11,54 @@ subsystem = importlib.import_module('pi-systems_subsystem-base')
 subsystem_pool = {}
 
 
+# How subsystem loops are executed once they are due.
+#   Thread: each subsystem owns an OS thread (default).
+#   Pool: loops are dispatched as tasks onto a bounded worker pool owned
+#         by this module. A subsystem is never dispatched again while its
+#         previous loop is still running, so loops stay serialized per
+#         subsystem and "with subsystem:" locking is unchanged.
+class ExecutionMode(Enum):
+    Thread = "thread"
+    Pool = "pool"
+
+
+DEFAULT_POOL_WORKERS = 2
+
+execution_mode = ExecutionMode.Thread
+pool_workers = DEFAULT_POOL_WORKERS
+__executor = None
+
+
+"""
+Select how subsystem loops are executed. Only affects subsystems
+started after the call.
+mode: An ExecutionMode or its string value.
+workers: Maximum number of worker threads in Pool mode.
+"""
+def set_execution_mode(mode, workers=None):
+    global execution_mode
+    global pool_workers
+    global __executor
+
+    execution_mode = ExecutionMode(mode)
+    if workers is not None:
+        if workers < 1:
+            raise ValueError("Worker pool must have at least one worker!")
+        if __executor is not None and workers != pool_workers:
+            __executor.shutdown(wait=False)
+            __executor = None
+        pool_workers = workers
+
+
+def submit(fn):
+    global __executor
+    if __executor is None:
+        __executor = ThreadPoolExecutor(
+            max_workers=pool_workers,
+            thread_name_prefix="subsystem-worker")
+    return __executor.submit(fn)
+
+
 def add(subsys, overwrite=False):
     if subsys.name in subsystem_pool and overwrite is False:
         raise KeyError(
@@ -15,7 +66,7 @@ def add(subsys, overwrite=False):
             % (subsys.name))
 
     subsystem_pool[subsys.name] = subsys
-    print('Subsystem added to pool: %s' % (subsys.name))
+    log.v("subsystem-pool", "Subsystem added to pool: %s", subsys.name)
 
 
 def remove(subsys):
@@ -43,7 +94,13 @@ def get_all():
 
 
 def stop_all():
-    print("Closing all subsystems.")
+    global __executor
+
+    log.i("subsystem-pool", "Closing all subsystems.")
     for subsys in subsystem_pool.values():
-        if subsys.running:
+        if subsys.thread.running:
             subsys.stop()
+
+    if __executor is not None:
+        __executor.shutdown(wait=False)
+        __executor = None
@@ -0,0 +1,462 @@
+import bisect
+import functools
+import glob
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+import importlib
+from collections import namedtuple
+from enum import IntEnum
+log = importlib.import_module('pi-systems_log')
+
+"""
+Purpose: Persist airlock telemetry (raw I2C frames, decoded sensor
+    readings, input edges and FSM transitions) to a compact append-only
+    binary log.
+
+    Callers only enqueue records; a background thread batches them into
+    a single buffered write, so a slow SD card never stalls a control
+    loop. The queue is bounded: when it is full, or while the card fails
+    writes (e.g. when it is full), records are dropped and counted.
+    The log is split into segments of bounded size. Old segments can be
+    deleted automatically to cap disk use.
+
+    Segment layout:
+        header: magic "ALTL", version (u8), start timestamp (f64)
+        frames: record type (u8), timestamp (f64), payload length (u16),
+                payload, crc32 of everything before it in the frame (u32)
+
+    TelemetryReader memory-maps segments to iterate them without loading
+    them, and can seek to a timestamp.
+
+Usage:
+    telemetry.open_log("/home/pi/telemetry")   # Once at startup.
+    telemetry.record_sensors(readings)         # From anywhere.
+"""
+
+MAGIC = b"ALTL"
+VERSION = 1
+
+SEGMENT_HEADER = struct.Struct("<4sBd")
+FRAME_HEADER = struct.Struct("<BdH")
+FRAME_CRC = struct.Struct("<I")
+
+SEGMENT_PATTERN = "telemetry-%06d.log"
+
+# Sensor channels are stored in this order as float32.
+SENSOR_CHANNELS = ['O2', 'humidity', 'temperature', 'pressure', 'CO2']
+SENSOR_PAYLOAD = struct.Struct("<%if" % len(SENSOR_CHANNELS))
+I2C_PAYLOAD_HEADER = struct.Struct("<BBB")
+INPUT_PAYLOAD_HEADER = struct.Struct("<B")
+
+
+class RecordType(IntEnum):
+    I2CFrame = 1
+    SensorReadings = 2
+    FSMTransition = 3
+    InputEdge = 4
+
+
+class I2CDirection(IntEnum):
+    Write = 0
+    Read = 1
+
+
+TelemetryRecord = namedtuple(
+    "TelemetryRecord", ["type", "timestamp", "data"])
+I2CFrame = namedtuple(
+    "I2CFrame", ["direction", "address", "register", "data"])
+FSMTransition = namedtuple(
+    "FSMTransition", ["fsm", "event", "source", "target"])
+InputEdge = namedtuple("InputEdge", ["name", "state"])
+
+
+# ---------------------------------------------------------------------------
+# Payload encoding
+# ---------------------------------------------------------------------------
+def encode_i2c(direction, address, register, data):
+    return I2C_PAYLOAD_HEADER.pack(int(direction), address, register) \
+        + bytes(data or b"")
+
+
+def encode_sensors(readings):
+    return SENSOR_PAYLOAD.pack(
+        *[float(readings.get(c, 0)) for c in SENSOR_CHANNELS])
+
+
+def encode_transition(fsm, event, source, target):
+    return "\0".join(
+        str(x) if x is not None else "" for x in (fsm, event, source, target)
+    ).encode()
+
+
+def encode_input(name, state):
+    return INPUT_PAYLOAD_HEADER.pack(int(state)) + str(name).encode()
+
+
+def decode_payload(record_type, payload):
+    if record_type == RecordType.I2CFrame:
+        direction, address, register = \
+            I2C_PAYLOAD_HEADER.unpack_from(payload)
+        return I2CFrame(
+            I2CDirection(direction), address, register,
+            bytes(payload[I2C_PAYLOAD_HEADER.size:]))
+    if record_type == RecordType.SensorReadings:
+        return dict(zip(SENSOR_CHANNELS, SENSOR_PAYLOAD.unpack(payload)))
+    if record_type == RecordType.FSMTransition:
+        fields = bytes(payload).decode().split("\0")
+        return FSMTransition(*[f or None for f in fields])
+    if record_type == RecordType.InputEdge:
+        state, = INPUT_PAYLOAD_HEADER.unpack_from(payload)
+        return InputEdge(
+            bytes(payload[INPUT_PAYLOAD_HEADER.size:]).decode(), state)
+    return bytes(payload)
+
+
+# ---------------------------------------------------------------------------
+# Writing
+# ---------------------------------------------------------------------------
+class TelemetryLog:
+    """
+    directory: Where segments are written. Created if missing.
+    segment_bytes: Size after which a new segment is started.
+    max_segments: If set, the oldest segments beyond this count are deleted.
+    flush_interval_s: Longest time a record may sit in the write buffer.
+    queue_size: Records that may wait for the writer before new ones are
+        dropped.
+    retry_s: After a failed write, records are dropped for this long
+        before writing to a new segment is tried again.
+    """
+    DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+    DEFAULT_QUEUE_SIZE = 65536
+
+    def __init__(
+        self,
+        directory,
+        segment_bytes=DEFAULT_SEGMENT_BYTES,
+        max_segments=None,
+        flush_interval_s=1.0,
+        queue_size=DEFAULT_QUEUE_SIZE,
+        retry_s=5.0
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.flush_interval_s = flush_interval_s
+        self.retry_s = retry_s
+        self.dropped = 0
+        self.written = 0
+        self.errors = 0
+        self._retry_at = None
+
+        os.makedirs(directory, exist_ok=True)
+        existing = _segment_paths(directory)
+        self._segment_index = _segment_number(existing[-1]) + 1 \
+            if existing else 0
+        self._file = None
+        self._size = 0
+
+        self._queue = queue.Queue(queue_size)
+        self.running = True
+        self._thread = threading.Thread(
+            name="telemetry-writer",
+            target=self._run,
+            daemon=True)
+        self._thread.start()
+
+    """
+    Queue a record. Never blocks, on disk I/O or on a full queue.
+    """
+    def record(self, record_type, payload, timestamp=None):
+        if not self.running:
+            self.dropped += 1
+            return
+        if len(payload) > 0xFFFF:
+            raise ValueError("Telemetry payload is limited to 65535 bytes!")
+        try:
+            self._queue.put_nowait((
+                int(record_type),
+                time.time() if timestamp is None else timestamp,
+                payload))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if not self.running:
+            return
+        self.running = False
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        try:
+            self._write_records()
+        except Exception as e:
+            # From now on records are dropped and counted rather than
+            # queued for a writer that is gone.
+            self.running = False
+            log.wtf("telemetry", "Telemetry writer stopped: %s", e)
+
+    def _write_records(self):
+        batch = bytearray()
+        records = 0
+        started = None
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval_s)
+            except queue.Empty:
+                item = False
+
+            # Drain everything already queued into one write.
+            while item:
+                record_type, timestamp, payload = item
+                frame = FRAME_HEADER.pack(
+                    record_type, timestamp, len(payload)) + payload
+                batch += frame + FRAME_CRC.pack(zlib.crc32(frame))
+                records += 1
+                started = started or timestamp
+                if self._size + len(batch) >= self.segment_bytes:
+                    if self._write(batch, records, started):
+                        self._close_segment()
+                    batch, records, started = bytearray(), 0, None
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    item = False
+
+            if batch:
+                self._write(batch, records, started)
+                batch, records, started = bytearray(), 0, None
+
+            now = time.monotonic()
+            if self._file is not None and \
+                    now - last_flush >= self.flush_interval_s:
+                try:
+                    self._file.flush()
+                except (OSError, ValueError) as e:
+                    self._failed(0, e)
+                last_flush = now
+
+            if item is None:
+                self._close_segment()
+                return
+
+    """
+    Write a batch of records, starting a segment stamped with timestamp
+    if none is open. Returns False if the records were dropped instead.
+    """
+    def _write(self, data, records, timestamp):
+        if self._retry_at is not None:
+            if time.monotonic() < self._retry_at:
+                self.dropped += records
+                return False
+            self._retry_at = None
+        try:
+            if self._file is None:
+                self._open_segment(timestamp)
+            self._file.write(data)
+        except (OSError, ValueError) as e:
+            self._failed(records, e)
+            return False
+        self._size += len(data)
+        self.written += records
+        return True
+
+    def _failed(self, records, error):
+        self.dropped += records
+        self.errors += 1
+        self._retry_at = time.monotonic() + self.retry_s
+        log.e("telemetry", "Could not write the telemetry log, dropping "
+              "records for %.0f s: %s", self.retry_s, error,
+              dropped=self.dropped)
+        # The next write starts a new segment.
+        self._close_segment()
+
+    def _close_segment(self):
+        file, self._file = self._file, None
+        self._size = 0
+        if file is not None:
+            try:
+                file.close()
+            except (OSError, ValueError) as e:
+                self.errors += 1
+                log.e("telemetry", "Could not close a telemetry segment: %s",
+                      e)
+
+    def _open_segment(self, timestamp):
+        path = os.path.join(
+            self.directory, SEGMENT_PATTERN % self._segment_index)
+        self._file = open(path, "ab", buffering=64 * 1024)
+        self._size = SEGMENT_HEADER.size
+        self._file.write(SEGMENT_HEADER.pack(MAGIC, VERSION, timestamp))
+        self._segment_index += 1
+
+        if self.max_segments:
+            for old in _segment_paths(self.directory)[:-self.max_segments]:
+                os.remove(old)
+
+
+# ---------------------------------------------------------------------------
+# Reading
+# ---------------------------------------------------------------------------
+class TelemetryReader:
+    """
+    Purpose: Iterate the records of a telemetry directory in order.
+        Segments are memory-mapped one at a time and decoded lazily.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments = []
+        self.start_times = []
+        for path in _segment_paths(directory):
+            start = _segment_start(path)
+            if start is not None:
+                self.segments.append(path)
+                self.start_times.append(start)
+
+    def __iter__(self):
+        return self.seek(None)
+
+    """
+    Yield records with a timestamp at or after the given one.
+    record_types: Optional collection of RecordTypes to keep.
+    """
+    def seek(self, timestamp, record_types=None):
+        first = 0
+        if timestamp is not None and self.segments:
+            first = max(0, bisect.bisect_right(
+                self.start_times, timestamp) - 1)
+
+        for path in self.segments[first:]:
+            for record in _read_segment(path, record_types):
+                if timestamp is None or record.timestamp >= timestamp:
+                    yield record
+
+
+def _read_segment(path, record_types):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= SEGMENT_HEADER.size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            offset = SEGMENT_HEADER.size
+            end = len(view)
+            while offset + FRAME_HEADER.size + FRAME_CRC.size <= end:
+                record_type, timestamp, length = \
+                    FRAME_HEADER.unpack_from(view, offset)
+                payload_end = offset + FRAME_HEADER.size + length
+                if payload_end + FRAME_CRC.size > end:
+                    return  # Torn write at the end of the segment.
+
+                crc, = FRAME_CRC.unpack_from(view, payload_end)
+                if crc != zlib.crc32(view[offset:payload_end]):
+                    return  # Corrupt frame; nothing after it is trusted.
+
+                if record_types is None or record_type in record_types:
+                    payload = view[offset + FRAME_HEADER.size:payload_end]
+                    yield TelemetryRecord(
+                        RecordType(record_type),
+                        timestamp,
+                        decode_payload(record_type, payload))
+                offset = payload_end + FRAME_CRC.size
+
+
+def _segment_paths(directory):
+    return sorted(glob.glob(os.path.join(directory, "telemetry-*.log")))
+
+
+def _segment_number(path):
+    return int(os.path.basename(path)[len("telemetry-"):-len(".log")])
+
+
+def _segment_start(path):
+    with open(path, "rb") as f:
+        header = f.read(SEGMENT_HEADER.size)
+    if len(header) < SEGMENT_HEADER.size:
+        return None
+    magic, version, start = SEGMENT_HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        return None
+    return start
+
+
+# ---------------------------------------------------------------------------
+# Module-level log used by the subsystems. Recording is a no-op until
+# open_log() is called.
+# ---------------------------------------------------------------------------
+active_log = None
+
+
+def open_log(directory, **kwargs):
+    global active_log
+    close_log()
+    active_log = TelemetryLog(directory, **kwargs)
+    return active_log
+
+
+def close_log():
+    global active_log
+    if active_log is not None:
+        active_log.close()
+        active_log = None
+
+
+def record_i2c(direction, address, register, data):
+    log = active_log
+    if log is not None:
+        log.record(
+            RecordType.I2CFrame,
+            encode_i2c(direction, address, register, data))
+
+
+def record_sensors(readings, timestamp=None):
+    log = active_log
+    if log is not None:
+        log.record(
+            RecordType.SensorReadings, encode_sensors(readings), timestamp)
+
+
+def record_input(name, state, timestamp=None):
+    log = active_log
+    if log is not None:
+        log.record(
+            RecordType.InputEdge, encode_input(name, state), timestamp)
+
+
+def record_transition(fsm, event, source, target=None):
+    log = active_log
+    if log is not None:
+        log.record(
+            RecordType.FSMTransition,
+            encode_transition(fsm, event, source, target))
+
+
+"""
+Class decorator recording every transition of a state machine. Wraps
+each on_<transition> callback, which runs while the machine is still in
+the source state. The transition is recorded once the callback has
+returned, with the state the event leads to (see
+StateMachine.target_of).
+"""
+def trace_transitions(cls):
+    for name, callback in list(vars(cls).items()):
+        if name.startswith("on_") and callable(callback):
+            setattr(cls, name, _traced(cls.__name__, name[3:], callback))
+    return cls
+
+
+def _traced(fsm, event, callback):
+    @functools.wraps(callback)
+    def traced(self, *args, **kwargs):
+        source = self.current_state.name
+        # Only the compiled machines (pi-systems_fsm-engine) can tell.
+        target_of = getattr(self, "target_of", None)
+        target = target_of(event).name if target_of else None
+        result = callback(self, *args, **kwargs)
+        record_transition(fsm, event, source, target)
+        return result
+    return traced
@@ -0,0 +1,263 @@
+import threading
+import time
+from collections import deque
+import importlib
+subsys_pool = importlib.import_module('pi-systems_subsystem-pool')
+comms = importlib.import_module('pi-systems_communications')
+log = importlib.import_module('pi-systems_log')
+
+"""
+Purpose: Notice subsystem loops that hang or keep failing, and recover
+    them within a bounded time.
+
+    SubsystemThread._run_once catches every exception and carries on, and
+    nothing noticed a loop stuck in a blocking read_i2c_block_data: the
+    pressure the FSM trusts simply stopped changing. Every loop now leaves
+    a heartbeat (SubsystemThread.heartbeat and in_loop), and the watchdog
+    checks them every check_ms:
+        - The I2C bus is stuck when one transaction has been on it longer
+          than bus_timeout_ms. The bus manager gets a fresh bus handle;
+          the loops waiting on the stuck transaction get a TimeoutError.
+        - A subsystem has missed its deadline when a loop has run longer
+          than its timeout (miss_factor loop periods, at least
+          min_timeout_ms), or no loop has started for a loop period more
+          than that. It has failed when error_limit loops in a row raised.
+          Either way its thread is restarted (Subsystem.restart) after
+          resetting the bus if a transaction has been on it longer than
+          bus_timeout_ms. A transaction still within it is left alone:
+          it is most likely another subsystem's.
+        - A restarted subsystem has recovered once a loop of its new
+          thread completes. If that takes longer than recovery_timeout_ms
+          it is restarted again.
+    Restarts and bus resets are failures of the subsystem or of the bus.
+    The first time one fails escalate_after times within
+    escalate_window_s, on_escalate(name, reason) is called (name being
+    the subsystem's, or BUS), e.g. to press the FSMs' emergency input. So
+    a hung subsystem is escalated at most
+    timeout + escalate_after * recovery_timeout after its last heartbeat.
+
+    The time from detection to recovery of every incident is kept in
+    stats.
+"""
+
+
+# Name the failures of the I2C bus are escalated under.
+BUS = "i2c-bus"
+
+
+class Watchdog:
+    """
+    subsystems: Subsystems to watch. Defaults to every subsystem in the
+        pool at the time of each check.
+    bus_manager: I2CBusManager to watch, or None to leave the bus alone.
+    check_ms: Period of the checks.
+    miss_factor: Loop periods a loop may take before it is hung.
+    min_timeout_ms: Shortest timeout of a loop, for subsystems with short
+        periods.
+    bus_timeout_ms: Longest time a single I2C transaction may take.
+    error_limit: Loops in a row that may raise before the subsystem has
+        failed.
+    recovery_timeout_ms: Longest time from a restart to the first
+        completed loop.
+    escalate_after: Failures within escalate_window_s before on_escalate.
+    on_escalate: Callable (name, reason).
+    reset_bus: Callable giving the bus manager a fresh handle.
+    clock: Callable returning time.monotonic() seconds, the clock of the
+        heartbeats and of the bus manager.
+    """
+    def __init__(
+        self,
+        subsystems=None,
+        bus_manager=comms.bus_manager,
+        check_ms=250,
+        miss_factor=3,
+        min_timeout_ms=2000,
+        bus_timeout_ms=1000,
+        error_limit=5,
+        recovery_timeout_ms=5000,
+        escalate_after=3,
+        escalate_window_s=60,
+        on_escalate=None,
+        reset_bus=comms.reset_bus,
+        clock=time.monotonic
+    ):
+        self.subsystems = subsystems
+        self.bus_manager = bus_manager
+        self.check_ms = check_ms
+        self.miss_factor = miss_factor
+        self.min_timeout_ms = min_timeout_ms
+        self.bus_timeout_ms = bus_timeout_ms
+        self.error_limit = error_limit
+        self.recovery_timeout_ms = recovery_timeout_ms
+        self.escalate_after = escalate_after
+        self.escalate_window_s = escalate_window_s
+        self.on_escalate = on_escalate
+        self.reset_bus = reset_bus
+        self.clock = clock
+
+        # Subsystem name: (detected, restarted) of the incident not yet
+        # recovered from.
+        self._incidents = {}
+        # Subsystem name or BUS: times of its recent failures.
+        self._failures = {}
+        self.escalated = set()
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {
+            "checks": 0, "incidents": 0, "restarts": 0, "bus_resets": 0,
+            "escalations": 0, "recovered": 0, "total_recovery": 0,
+            "max_recovery": 0, "max_detection": 0
+        }
+
+    def __repr__(self):
+        return "Watchdog (%s)" % self.stats
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            name="watchdog", target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    """
+    Time from a hang (the last heartbeat) to its detection, and from
+    detection to the first completed loop after the restart.
+    """
+    @property
+    def stats(self):
+        stats = self._stats
+        recovered = stats["recovered"]
+        return {
+            "checks": stats["checks"],
+            "incidents": stats["incidents"],
+            "restarts": stats["restarts"],
+            "bus_resets": stats["bus_resets"],
+            "escalations": stats["escalations"],
+            "recovering": len(self._incidents),
+            "max_detection_ms": stats["max_detection"] * 1000,
+            "mean_recovery_ms":
+                stats["total_recovery"] * 1000 / recovered if recovered else 0,
+            "max_recovery_ms": stats["max_recovery"] * 1000
+        }
+
+    """
+    Timeout of one loop of the subsystem, in seconds.
+    """
+    def timeout(self, subsystem):
+        return max(self.min_timeout_ms,
+                   self.miss_factor * subsystem.thread.loop_delay_ms) / 1000
+
+    """
+    Run one round of checks. Called every check_ms by the watchdog thread;
+    can also be called directly.
+    """
+    def check(self):
+        now = self.clock()
+        self._stats["checks"] += 1
+        self._check_bus(now)
+
+        subsystems = self.subsystems
+        if subsystems is None:
+            subsystems = list(subsys_pool.get_all().values())
+        for subsystem in subsystems:
+            thread = subsystem.thread
+            if not thread.running or thread.heartbeat is None:
+                continue  # Not started, or has not run yet.
+            incident = self._incidents.get(subsystem.name)
+            if incident is not None:
+                self._check_recovery(subsystem, incident, now)
+            else:
+                self._check_health(subsystem, now)
+
+    def _run(self):
+        while not self._stop.wait(self.check_ms / 1000):
+            try:
+                self.check()
+            except Exception as e:
+                log.e("watchdog", "Check failed: %s", e)
+
+    def _check_bus(self, now):
+        if self.bus_manager is None:
+            return
+        busy_since = self.bus_manager.busy_since
+        if busy_since is not None and \
+                now - busy_since > self.bus_timeout_ms / 1000:
+            self._reset_bus("a transaction has been on the bus for %.0f ms"
+                            % ((now - busy_since) * 1000), now)
+
+    def _reset_bus(self, reason, now):
+        log.w("watchdog", "Resetting the I2C bus, %s", reason)
+        self._stats["bus_resets"] += 1
+        self.reset_bus()
+        self._fail(BUS, reason, now)
+
+    def _check_health(self, subsystem, now):
+        thread = subsystem.thread
+        timeout = self.timeout(subsystem)
+        since = now - thread.heartbeat
+        if thread.in_loop and since > timeout:
+            reason = "loop running for %.0f ms" % (since * 1000)
+        elif not thread.in_loop and \
+                since > timeout + thread.loop_delay_ms / 1000:
+            reason = "no loop for %.0f ms" % (since * 1000)
+        elif thread.consecutive_errors >= self.error_limit:
+            reason = "%i loops in a row raised" % thread.consecutive_errors
+        else:
+            return
+
+        self._stats["incidents"] += 1
+        self._stats["max_detection"] = max(
+            self._stats["max_detection"], since)
+        self._restart(subsystem, reason, now, detected=now)
+
+    def _check_recovery(self, subsystem, incident, now):
+        detected, restarted = incident
+        thread = subsystem.thread
+        if not thread.in_loop and thread.heartbeat > restarted \
+                and thread.consecutive_errors == 0:
+            del self._incidents[subsystem.name]
+            recovery = thread.heartbeat - detected
+            self._stats["recovered"] += 1
+            self._stats["total_recovery"] += recovery
+            self._stats["max_recovery"] = max(
+                self._stats["max_recovery"], recovery)
+            log.i("watchdog", "%s recovered after %.0f ms",
+                  subsystem.name, recovery * 1000)
+        elif now - restarted > self.recovery_timeout_ms / 1000:
+            self._restart(subsystem, "not recovered after %.0f ms" % (
+                (now - restarted) * 1000), now, detected=detected)
+
+    def _restart(self, subsystem, reason, now, detected):
+        log.w("watchdog", "Restarting %s, %s", subsystem.name, reason)
+        # The loop may be waiting on a stuck transaction. One that is only
+        # in flight is left to finish, so a healthy loop waiting on it is
+        # not failed along with this one.
+        self._check_bus(now)
+        subsystem.restart()
+        self._stats["restarts"] += 1
+        self._incidents[subsystem.name] = (detected, self.clock())
+        self._fail(subsystem.name, reason, now)
+
+    def _fail(self, name, reason, now):
+        failures = self._failures.setdefault(name, deque())
+        failures.append(now)
+        while failures and now - failures[0] > self.escalate_window_s:
+            failures.popleft()
+        if len(failures) < self.escalate_after or name in self.escalated:
+            return
+
+        self.escalated.add(name)
+        self._stats["escalations"] += 1
+        log.e("watchdog", "%s failed %i times in %i s (%s), escalating",
+              name, len(failures), self.escalate_window_s, reason)
+        if self.on_escalate:
+            self.on_escalate(name, reason)
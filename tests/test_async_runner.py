@@ -0,0 +1,106 @@
+import importlib
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+"""
+Plain subsystems adopted by an AsyncRunner: their loops still leave a
+heartbeat for the Watchdog, and notify() and restart() reach the runner.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "Jacky's Pi Sys"))
+os.environ.setdefault("AIRLOCK_BACKEND", "simulator")
+
+subsys = importlib.import_module('pi-systems_subsystem-base')
+async_ss = importlib.import_module('pi-systems_async-subsystem')
+
+# Long enough that a loop run well within it was brought forward.
+LOOP_DELAY_MS = 5000
+TIMEOUT_S = 2
+
+
+class Counter(subsys.Subsystem):
+    def __init__(self, name, fail=False):
+        super().__init__(name, thread_id=name, loop_delay_ms=LOOP_DELAY_MS)
+        self.fail = fail
+        self.loops = 0
+        self.looped = threading.Event()
+
+    def loop(self):
+        self.loops += 1
+        self.looped.set()
+        if self.fail:
+            raise RuntimeError("failed loop")
+
+
+@pytest.fixture
+def run():
+    runners = []
+
+    def run(subsystem):
+        runner = async_ss.AsyncRunner(subsystems=[subsystem])
+        thread = threading.Thread(target=runner.run)
+        thread.start()
+        runners.append((runner, thread))
+        deadline = time.monotonic() + TIMEOUT_S
+        while subsystem.thread.on_notify is None:
+            assert time.monotonic() < deadline, "subsystem not adopted"
+            time.sleep(0.001)
+        return runner
+
+    yield run
+    for runner, thread in runners:
+        runner.stop()
+        thread.join(TIMEOUT_S)
+
+
+def test_notify_wakes_adopted_subsystem(run):
+    counter = Counter("adopted-notify")
+    run(counter)
+
+    counter.notify()
+
+    assert counter.looped.wait(TIMEOUT_S)
+    assert counter.thread.running
+    assert counter.thread.heartbeat is not None
+    assert not counter.thread.in_loop
+
+
+def test_adopted_loop_errors_are_counted(run):
+    counter = Counter("adopted-errors", fail=True)
+    run(counter)
+
+    counter.notify()
+
+    assert counter.looped.wait(TIMEOUT_S)
+    deadline = time.monotonic() + TIMEOUT_S
+    while counter.thread.consecutive_errors == 0:
+        assert time.monotonic() < deadline, "error not counted"
+        time.sleep(0.001)
+    assert counter.thread.errors == 1
+
+
+def test_restart_runs_adopted_loop_again(run):
+    counter = Counter("adopted-restart")
+    run(counter)
+
+    counter.restart()
+
+    assert counter.looped.wait(TIMEOUT_S)
+    assert counter.thread.restarts == 1
+    assert counter.thread.task is None
+
+
+def test_runner_stop_releases_adopted_subsystem(run):
+    counter = Counter("adopted-stop")
+    runner = run(counter)
+
+    runner.stop()
+    deadline = time.monotonic() + TIMEOUT_S
+    while counter.thread.running or counter.thread.on_notify is not None:
+        assert time.monotonic() < deadline, "subsystem not released"
+        time.sleep(0.001)
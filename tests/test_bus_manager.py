@@ -0,0 +1,84 @@
+import importlib
+import os
+import sys
+import threading
+
+"""
+I2CBusManager coalescing, on a bus that records what is sent and can be
+held on a transaction while more are queued.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "Jacky's Pi Sys"))
+os.environ.setdefault("AIRLOCK_BACKEND", "simulator")
+
+comms = importlib.import_module('pi-systems_communications')
+
+HOLD = 0x20
+
+
+class RecordingBus:
+    # Registers of the devices, as last written. A read of HOLD waits
+    # until released.
+    def __init__(self):
+        self.log = []
+        self.registers = {}
+        self.holding = threading.Event()
+        self.released = threading.Event()
+
+    def read_i2c_block_data(self, address, register):
+        self.log.append(('r', address, register))
+        if address == HOLD:
+            self.holding.set()
+            self.released.wait(5)
+        return list(self.registers.get((address, register), [0]))
+
+    def write_i2c_block_data(self, address, register, data):
+        self.log.append(('w', address, register, list(data)))
+        self.registers[(address, register)] = data
+
+
+def held_manager():
+    bus = RecordingBus()
+    manager = comms.I2CBusManager(bus)
+    held = manager.submit_read(HOLD, 9)
+    assert bus.holding.wait(5)
+    return bus, manager, held
+
+
+def test_read_is_not_coalesced_across_a_write():
+    bus, manager, held = held_manager()
+    before = manager.submit_read(0x14, 1)
+    write = manager.submit_write(0x14, 1, [7])
+    after = manager.submit_read(0x14, 1)
+    bus.released.set()
+
+    assert before.result(5) == [0]
+    write.result(5)
+    assert after.result(5) == [7]
+    assert bus.log == [('r', HOLD, 9), ('r', 0x14, 1), ('w', 0x14, 1, [7]),
+                       ('r', 0x14, 1)]
+    manager.stop()
+
+
+def test_back_to_back_reads_are_coalesced():
+    bus, manager, held = held_manager()
+    first = manager.submit_read(0x14, 1)
+    second = manager.submit_read(0x14, 1)
+    bus.released.set()
+
+    assert first.result(5) == second.result(5)
+    assert bus.log == [('r', HOLD, 9), ('r', 0x14, 1)]
+    assert manager.stats()[0x14]["coalesced"] == 1
+    manager.stop()
+
+
+def test_identical_writes_are_all_sent():
+    bus, manager, held = held_manager()
+    writes = [manager.submit_write(0x14, 1, [7]) for _ in range(2)]
+    bus.released.set()
+
+    for write in writes:
+        write.result(5)
+    assert bus.log.count(('w', 0x14, 1, [7])) == 2
+    manager.stop()
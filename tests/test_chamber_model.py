@@ -0,0 +1,62 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+"""
+The chamber model against the simulated pressurization Arduino: the
+depressurizer opens valve_delay_s after the command, and only flows from
+then on, however far apart the model is updated.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "Jacky's Pi Sys"))
+os.environ.setdefault("AIRLOCK_BACKEND", "simulator")
+
+chamber_model = importlib.import_module('pi-systems_chamber-model')
+clocks = importlib.import_module('pi-systems_clock')
+simulator = importlib.import_module('pi-systems_simulator')
+
+VALVE_DELAY_S = 1.0
+
+
+def depressurizing(clock):
+    pressure = simulator.PressureController(
+        clock=clock, valve_delay_s=VALVE_DELAY_S)
+    chamber = chamber_model.ChamberModel(
+        clock=clock,
+        valves=pressure.valves_open,
+        valve_switch=pressure.valve_switch)
+    pressure.on_change = chamber.update
+    pressure.receive(simulator.PressureController.SET_PRESSURE_T.pack(
+        1, simulator.PressureController.SET_PRESSURE, 0,
+        simulator.PressureController.DEPRESSURIZE))
+    return chamber
+
+
+def test_depressurizer_flows_only_after_its_delay():
+    clock = clocks.VirtualClock()
+    chamber = depressurizing(clock)
+
+    start = chamber.pressure_pa
+    clock.advance(VALVE_DELAY_S + 0.5)
+
+    # The vent is choked, so it flows at a constant rate once open.
+    expected = start + VALVE_DELAY_S * chamber.rate(start) \
+        + 0.5 * chamber.rate(start, depressurizer=True)
+    assert chamber.pressure_pa == pytest.approx(expected, rel=1e-4)
+
+
+def test_update_spanning_the_switch_matches_stepped_updates():
+    stepped_clock = clocks.VirtualClock()
+    stepped = depressurizing(stepped_clock)
+    for _ in range(30):
+        stepped_clock.advance(0.1)
+        stepped.update()
+
+    clock = clocks.VirtualClock()
+    chamber = depressurizing(clock)
+    clock.advance(3.0)
+
+    assert chamber.pressure_pa == pytest.approx(stepped.pressure_pa)
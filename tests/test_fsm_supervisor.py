@@ -0,0 +1,65 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+"""
+FSMSupervisor fed by the InputComponents of loop_FSMs, as on the Pi,
+rather than by set_input calls.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "Jacky's Pi Sys"))
+os.environ.setdefault("AIRLOCK_BACKEND", "simulator")
+
+interface = importlib.import_module('pi-systems_interface-subsystem')
+supervisor = importlib.import_module('pi-systems_fsm-supervisor')
+replay = importlib.import_module('pi-systems_replay')
+clocks = importlib.import_module('pi-systems_clock')
+
+# name, pin and subtype of each input of pi-systems_FSMs.py, built the
+# same way (no on_change_callbacks).
+INPUTS = [
+    ('E', 36, 'Button'), ('P', 29, 'Button'), ('D', 31, 'Button'),
+    ('L', 32, 'Switch'), ('O', 33, 'Button'), ('Cl', 35, 'Button'),
+    ('Enable P/D/H', 37, 'Switch'), ('H', 38, 'Button'), ('C', 40, 'Button')
+]
+
+
+@pytest.fixture
+def attached():
+    inputs = [interface.InputComponent(name=name, pin=pin, subtype=subtype)
+              for name, pin, subtype in INPUTS]
+    fsms = supervisor.FSMSupervisor(
+        replay.ReplayPressure(),
+        replay.ReplayDoor(clocks.VirtualClock()),
+        leds=[replay.ReplayLED(name) for name in supervisor.LED_NAMES])
+    fsms.attach_inputs(inputs)
+    return fsms, inputs
+
+
+@pytest.mark.parametrize("index", range(len(INPUTS)),
+                         ids=[name for name, _, _ in INPUTS])
+def test_each_input_reaches_its_own_supervisor_input(attached, index):
+    fsms, inputs = attached
+    component = inputs[index]
+    before = dict(fsms.inputs)
+
+    component.state = 1 - component.state
+
+    expected = dict(before, **{component.name: component.state})
+    assert fsms.inputs == expected
+
+
+def test_emergency_button_reaches_the_fsms(attached):
+    fsms, inputs = attached
+    emergency = inputs[0]
+    emergency.state = 1
+    fsms.settle()
+
+    emergency.state = 0
+    fsms.settle()
+
+    assert fsms.inputs['E'] == 0
+    assert fsms.in_emergency
@@ -0,0 +1,105 @@
+import importlib
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+"""
+Edge-mode input handling of the InterfaceSubsystem, driven through the
+simulated GPIO as a button would be: an accepted edge reaches the
+component's callbacks, bounces inside the debounce window are ignored,
+and a level that settled during the window is picked up when it closes.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "Jacky's Pi Sys"))
+os.environ.setdefault("AIRLOCK_BACKEND", "simulator")
+
+hardware = importlib.import_module('pi-systems_hardware')
+interface_ss = importlib.import_module('pi-systems_interface-subsystem')
+subsys_pool = importlib.import_module('pi-systems_subsystem-pool')
+
+PIN = 5
+DEBOUNCE_MS = 200
+TIMEOUT_S = 2
+# Keeps the safety-net loop from re-reading the pin during a test, so
+# only the edge dispatcher changes the state.
+LOOP_DELAY_MS = 60000
+
+
+class Recorder:
+    def __init__(self):
+        self.states = []
+        self.changed = threading.Event()
+
+    def __call__(self, state):
+        self.states.append(state)
+        self.changed.set()
+
+    def wait(self):
+        assert self.changed.wait(TIMEOUT_S), "no callback"
+        self.changed.clear()
+
+
+@pytest.fixture
+def button(request):
+    recorder = Recorder()
+    component = interface_ss.InputComponent(
+        "button", PIN, "Button", debounce_ms=DEBOUNCE_MS,
+        on_change_callbacks={"test": recorder})
+    interface = interface_ss.InterfaceSubsystem(
+        name="edges-%s" % request.node.name,
+        thread_id="edges-%s" % request.node.name,
+        inputs=[component],
+        loop_delay_ms=LOOP_DELAY_MS)
+    interface.start()
+    assert interface.input_mode is \
+        interface_ss.InterfaceSubsystem.InputMode.Edge
+
+    yield interface, recorder
+    interface.stop()
+    interface.remove_input(component)
+    subsys_pool.remove(interface)
+
+
+def settle():
+    time.sleep(2 * DEBOUNCE_MS / 1000)
+
+
+def test_edge_reaches_callbacks(button):
+    interface, recorder = button
+
+    hardware.GPIO.drive(PIN, 1)
+    recorder.wait()
+
+    assert recorder.states == [1]
+    assert interface.get_input_component("button").state == 1
+    assert interface.edge_stats["edges"] == 1
+
+
+def test_bounces_are_ignored(button):
+    interface, recorder = button
+
+    hardware.GPIO.drive(PIN, 1)
+    recorder.wait()
+    hardware.GPIO.drive(PIN, 0)
+    hardware.GPIO.drive(PIN, 1)
+    settle()
+
+    assert recorder.states == [1]
+    assert interface.edge_stats["edges"] == 1
+
+
+def test_level_settled_during_window_is_resynced(button):
+    interface, recorder = button
+
+    hardware.GPIO.drive(PIN, 1)
+    recorder.wait()
+    hardware.GPIO.drive(PIN, 0)  # Inside the window: not dispatched yet.
+    assert not recorder.changed.wait(DEBOUNCE_MS / 2000)
+    recorder.wait()
+
+    assert recorder.states == [1, 0]
+    assert interface.get_input_component("button").state == 0
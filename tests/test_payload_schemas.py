@@ -0,0 +1,83 @@
+import importlib
+import os
+import re
+import sys
+
+import pytest
+
+"""
+The payload schemas checked against sources written independently of
+them: the structs in the Arduino sketches, and the struct layouts the
+simulated Arduinos answer with. PayloadSchema.sketch_size is typed by
+hand next to the schema, so verify() alone cannot catch a schema and its
+size being wrong together.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "Jacky's Pi Sys"))
+os.environ.setdefault("AIRLOCK_BACKEND", "simulator")
+
+schemas = importlib.import_module('pi-systems_payload-schemas')
+simulator = importlib.import_module('pi-systems_simulator')
+
+# sizeof() of the member types on the AVR Arduinos.
+AVR_SIZES = {
+    "bool": 1, "byte": 1, "char": 1, "int8_t": 1, "uint8_t": 1,
+    "short": 2, "int": 2, "word": 2, "int16_t": 2, "uint16_t": 2,
+    "long": 4, "float": 4, "int32_t": 4, "uint32_t": 4
+}
+
+STRUCT = re.compile(
+    r"typedef\s+struct\s*(\w*)\s*\{(.*?)\}\s*(\w*)\s*;", re.S)
+MEMBER = re.compile(r"^\s*(\w+)\s+\w+\s*;", re.M)
+COMMENT = re.compile(r"//[^\n]*|/\*.*?\*/", re.S)
+
+# The struct each simulated Arduino packs for the schema's payload.
+SIMULATED = {
+    "SensorData": simulator.SensorBoard.SEND_DATA,
+    "DoorState": simulator.DoorController.GET_DOOR_STATE_T,
+    "SetDoorState": simulator.DoorController.SET_DOOR_STATE_T,
+    "SetPressure": simulator.PressureController.SET_PRESSURE_T,
+    "UpdateDisplay": simulator.HexDisplay.UPDATE_DISPLAY_T
+}
+
+
+# sizeof() of every packed struct typedef in a sketch, by name.
+def sketch_struct_sizes(path):
+    with open(path) as f:
+        source = COMMENT.sub("", f.read())
+    sizes = {}
+    for match in STRUCT.finditer(source):
+        size = 0
+        for member in MEMBER.finditer(match.group(2)):
+            member_type = member.group(1)
+            size += sizes.get(member_type) or AVR_SIZES[member_type]
+        sizes[match.group(1) or match.group(3)] = size
+    return sizes
+
+
+@pytest.mark.parametrize("schema", schemas.SCHEMAS, ids=lambda s: s.name)
+def test_schema_matches_sketch_struct(schema):
+    path, struct_name = schema.sketch.rsplit(": ", 1)
+    sizes = sketch_struct_sizes(os.path.join(ROOT, path))
+
+    assert struct_name in sizes, "%s not found in %s" % (struct_name, path)
+    assert schema.codec.size == sizes[struct_name]
+    assert schema.sketch_size == sizes[struct_name]
+
+
+@pytest.mark.parametrize("schema", schemas.SCHEMAS, ids=lambda s: s.name)
+def test_schema_matches_simulator(schema):
+    assert schema.codec.format == SIMULATED[schema.name].format
+
+
+def test_verify():
+    assert schemas.verify() == []
+
+
+def test_verify_reports_mismatch():
+    schema = schemas.PayloadSchema(
+        "Short", [("value", "B")], sketch="test.ino: Short_t",
+        sketch_size=5)
+
+    assert len(schemas.verify([schema])) == 1